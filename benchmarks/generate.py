@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+"""
+Seeded generators of synthetic inputs for the benchmark suite.
+
+All data derive from one numpy RandomState per file, so a scale and seed
+always give the same files:
+    taxdb.sqlite              small taxonomy in the ete3 sqlite layout
+    seqid2taxid.map           reference sequences of the leaf taxa
+    sample.out                centrifuge classification output
+    sample.report.tsv         centrifuge report matching sample.out
+    sample.mapping.ARG        deepARG mapping output
+    features.gene.length      ARG lengths of the deepARG database
+    sample.filtered_genomes   candidate genomes of a sample
+    sample.sourmash.tsv       sourmash containment of the candidates
+
+    python benchmarks/generate.py --scale 1M --out benchmarks/data/1M
+"""
+
+from argparse import ArgumentParser
+import pandas as pd
+import numpy as np
+import sqlite3
+import json
+import sys
+import os
+
+# rows of the large inputs and number of species of the taxonomy
+SCALES = {"smoke": (10000, 500),
+          "1M": (1000000, 5000),
+          "10M": (10000000, 20000),
+          "100M": (100000000, 20000)}
+
+RANKS = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
+
+# rows written at a time by the large generators
+CHUNK = 1000000
+
+HERV_TAXID = 45617
+
+class Taxonomy(object):
+    """Nodes of a synthetic taxonomy: parallel lists of taxid, parent, rank and name"""
+    def __init__(self):
+        self.taxid, self.parent, self.rank, self.name = [], [], [], []
+        self.kingdom = {}
+
+    def add(self, taxid, parent, rank, name, kingdom=None):
+        self.taxid.append(taxid)
+        self.parent.append(parent)
+        self.rank.append(rank)
+        self.name.append(name)
+        if kingdom:
+            self.kingdom[taxid] = kingdom
+        return taxid
+
+def make_taxonomy(num_species, seed):
+    """Random taxonomy of bacteria, fungi and viruses below the real top-level nodes, with human and HERVs"""
+    rng = np.random.RandomState(seed)
+    tax = Taxonomy()
+    tax.add(1, 1, "no rank", "root")
+    tax.add(131567, 1, "no rank", "cellular organisms")
+    kingdoms = [("Bacteria", tax.add(2, 131567, "superkingdom", "Bacteria"), 0.6),
+                ("Eukaryota", tax.add(2759, 131567, "superkingdom", "Eukaryota"), 0.1),
+                ("Viruses", tax.add(10239, 1, "superkingdom", "Viruses"), 0.3)]
+    # the host
+    parent = 2759
+    for rank, taxid, name in zip(RANKS[1:], [7711, 40674, 9443, 9604, 9605, 9606],
+                                 ["Chordata", "Mammalia", "Primates", "Hominidae", "Homo", "Homo sapiens"]):
+        parent = tax.add(taxid, parent, rank, name, "Eukaryota")
+    # human endogenous retroviruses, excluded from the viral candidates
+    tax.add(HERV_TAXID, 10239, "no rank", "Human endogenous retroviruses", "Viruses")
+    for i in range(3):
+        tax.add(HERV_TAXID * 10 + i, HERV_TAXID, "species", "Human endogenous retrovirus {}".format(i), "Viruses")
+
+    next_taxid = [1000000]
+    def new_taxid():
+        next_taxid[0] += 1
+        return next_taxid[0]
+
+    for kingdom, kingdom_taxid, share in kingdoms:
+        n = max(1, int(num_species * share))
+        # fan-out from phylum to genus, about 5 species per genus
+        sizes = [max(1, int(n / f)) for f in (500, 200, 80, 25, 5)]
+        parents = [kingdom_taxid]
+        for rank, size in zip(RANKS[1:6], sizes):
+            level = []
+            for j in range(size):
+                level.append(tax.add(new_taxid(), parents[rng.randint(len(parents))], rank,
+                                     "{} {} {}".format(kingdom[:3], rank, j), kingdom))
+            parents = level
+        genera = parents
+        for j in range(n):
+            genus = genera[rng.randint(len(genera))]
+            species = tax.add(new_taxid(), genus, "species", "{} species {}".format(kingdom[:3], j), kingdom)
+            # some species have strains below them, reported as leaves
+            for k in range(rng.choice([0, 0, 0, 1, 2, 3])):
+                tax.add(new_taxid(), species, "no rank", "{} species {} strain {}".format(kingdom[:3], j, k), kingdom)
+    return tax
+
+def leaf_taxa(tax):
+    """Taxids without children"""
+    parents = set(tax.parent)
+    return np.array([t for t in tax.taxid if t not in parents], dtype=np.int64)
+
+def write_taxdb(tax, fp, seed):
+    """Taxonomy in the ete3 sqlite layout, with a few synonyms and merged taxids"""
+    rng = np.random.RandomState(seed)
+    if os.path.exists(fp):
+        os.remove(fp)
+    parent = dict(zip(tax.taxid, tax.parent))
+    def track(taxid):
+        lineage = [taxid]
+        while parent[lineage[-1]] != lineage[-1]:
+            lineage.append(parent[lineage[-1]])
+        return ",".join(map(str, lineage))
+    con = sqlite3.connect(fp)
+    con.execute("CREATE TABLE stats (version INT PRIMARY KEY)")
+    con.execute("CREATE TABLE species (taxid INT PRIMARY KEY, parent INT, spname VARCHAR(50) COLLATE NOCASE, "
+                "common VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT)")
+    con.execute("CREATE TABLE synonym (taxid INT, spname VARCHAR(50) COLLATE NOCASE, PRIMARY KEY (spname, taxid))")
+    con.execute("CREATE TABLE merged (taxid_old INT, taxid_new INT)")
+    con.execute("INSERT INTO stats VALUES (2)")
+    con.executemany("INSERT INTO species VALUES (?, ?, ?, '', ?, ?)",
+                    [(t, "" if t == 1 else p, n, r, track(t))
+                     for t, p, n, r in zip(tax.taxid, tax.parent, tax.name, tax.rank)])
+    picks = rng.choice(len(tax.taxid), size=min(200, len(tax.taxid)), replace=False)
+    con.executemany("INSERT INTO synonym VALUES (?, ?)",
+                    [(tax.taxid[i], "synonym of {}".format(tax.name[i])) for i in picks[:100]])
+    con.executemany("INSERT INTO merged VALUES (?, ?)",
+                    [(9000000 + j, tax.taxid[i]) for j, i in enumerate(picks[100:])])
+    con.commit()
+    con.close()
+
+def write_chunked(fp, rows, make_chunk, header=True):
+    """Write rows produced by make_chunk(start, n) in chunks of CHUNK rows"""
+    with open(fp, "w") as fh:
+        for start in range(0, rows, CHUNK):
+            df = make_chunk(start, min(CHUNK, rows - start))
+            df.to_csv(fh, sep="\t", index=False, header=header and start == 0)
+
+def zipf_choice(rng, values, n, a=1.2):
+    """n draws from values with Zipf-like weights over a random order of values"""
+    weights = 1.0 / np.arange(1, len(values) + 1) ** a
+    weights /= weights.sum()
+    order = rng.permutation(len(values))
+    return values[order][rng.choice(len(values), size=n, p=weights)]
+
+def write_seqid2taxid(tax, fp, rows, seed):
+    rng = np.random.RandomState(seed)
+    leaves = leaf_taxa(tax)
+    # a few sequences of taxids missing from the taxonomy
+    leaves = np.append(leaves, [8999999])
+    def chunk(start, n):
+        return pd.DataFrame({"seq": ["NZ_{:09d}.1".format(i) for i in range(start, start + n)],
+                             "taxID": leaves[rng.randint(len(leaves), size=n)]})
+    write_chunked(fp, rows, chunk, header=False)
+
+def write_centrifuge(tax, out_fp, report_fp, rows, seed):
+    """Centrifuge output with host, unclassified and multi-matching reads, and its report"""
+    rng = np.random.RandomState(seed)
+    leaves = leaf_taxa(tax)
+    leaves = leaves[leaves != 9606]
+    counts = {}
+    def chunk(start, n):
+        taxid = zipf_choice(rng, leaves, n)
+        kind = rng.random_sample(n)
+        taxid[kind < 0.05] = 0
+        taxid[(kind >= 0.05) & (kind < 0.15)] = 9606
+        num_matches = np.where(rng.random_sample(n) < 0.85, 1, rng.randint(2, 6, size=n))
+        hit_length = rng.randint(16, 151, size=n)
+        score = (hit_length - 15) ** 2 + rng.randint(0, 50, size=n)
+        unclassified = taxid == 0
+        hit_length[unclassified] = 0
+        score[unclassified] = 0
+        num_matches[unclassified] = 1
+        df = pd.DataFrame({"readID": ["read{:010d}".format(i) for i in range(start, start + n)],
+                           "seqID": np.where(unclassified, "unclassified", "species"),
+                           "taxID": taxid,
+                           "score": score,
+                           "2ndBestScore": np.where(num_matches > 1, score, 0),
+                           "hitLength": hit_length,
+                           "queryLength": 150,
+                           "numMatches": num_matches},
+                          columns=["readID", "seqID", "taxID", "score", "2ndBestScore",
+                                   "hitLength", "queryLength", "numMatches"])
+        agg = df.loc[~unclassified].groupby("taxID").agg(
+            numReads=("readID", "size"), numUniqueReads=("numMatches", lambda m: (m == 1).sum()))
+        for t, reads, unique in zip(agg.index, agg.numReads, agg.numUniqueReads):
+            c = counts.setdefault(t, [0, 0])
+            c[0] += reads
+            c[1] += unique
+        return df
+    write_chunked(out_fp, rows, chunk)
+
+    taxids = np.array(sorted(counts), dtype=np.int64)
+    pos = {t: i for i, t in enumerate(tax.taxid)}
+    kingdom = [tax.kingdom.get(t, "") for t in taxids]
+    genome_size = np.where(np.array(kingdom) == "Viruses", rng.randint(10000, 300000, size=len(taxids)),
+                           rng.randint(1000000, 10000000, size=len(taxids)))
+    genome_size[taxids == 9606] = 3100000000
+    unique = np.array([counts[t][1] for t in taxids], dtype=float)
+    abundance = unique / genome_size
+    abundance = abundance / abundance.sum() if abundance.sum() > 0 else abundance
+    report = pd.DataFrame({"name": [tax.name[pos[t]] for t in taxids],
+                           "taxID": taxids,
+                           "taxRank": ["leaf" if tax.rank[pos[t]] == "no rank" else tax.rank[pos[t]] for t in taxids],
+                           "genomeSize": genome_size,
+                           "numReads": [counts[t][0] for t in taxids],
+                           "numUniqueReads": unique.astype(np.int64),
+                           "abundance": np.round(abundance, 6)},
+                          columns=["name", "taxID", "taxRank", "genomeSize", "numReads", "numUniqueReads", "abundance"])
+    report.to_csv(report_fp, sep="\t", index=False)
+
+def write_deeparg(mapping_fp, length_fp, rows, seed, num_genes=2000, num_classes=30):
+    rng = np.random.RandomState(seed)
+    genes = np.array(["ARG{:05d}".format(i) for i in range(num_genes)])
+    classes = np.array(["class{:02d}".format(i) for i in range(num_classes)])
+    gene_class = classes[rng.randint(num_classes, size=num_genes)]
+    gene_length = rng.randint(300, 3000, size=num_genes)
+    with open(length_fp, "w") as fh:
+        for i, (gene, length) in enumerate(zip(genes, gene_length)):
+            # one or two database entries per gene, with slightly different lengths
+            for j in range(1 + i % 2):
+                fh.write("DB{}|{}|{}|{}\t{}\n".format(i, j, gene_class[i], gene.lower(), length + 3 * j))
+    def chunk(start, n):
+        g = zipf_choice(rng, np.arange(num_genes), n, a=1.0)
+        qlen = rng.randint(20, 50, size=n)
+        qstart = (rng.random_sample(n) * (gene_length[g] - qlen)).astype(np.int64) + 1
+        return pd.DataFrame({"#ARG": genes[g],
+                             "query-start": qstart,
+                             "query-end": qstart + qlen,
+                             "read_id": ["read{:010d}".format(i) for i in range(start, start + n)],
+                             "predicted_ARG-class": gene_class[g],
+                             "best-hit": ["DB{}|0|{}|{}".format(i, gene_class[i], genes[i].lower()) for i in g],
+                             "probability": np.round(rng.uniform(0.8, 1, size=n), 3),
+                             "identity": np.round(rng.uniform(80, 100, size=n), 2),
+                             "alignment-length": qlen,
+                             "alignment-bitscore": np.round(qlen * 1.9, 1),
+                             "alignment-evalue": 1e-10,
+                             "counts": 1},
+                            columns=["#ARG", "query-start", "query-end", "read_id", "predicted_ARG-class", "best-hit",
+                                     "probability", "identity", "alignment-length", "alignment-bitscore",
+                                     "alignment-evalue", "counts"])
+    write_chunked(mapping_fp, rows, chunk)
+
+def candidate_genomes(tax, rng, n):
+    """Filtered genome table of n candidate sequences, as written by centrifuge_filter_genomes.py"""
+    leaves = leaf_taxa(tax)
+    leaves = leaves[np.isin(leaves, list(tax.kingdom))]
+    pos = {t: i for i, t in enumerate(tax.taxid)}
+    parent = dict(zip(tax.taxid, tax.parent))
+    def ancestor(t, rank):
+        while tax.rank[pos[t]] != rank and parent[t] != t:
+            t = parent[t]
+        return tax.name[pos[t]] if tax.rank[pos[t]] == rank else ""
+    taxa = np.unique(leaves[rng.randint(len(leaves), size=max(1, n // 20))])
+    info = {t: (tax.name[pos[t]], ancestor(t, "genus"), ancestor(t, "family"), tax.kingdom[t]) for t in taxa}
+    taxid = taxa[rng.randint(len(taxa), size=n)]
+    # distinct accessions in random order
+    seq = np.arange(n) * 4 + rng.randint(4, size=n)
+    rng.shuffle(seq)
+    return pd.DataFrame({"seq": ["NZ_{:09d}.1".format(s) for s in seq],
+                         "taxID": taxid,
+                         "name": [info[t][0] for t in taxid],
+                         "genus": [info[t][1] for t in taxid],
+                         "family": [info[t][2] for t in taxid],
+                         "kingdom": [info[t][3] for t in taxid]},
+                        columns=["seq", "taxID", "name", "genus", "family", "kingdom"])
+
+def write_sourmash(tax, genomes_fp, sourmash_fp, rows, seed):
+    """Candidate genomes of a sample and the sourmash containment of about half of them"""
+    rng = np.random.RandomState(seed)
+    genomes = candidate_genomes(tax, rng, rows)
+    genomes.to_csv(genomes_fp, sep="\t", index=False)
+    hit = genomes.loc[rng.random_sample(len(genomes)) < 0.5]
+    f_match = np.round(rng.beta(0.5, 2, size=len(hit)), 4)
+    pd.DataFrame({"seq": hit.seq.values,
+                  "intersect_bp": (f_match * 100000).astype(np.int64) * 100,
+                  "f_orig_query": np.round(f_match / 10, 4),
+                  "f_match": f_match,
+                  "f_unique_to_query": np.round(f_match / 20, 4),
+                  "group": np.where(hit.kingdom.values == "Viruses", "virus", "nonvirus")},
+                 columns=["seq", "intersect_bp", "f_orig_query", "f_match", "f_unique_to_query", "group"]).to_csv(
+        sourmash_fp, sep="\t", index=False)
+
+def generate(scale, outdir, seed=1):
+    """Generate all inputs of a scale into outdir, unless they exist for the same scale and seed"""
+    rows, num_species = SCALES[scale]
+    stamp = os.path.join(outdir, "generated.json")
+    params = {"scale": scale, "rows": rows, "species": num_species, "seed": seed}
+    if os.path.exists(stamp):
+        with open(stamp) as fh:
+            if json.load(fh) == params:
+                return rows
+    os.makedirs(outdir, exist_ok=True)
+    steps = [
+        ("taxonomy", lambda tax: write_taxdb(tax, os.path.join(outdir, "taxdb.sqlite"), seed + 1)),
+        ("seqid2taxid.map", lambda tax: write_seqid2taxid(tax, os.path.join(outdir, "seqid2taxid.map"), rows, seed + 2)),
+        ("centrifuge output", lambda tax: write_centrifuge(tax, os.path.join(outdir, "sample.out"),
+                                                           os.path.join(outdir, "sample.report.tsv"), rows, seed + 3)),
+        ("deepARG mapping", lambda tax: write_deeparg(os.path.join(outdir, "sample.mapping.ARG"),
+                                                      os.path.join(outdir, "features.gene.length"), rows, seed + 4)),
+        ("sourmash containment", lambda tax: write_sourmash(tax, os.path.join(outdir, "sample.filtered_genomes"),
+                                                            os.path.join(outdir, "sample.sourmash.tsv"), rows, seed + 5)),
+    ]
+    tax = make_taxonomy(num_species, seed)
+    for name, step in steps:
+        sys.stderr.write("Generating {} ({} rows) in {}\n".format(name, rows, outdir))
+        step(tax)
+    with open(stamp, "w") as fh:
+        json.dump(params, fh)
+    return rows
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--scale", type=str, default="smoke", choices=sorted(SCALES),
+                        help="Number of rows of the large inputs (default = smoke)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Random seed (default = 1)")
+    parser.add_argument("--out", type=str, required=True,
+                        help="Output directory.")
+    args = parser.parse_args()
+    generate(args.scale, args.out, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""
+Benchmark of the Python stages of the pipeline on synthetic data.
+
+Generates the inputs of a scale with generate.py (kept in --workdir between
+runs), then runs each stage the way its rule does, in a child process:
+    taxtable                 scripts/taxtable.py
+    seqidindex               scripts/seqidindex.py
+    parse_centrifuge         scripts/parse_centrifuge.py
+    centrifuge_filter        filter_genomes of scripts/centrifuge_filter_genomes.py
+    parse_ARG                scripts/parse_ARG.py
+    summarize_centrifuge_db  resources/summarize_centrifuge_db.py
+    sourmash_filter          coverage_filter of scripts/select_genomes.py
+and records its wall time, peak RSS and throughput (input rows per second).
+The outputs of each stage are checked against the checksums in golden.json,
+so an optimization cannot silently change results; --update_golden records
+the current outputs as the reference instead. Results are appended to --out
+to track them over commits.
+
+    python benchmarks/run.py --scale 1M --out benchmarks/results.tsv
+"""
+
+from argparse import ArgumentParser
+import subprocess
+import hashlib
+import shutil
+import json
+import time
+import sys
+import os
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GOLDEN = os.path.join(REPO, "benchmarks", "golden.json")
+
+COLUMNS = ["date", "commit", "scale", "stage", "rows", "seconds", "max_rss_mb", "rows_per_second", "golden"]
+
+def stages(data, work):
+    """(name, command, outputs, number of input rows) of each stage, in run order"""
+    d = lambda *p: os.path.join(data, *p)
+    w = lambda *p: os.path.join(work, *p)
+    script = lambda *p: os.path.join(REPO, *p)
+    call = "import sys; sys.path.insert(0, {!r}); ".format(script("scripts"))
+    rows = lambda fp: lambda: count_lines(fp)
+    return [
+        ("taxtable",
+         ["python", script("scripts", "taxtable.py"), "--taxdb", d("taxdb.sqlite"), "--out", w("taxdb.taxtable")],
+         [w("taxdb.taxtable")], lambda: count_taxa(d("taxdb.sqlite"))),
+        ("seqidindex",
+         ["python", script("scripts", "seqidindex.py"), "--mapfile", d("seqid2taxid.map"),
+          "--taxtable", w("taxdb.taxtable"), "--out", w("seqid2taxid.index")],
+         [w("seqid2taxid.index")], lambda: count_lines(d("seqid2taxid.map"), header=False)),
+        ("parse_centrifuge",
+         ["python", script("scripts", "parse_centrifuge.py"), "-i", d("sample.out"), "-r", d("sample.report.tsv"),
+          "--taxdb", w("taxdb.taxtable"), "--unique", "--normalize", "--min_score", "75", "--min_length", "22",
+          "--reportTaxalineage", w("sample.report.taxlineage"), "--taxidHitFolder", w("ViralHitReads")],
+         [w("sample.report.taxlineage"), w("ViralHitReads")], rows(d("sample.out"))),
+        ("centrifuge_filter",
+         ["python", "-c", call + "from centrifuge_filter_genomes import filter_genomes; "
+          "filter_genomes(sys.argv[1], sys.argv[2], sys.argv[3], 2000, 0.01, '9606', sys.argv[4])",
+          d("sample.report.tsv"), w("taxdb.taxtable"), w("seqid2taxid.index"), w("sample.filtered_genomes")],
+         [w("sample.filtered_genomes")], rows(d("sample.report.tsv"))),
+        # the pie chart is not compared, its bytes depend on the matplotlib version
+        ("parse_ARG",
+         ["python", script("scripts", "parse_ARG.py"), "--deeparg_file", d("sample.mapping.ARG"),
+          "--features_gene_length", d("features.gene.length"),
+          "--out_table", w("sample.ARG.tsv"), "--out_png", w("sample.ARG.png")],
+         [w("sample.ARG.tsv")], rows(d("sample.mapping.ARG"))),
+        ("summarize_centrifuge_db",
+         ["python", script("resources", "summarize_centrifuge_db.py"), "--seqid2taxidmap", d("seqid2taxid.map"),
+          "--taxtable", w("taxdb.taxtable"), "--mapTaxafile", w("seqid2taxa.map")],
+         [w("seqid2taxa.map"), w("summarize_centrifuge_db.stdout")],
+         lambda: count_lines(d("seqid2taxid.map"), header=False)),
+        ("sourmash_filter",
+         ["python", "-c", call + "from select_genomes import coverage_filter; "
+          "coverage_filter(sys.argv[1], sys.argv[2], 0.1).to_csv(sys.argv[3], sep='\\t', index=False)",
+          d("sample.sourmash.tsv"), d("sample.filtered_genomes"), w("sample.genomes.filtered.ids.tax")],
+         [w("sample.genomes.filtered.ids.tax")], rows(d("sample.filtered_genomes"))),
+    ]
+
+def count_lines(fp, header=True):
+    """Number of data lines of a table"""
+    with open(fp, "rb") as fh:
+        n = sum(1 for line in fh)
+    return n - 1 if header else n
+
+def count_taxa(fp):
+    import sqlite3
+    con = sqlite3.connect(fp)
+    n = con.execute("SELECT count(*) FROM species").fetchone()[0]
+    con.close()
+    return n
+
+def run_stage(command, stdout_fp):
+    """Wall time in seconds and peak RSS in MB of a command run in a child process"""
+    start = time.time()
+    with open(stdout_fp, "w") as out:
+        proc = subprocess.Popen(command, stdout=out, cwd=REPO)
+        pid, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.time() - start
+    if os.WEXITSTATUS(status) or os.WIFSIGNALED(status):
+        raise subprocess.CalledProcessError(status, command)
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, usage.ru_maxrss / 1024.0
+
+def checksum(paths):
+    """sha256 of the contents of files and of the files below directories, by relative path"""
+    h = hashlib.sha256()
+    for path in paths:
+        files = [path] if os.path.isfile(path) else \
+            sorted(os.path.join(root, f) for root, dirs, fs in os.walk(path) for f in fs)
+        for fp in files:
+            h.update(os.path.relpath(fp, os.path.dirname(path)).encode("utf-8") + b"\0")
+            with open(fp, "rb") as fh:
+                for block in iter(lambda: fh.read(1 << 20), b""):
+                    h.update(block)
+    return h.hexdigest()
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO,
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return ""
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--scale", type=str, default="smoke",
+                        help="Input size: smoke, 1M, 10M or 100M rows (default = smoke)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="Random seed of the inputs (default = 1)")
+    parser.add_argument("--workdir", type=str, default=os.path.join(REPO, "benchmarks", "data"),
+                        help="Directory of the generated inputs and the outputs (default = benchmarks/data)")
+    parser.add_argument("--stages", type=str, nargs="+",
+                        help="Only run these stages (the stages they depend on must have run before).")
+    parser.add_argument("--update_golden", action="store_true",
+                        help="Record the checksums of the outputs in golden.json instead of checking them.")
+    parser.add_argument("--out", type=str,
+                        help="Table the results are appended to.")
+    args = parser.parse_args()
+
+    data = os.path.join(args.workdir, args.scale)
+    work = os.path.join(data, "out")
+    # in its own process, the peak RSS of a child includes the memory of this one at fork time
+    subprocess.check_call(["python", os.path.join(REPO, "benchmarks", "generate.py"), "--scale", args.scale,
+                           "--seed", str(args.seed), "--out", data])
+    os.makedirs(work, exist_ok=True)
+
+    golden = {}
+    if os.path.exists(GOLDEN):
+        with open(GOLDEN) as fh:
+            golden = json.load(fh)
+    key = "{}/seed{}".format(args.scale, args.seed)
+    reference = golden.setdefault(key, {})
+
+    date, commit = time.strftime("%Y-%m-%d %H:%M:%S"), git_commit()
+    results, failed = [], []
+    print("\t".join(COLUMNS))
+    for name, command, outputs, rows in stages(data, work):
+        if args.stages and name not in args.stages:
+            continue
+        for path in outputs:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        # scripts writing into a directory expect it to exist
+        if name == "parse_centrifuge":
+            os.makedirs(os.path.join(work, "ViralHitReads"))
+        sys.stderr.write("Running {}\n".format(name))
+        seconds, rss = run_stage(command, os.path.join(work, name + ".stdout"))
+        n = rows()
+        digest = checksum(outputs)
+        if args.update_golden:
+            reference[name] = digest
+            status = "updated"
+        elif name not in reference:
+            status = "missing"
+        else:
+            status = "ok" if reference[name] == digest else "DIFFERS"
+            if status != "ok":
+                failed.append(name)
+        row = [date, commit, args.scale, name, n, "{:.2f}".format(seconds), "{:.1f}".format(rss),
+               "{:.0f}".format(n / seconds if seconds > 0 else 0), status]
+        results.append("\t".join(map(str, row)))
+        print(results[-1])
+        sys.stdout.flush()
+
+    if args.update_golden:
+        with open(GOLDEN, "w") as fh:
+            json.dump(golden, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+    if args.out:
+        new = not os.path.exists(args.out)
+        with open(args.out, "a") as fh:
+            if new:
+                fh.write("\t".join(COLUMNS) + "\n")
+            fh.write("".join(line + "\n" for line in results))
+    if failed:
+        sys.stderr.write("ERROR: outputs of {} differ from golden.json\n".format(", ".join(failed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
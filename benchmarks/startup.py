@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+Startup benchmark of the workflow on a synthetic project with many samples.
+
+Generates a project with --samples empty BAM files, a sample list, a config
+file and empty stand-ins of the reference databases, then times:
+    load_cold   loading the sample list without a manifest
+    load_warm   loading it again from the manifest
+    dryrun_cold snakemake -n without a manifest (parsing and DAG building)
+    dryrun_warm snakemake -n with the manifest
+and appends one row per run to --out, so startup time can be tracked over
+commits.
+
+    python benchmarks/startup.py --samples 10000 --out benchmarks/startup.tsv
+"""
+
+from argparse import ArgumentParser
+import subprocess
+import tempfile
+import shutil
+import time
+import yaml
+import sys
+import os
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO, "scripts"))
+from samplemanifest import load_sample_list, manifest_path
+
+COLUMNS = ["date", "commit", "samples", "load_cold", "load_warm", "dryrun_cold", "dryrun_warm", "jobs"]
+
+def make_project(workdir, num_samples):
+    """Synthetic project with empty read files and database stand-ins, returns the config file"""
+    data = os.path.join(workdir, "data")
+    resources = os.path.join(workdir, "resources")
+    os.makedirs(data, exist_ok=True)
+    with open(os.path.join(workdir, "samples.csv"), "w") as fh:
+        for i in range(num_samples):
+            bam = os.path.join(data, "S{:05d}.bam".format(i))
+            open(bam, "w").close()
+            fh.write("S{:05d},{},\n".format(i, bam))
+
+    with open(os.path.join(REPO, "config", "config.yaml")) as fh:
+        config = yaml.safe_load(fh.read().format(PROJECT_FP=workdir, CONDA_FP=""))
+    config.update({"taxdb": resources,
+                   "deeparg_dir": os.path.join(resources, "deeparg"),
+                   "centrifuge_dir": os.path.join(resources, "classifier_db"),
+                   "bowtie2_index_cache": os.path.join(resources, "bowtie2_index_cache")})
+    # inputs of the workflow that no rule creates
+    stubs = [os.path.join(config["centrifuge_dir"], "{}.{}.cf".format(config["centrifuge_base"], i))
+             for i in (1, 2, 3)]
+    stubs += [os.path.join(resources, name) for name in
+              ("Virus_MoH2006.descendants.tsv", "Bac_Fungi_MoH2006.descendants.tsv")]
+    for stub in stubs:
+        os.makedirs(os.path.dirname(stub), exist_ok=True)
+        open(stub, "w").close()
+    os.makedirs(config["deeparg_dir"], exist_ok=True)
+
+    configfile = os.path.join(workdir, "config.yaml")
+    with open(configfile, "w") as fh:
+        yaml.safe_dump(config, fh, default_flow_style=False)
+    return configfile, config
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+def dryrun(configfile):
+    """Number of jobs of a dry run of the workflow"""
+    out = subprocess.check_output(["snakemake", "-n", "--configfile", configfile],
+                                  cwd=REPO, stderr=subprocess.STDOUT).decode("utf-8")
+    for line in out.splitlines():
+        if line.startswith("total"):
+            return int(line.split()[-1])
+    return 0
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO,
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return ""
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--samples", type=int, default=10000,
+                        help="Number of synthetic samples (default = 10000)")
+    parser.add_argument("--workdir", type=str,
+                        help="Directory of the synthetic project (default = a temporary directory, removed afterwards)")
+    parser.add_argument("--skip_dryrun", action="store_true",
+                        help="Only time loading the sample list.")
+    parser.add_argument("--out", type=str,
+                        help="Table the results are appended to.")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="ion-meta-startup.")
+    try:
+        sys.stderr.write("Generating {} samples in {}\n".format(args.samples, workdir))
+        configfile, config = make_project(workdir, args.samples)
+        manifest = manifest_path(config["samplelist_fp"])
+        # files modified within the mtime resolution are not trusted by the manifest
+        time.sleep(2)
+
+        row = {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "commit": git_commit(), "samples": args.samples}
+        if os.path.exists(manifest):
+            os.remove(manifest)
+        row["load_cold"], samples = timed(load_sample_list, config["samplelist_fp"], False, manifest)
+        row["load_warm"], samples = timed(load_sample_list, config["samplelist_fp"], False, manifest)
+        row["dryrun_cold"] = row["dryrun_warm"] = row["jobs"] = ""
+        if not args.skip_dryrun:
+            os.remove(manifest)
+            row["dryrun_cold"], row["jobs"] = timed(dryrun, configfile)
+            row["dryrun_warm"], row["jobs"] = timed(dryrun, configfile)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    for key in ("load_cold", "load_warm", "dryrun_cold", "dryrun_warm"):
+        if row[key] != "":
+            row[key] = "{:.2f}".format(row[key])
+    line = "\t".join(str(row[c]) for c in COLUMNS)
+    print("\t".join(COLUMNS))
+    print(line)
+    if args.out:
+        new = not os.path.exists(args.out)
+        with open(args.out, "a") as fh:
+            if new:
+                fh.write("\t".join(COLUMNS) + "\n")
+            fh.write(line + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,144 @@
 #!/usr/bin/env python
 
-from bioservices import KEGG
+"""
+Build kegg_genomeinfo.tsv and kegg_genomeinfo.json from the KEGG GENOME database.
+
+Records are fetched from the KEGG REST API by a few threads sharing a
+token-bucket rate limit, and retried with backoff on 403/429/5xx responses.
+A genome whose record still fails, e.g. with a 404 when it was delisted after
+'list genome', is left out with a warning and fetched again on the next run.
+Raw records are kept in a cache directory:
+    records/{code}.txt  raw KEGG flat file of each genome
+    journal.tsv         code, checksum of its 'list genome' line and time of
+                        each completed record, appended as records complete
+
+A rerun only fetches genomes that are new, whose 'list genome' line changed
+or, with --max_age, whose record is older than that; everything else comes
+from the cache. Rows are written to the TSV and JSON outputs in list order
+as soon as they are available.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from bioservices.kegg import KEGGParser
+import urllib.request
+import urllib.error
+import threading
+import hashlib
 import json
 import time
+import sys
+import os
 import re
 
-k = KEGG()
+class TokenBucket(object):
+    """Thread-safe token bucket allowing rate requests per second, in bursts of up to burst"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def fetch(url, bucket, retries=5, timeout=60):
+    """Text of a KEGG REST url, retried with exponential backoff on throttling and server errors"""
+    for attempt in range(retries + 1):
+        bucket.acquire()
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as response:
+                return response.read().decode("utf-8")
+        except urllib.error.HTTPError as e:
+            if e.code not in (403, 429) and e.code < 500 or attempt == retries:
+                raise
+        except urllib.error.URLError:
+            if attempt == retries:
+                raise
+        time.sleep(min(60, 2 ** attempt))
+
+def list_genomes(url, bucket, retries):
+    """(code, checksum of the list line) of all genomes"""
+    genomes = []
+    for line in fetch(url + "/list/genome", bucket, retries).rstrip().split("\n"):
+        line = line.rstrip()
+        if line:
+            genomes.append((line.split("\t")[0], hashlib.sha1(line.encode("utf-8")).hexdigest()))
+    return genomes
+
+class RecordCache(object):
+    def __init__(self, path, max_age=None):
+        self.path = path
+        self.max_age = max_age
+        os.makedirs(os.path.join(path, "records"), exist_ok=True)
+        self.journal = {}
+        journal = os.path.join(path, "journal.tsv")
+        if os.path.exists(journal):
+            with open(journal) as fh:
+                for line in fh:
+                    fields = line.rstrip("\n").split("\t")
+                    # a line cut short by a crash is ignored
+                    if len(fields) == 3:
+                        self.journal[fields[0]] = (fields[1], float(fields[2]))
+        self.fh = open(journal, "a")
+
+    def record_file(self, code):
+        return os.path.join(self.path, "records", code.replace(":", "_") + ".txt")
 
-organisms = k.list("genome")
-organisms = organisms.rstrip().split("\n")
+    def get(self, code, checksum):
+        """Cached record of code, None if it is missing, changed or expired"""
+        if code not in self.journal or self.journal[code][0] != checksum:
+            return None
+        if self.max_age and time.time() - self.journal[code][1] > self.max_age:
+            return None
+        if not os.path.exists(self.record_file(code)):
+            return None
+        with open(self.record_file(code)) as fh:
+            return fh.read()
 
-# get all organisms codes
-org_codes = []
-for org in organisms:
-    org_code = org.rstrip().split("\t")
-    org_codes.append(org_code[0])
+    def put(self, code, record):
+        tmp = self.record_file(code) + ".tmp"
+        with open(tmp, "w") as fh:
+            fh.write(record)
+        os.rename(tmp, self.record_file(code))
 
-records = {}
-fout = open("kegg_genomeinfo.tsv","w")
-fout.write("Taxonomy ID\tDefinition\tTaxonomy LINEAGE\tKeywords\tDisease\tComment\tReference\n")
+    def commit(self, code, checksum):
+        """Mark code as complete in the journal"""
+        self.journal[code] = (checksum, time.time())
+        self.fh.write("{}\t{}\t{}\n".format(code, checksum, self.journal[code][1]))
+        self.fh.flush()
 
-length = len(org_codes)
-for i in range(length):
-    record = k.get(org_codes[i])
-    if record == 403: 
-        time.sleep(1)
-        record = k.get(org_codes[i])
-     
+    def close(self):
+        self.fh.close()
+
+_parser = threading.local()
+
+def parse_record(record):
+    """Parse a record like KEGG.parse, without the connection check of the KEGG service"""
+    if not hasattr(_parser, "parser"):
+        _parser.parser = KEGGParser()
+    try:
+        return _parser.parser.parse(record)
+    except Exception:
+        return {}
+
+def genome_info(record):
+    """(taxid, TSV row, parsed record) of a KEGG genome record, None for viruses"""
     # exclude viruses since parse function cannot deal with them
-    m = re.search(r"Viruses;", str(record))
-    if m: continue
-    
-    dict = k.parse(record)
+    if re.search(r"Viruses;", str(record)):
+        return None
+    dict = parse_record(record)
     if not 'KEYWORDS' in dict: dict['KEYWORDS'] = ""
     if not 'DISEASE' in dict: dict['DISEASE'] = {}
     if not 'COMMENT' in dict: dict['COMMENT'] = ""
@@ -40,13 +147,97 @@ for i in range(length):
         for key, value in dict["REFERENCE"][0].items():
             if ref: ref = ref + ", " + key + ":" + value
             else: ref = key + ":" + value
-            
-    fout.write(dict['TAXONOMY'][0]['TAXONOMY'].split(":")[1]+"\t"+dict['DEFINITION']+"\t"+dict['TAXONOMY'][0]['LINEAGE']+"\t"+dict['KEYWORDS']+"\t"+", ".join(list(dict['DISEASE'].values()))+"\t"+"; ".join(dict['COMMENT'])+"\t"+ref+"\n")
-    records[dict['TAXONOMY'][0]['TAXONOMY'].split(":")[1]] = dict
-    time.sleep(0.1)
+    taxid = dict['TAXONOMY'][0]['TAXONOMY'].split(":")[1]
+    row = taxid+"\t"+dict['DEFINITION']+"\t"+dict['TAXONOMY'][0]['LINEAGE']+"\t"+dict['KEYWORDS']+"\t"+", ".join(list(dict['DISEASE'].values()))+"\t"+"; ".join(dict['COMMENT'])+"\t"+ref+"\n"
+    return taxid, row, dict
+
+def ordered_map(executor, fn, items, window):
+    """Like executor.map, with at most window items in flight"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def download_genomeinfo(url, cachedir, tsv, jsonfile, threads=4, rate=3.0, retries=5, max_age=None):
+    bucket = TokenBucket(rate, max(1, int(rate)))
+    cache = RecordCache(cachedir, max_age)
+    genomes = list_genomes(url, bucket, retries)
+    sys.stderr.write("{} genomes listed, {} in the cache\n".format(
+        len(genomes), sum(1 for code, checksum in genomes if code in cache.journal)))
+
+    def load(genome):
+        code, checksum = genome
+        record = cache.get(code, checksum)
+        status = "cached"
+        if record is None:
+            try:
+                record = fetch(url + "/get/" + code, bucket, retries)
+            except urllib.error.HTTPError as e:
+                sys.stderr.write("WARNING: Could not fetch KEGG record {}: HTTP {}\n".format(code, e.code))
+                return code, checksum, "failed", None
+            cache.put(code, record)
+            status = "fetched"
+        try:
+            info = genome_info(record)
+        except (KeyError, IndexError):
+            sys.stderr.write("WARNING: Could not parse KEGG record {}\n".format(code))
+            info = None
+        return code, checksum, status, info
+
+    counts = {"fetched": 0, "cached": 0, "failed": 0}
+    written = set()
+    start = time.time()
+    with open(tsv, "w") as fout, open(jsonfile, "w") as fjson, ThreadPoolExecutor(threads) as executor:
+        fout.write("Taxonomy ID\tDefinition\tTaxonomy LINEAGE\tKeywords\tDisease\tComment\tReference\n")
+        fjson.write("{")
+        try:
+            for i, (code, checksum, status, info) in enumerate(ordered_map(executor, load, genomes, 4 * threads), start=1):
+                counts[status] += 1
+                # a failed record is not committed, so the next run fetches it again
+                if status != "failed":
+                    cache.commit(code, checksum)
+                if info is not None:
+                    taxid, row, dict = info
+                    fout.write(row)
+                    # the first record of a taxid goes to the JSON file
+                    if taxid not in written:
+                        entry = json.dumps({taxid: dict}, indent=4)[2:-2]
+                        fjson.write(("\n" if not written else ",\n") + entry)
+                        written.add(taxid)
+                    fout.flush()
+                    fjson.flush()
+                if i % 500 == 0:
+                    sys.stderr.write("{} of {} genomes ({} fetched, {} cached, {:.1f} genomes/s)\n".format(
+                        i, len(genomes), counts["fetched"], counts["cached"], i / (time.time() - start)))
+        finally:
+            cache.close()
+        fjson.write("\n}" if written else "}")
+    sys.stderr.write("Done: {} fetched, {} cached, {} failed\n".format(counts["fetched"], counts["cached"], counts["failed"]))
 
-fout.close()
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--url", type=str, default="https://rest.kegg.jp",
+                        help="KEGG REST API base url (default = https://rest.kegg.jp)")
+    parser.add_argument("--cache", type=str, default="kegg_cache",
+                        help="Cache directory of fetched records and the journal (default = kegg_cache)")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of concurrent requests (default = 4)")
+    parser.add_argument("--rate", type=float, default=3.0,
+                        help="Maximum number of requests per second (default = 3)")
+    parser.add_argument("--retries", type=int, default=5,
+                        help="Number of retries of a failed request (default = 5)")
+    parser.add_argument("--max_age", type=float, default=0,
+                        help="Refetch cached records older than this many days (default = 0, never)")
+    parser.add_argument("--tsv", type=str, default="kegg_genomeinfo.tsv",
+                        help="Output table (default = kegg_genomeinfo.tsv)")
+    parser.add_argument("--json", type=str, default="kegg_genomeinfo.json",
+                        help="Output parsed records (default = kegg_genomeinfo.json)")
+    args = parser.parse_args()
+    download_genomeinfo(args.url.rstrip("/"), args.cache, args.tsv, args.json, args.threads, args.rate,
+                        args.retries, args.max_age * 86400 or None)
 
-json_str = json.dumps(records, indent=4)
-with open('kegg_genomeinfo.json', 'w+') as json_file:
-    json_file.write(json_str)
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,98 @@
 #!/usr/bin/python3
 
-import sys
-from ete3 import NCBITaxa
+"""
+Index the taxa covered by the categories of a MoH pathogen table.
+
+The names of all categories (TaxonomyName column) are resolved in one batch,
+and their descendants are taken from the pre-order of the taxonomy table: the
+descendants of a node are a contiguous range of it. Ranges are painted from
+the largest to the smallest category, so each taxid ends up with the most
+specific category containing it, as the report picks it. Two tables are
+written:
+    --categories  the input table with an Entry number and the number of
+                  taxa of each category (NumDescendants, itself included)
+    --index       taxID and Entry of every taxid in a category, merged
+                  taxids included
+"""
+
+from argparse import ArgumentParser
 import pandas as pd
+import numpy as np
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from taxtable import TaxTable
+
+def resolve_categories(df, taxtable):
+    """Node position of each category, -1 for names missing from the taxonomy"""
+    name2taxid = taxtable.name_translator(df.TaxonomyName.astype(str).unique())
+    taxids = []
+    for name, taxonomy_id in zip(df.TaxonomyName.astype(str), df.TaxonomyID):
+        if name not in name2taxid:
+            sys.stderr.write("WARNING: Name {} missing from db\n".format(name))
+            taxids.append(-1)
+            continue
+        taxid = name2taxid[name][0]
+        if int(taxid) != int(taxonomy_id):
+            sys.stderr.write("WARNING: Name {} has a different ID {} in db from {}.\n".format(name, taxid, taxonomy_id))
+        taxids.append(taxid)
+    return taxtable.index(taxids) if taxids else np.zeros(0, dtype=np.int64)
+
+def category_index(taxtable, nodes):
+    """taxids and the category (position in nodes) they belong to, the smallest containing category wins"""
+    tour_in = np.asarray(taxtable.tour_in)
+    tour_out = np.asarray(taxtable.tour_out)
+    owner = np.full(len(tour_in), -1, dtype=np.int64)
+    found = np.nonzero(nodes >= 0)[0]
+    sizes = tour_out[nodes[found]] - tour_in[nodes[found]] + 1
+    # largest first, among equal sizes the first category of the table is painted last
+    for c in found[np.lexsort((-found, -sizes))]:
+        owner[tour_in[nodes[c]]:tour_out[nodes[c]] + 1] = c
+    # owner is indexed by pre-order number
+    preorder = np.empty(len(tour_in), dtype=np.int64)
+    preorder[tour_in] = np.arange(len(tour_in))
+    members = np.nonzero(owner >= 0)[0]
+    taxids = np.asarray(taxtable.taxid)[preorder[members]]
+    entries = owner[members]
+
+    # obsolete taxids follow the taxid they were merged into
+    merged_new = taxtable.index(np.asarray(taxtable.merged_new))
+    keep = merged_new >= 0
+    merged_owner = owner[tour_in[merged_new[keep]]]
+    hit = merged_owner >= 0
+    taxids = np.concatenate([taxids, np.asarray(taxtable.merged_old)[keep][hit]])
+    entries = np.concatenate([entries, merged_owner[hit]])
+    order = np.argsort(taxids, kind="stable")
+    return taxids[order], entries[order]
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--input", type=str, required=True,
+                        help="MoH table with TaxonomyName and TaxonomyID columns (a *.descendants.tsv table works too).")
+    parser.add_argument("--taxtable", type=str, required=True,
+                        help="Compiled taxonomy table of the ete3 sqlite database (see scripts/taxtable.py).")
+    parser.add_argument("--categories", type=str, required=True,
+                        help="Output table of categories.")
+    parser.add_argument("--index", type=str, required=True,
+                        help="Output taxid to category index.")
+    args = parser.parse_args()
+
+    taxtable = TaxTable(args.taxtable)
+    df = pd.read_csv(args.input, header=0, sep="\t", dtype=str)
+    # descendant lists of the old output format are recomputed
+    df = df.drop("Descendants", axis=1, errors="ignore")
+    nodes = resolve_categories(df, taxtable)
+    taxids, entries = category_index(taxtable, nodes)
+
+    found = nodes >= 0
+    df = df.loc[found].copy()
+    df["Entry"] = np.nonzero(found)[0] + 1
+    df["NumDescendants"] = np.asarray(taxtable.tour_out)[nodes[found]] - np.asarray(taxtable.tour_in)[nodes[found]] + 1
+    df.to_csv(args.categories, sep="\t", index=False)
+    pd.DataFrame({"taxID": taxids, "Entry": entries + 1}, columns=["taxID", "Entry"]).to_csv(
+        args.index, sep="\t", index=False)
+    sys.stderr.write("{} of {} categories cover {} taxids\n".format(found.sum(), len(found), len(taxids)))
 
-input_file = sys.argv[1]
-output_file = sys.argv[2]
-taxdb = sys.argv[3] # "resources/taxonomy/taxdb.sqlite"
-
-def get_descendant(taxid, ncbitaxa):
-    descendants = ncbitaxa.get_descendant_taxa(taxid,intermediate_nodes=True)
-    if taxid not in descendants: descendants = descendants + [taxid]
-    return descendants
-
-ncbi = NCBITaxa(taxdb)
-fw = open(output_file,"w")
-
-df = pd.read_csv(input_file, header=0, sep="\t")
-names = df.columns.values.tolist()
-fw.write("\t".join(names) + "\t" + "Descendants"+ "\n")
-
-for index, row in df.iterrows():
-    try:
-        name2taxid = ncbi.get_name_translator([row['TaxonomyName']])
-    except ValueError:
-        sys.stderr.write("WARNING: Name {} missing from db\n".format(row['TaxonomyName']))
-        continue
-    for name, taxid in name2taxid.items():
-        if(int(taxid[0]) != int(row['TaxonomyID'])):
-            print("WARNING: Name {} has a different ID {} in db from {}.\n".format(name, str(taxid[0]), str(row['TaxonomyID'])))
-        descendants = get_descendant(taxid[0],ncbi)
-        fw.write("\t".join(map(str,row)) + "\t" + ",".join(map(str,descendants))+ "\n")
-
-fw.close()
+if __name__ == '__main__':
+    main()
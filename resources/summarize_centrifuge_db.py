@@ -1,83 +1,108 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-from ete3 import NCBITaxa
+from multiprocessing import Pool
+import pandas as pd
+import time
 import sys
+import os
 
-def summarize_to_ranks(mapfile, summary_rank, mapTaxafile, taxdbfile):
-    ncbitaxa = NCBITaxa(taxdbfile)
-    summary1 = {}
-    summary2 = {}
-    lineage_dict = {}
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from taxtable import TaxTable, RANKS
+
+def summarize_taxids(taxtable, taxids, summary_rank):
+    """
+    DataFrame indexed by taxID with name, superkingdom, summary rank name and
+    lineage of each taxid, missing taxids are left out
+    """
+    taxids = pd.unique(taxids)
+    idx = taxtable.index(taxids)
+    found = idx >= 0
+    taxids, idx = taxids[found], idx[found]
+    lineages = taxtable.lineage_names(taxids, sep="\t")
+    fields = [lineage.split("\t") for lineage in lineages]
+    if summary_rank in RANKS:
+        rank_names = [f[RANKS.index(summary_rank)] for f in fields]
+    else:
+        rank_names = ["Unknown"]*len(fields)
+    return pd.DataFrame({"name": taxtable.name_of(idx),
+                         "kingdom": [f[0] for f in fields],
+                         "rank_name": rank_names,
+                         "lineage": lineages}, index=pd.Index(taxids, name="taxID"),
+                        columns=["name", "kingdom", "rank_name", "lineage"])
+
+# per-process state of the summarizing workers
+_taxtable = None
+_summary_rank = None
+_taxa = None
+_missing = None
+
+def init_worker(taxtablefile, summary_rank):
+    global _taxtable, _summary_rank, _taxa, _missing
+    _taxtable = TaxTable(taxtablefile)
+    _summary_rank = summary_rank
+    _taxa = summarize_taxids(_taxtable, [], summary_rank)
+    _missing = set()
+
+def summarize_chunk(chunk):
+    """
+    Output lines, per (kingdom, taxid) and (kingdom, rank name) sequence counts
+    and missing taxids of a chunk of the seqid2taxid map. Each distinct taxid
+    is resolved once per worker.
+    """
+    global _taxa
+    new = pd.Index(pd.unique(chunk.taxID)).difference(_taxa.index).difference(list(_missing))
+    if len(new):
+        _taxa = pd.concat([_taxa, summarize_taxids(_taxtable, new.values, _summary_rank)])
+    missing = new.difference(_taxa.index).tolist()
+    _missing.update(missing)
+    # a left join keeps the map order
+    df = chunk.join(_taxa, on="taxID", how="left").dropna(subset=["lineage"])
+    lines = df.seq + "\t" + df.taxID.astype(str) + "\t" + df.name + "\t" + df.lineage + "\n"
+    return ("".join(lines.tolist()), df.groupby(["kingdom", "taxID"]).size(),
+            df.groupby(["kingdom", "rank_name"]).size(), missing, len(chunk))
+
+def summarize_to_ranks(mapfile, summary_rank, mapTaxafile, taxtablefile, threads=1,
+                       chunksize=200000, report_seconds=30):
     sys.stderr.write("Reading seq2taxid mapfile and summarizing at rank {}\n".format(summary_rank))
-    fhout = open(mapTaxafile, 'w')
-    with open(mapfile, 'r') as fh:
-        for i, line in enumerate(fh, start=1): # start=1: index starts from 1 
-            if i%1000 == 0:
-                sys.stderr.write("Read {} lines...\n".format(i))
-            line = line.rstrip()
-            try:
-                seqid, taxid = line.split("\t")
-            except ValueError:
-                seqid, taxid = line.split()
-            taxid = int(taxid)
-            seq_name = ""
-            try:
-                seq_name = ncbitaxa.get_taxid_translator([taxid])[taxid]
-            except ValueError:
+    reader = pd.read_csv(mapfile, sep=r"\s+", header=None, names=["seq", "taxID"],
+                         usecols=[0, 1], dtype={"seq": str, "taxID": int}, chunksize=chunksize)
+    if threads > 1:
+        pool = Pool(threads, initializer=init_worker, initargs=(taxtablefile, summary_rank))
+        results = pool.imap(summarize_chunk, reader)
+    else:
+        init_worker(taxtablefile, summary_rank)
+        results = map(summarize_chunk, reader)
+
+    tax_counts, rank_counts = [], []
+    num_lines = 0
+    start = last_report = time.time()
+    with open(mapTaxafile, 'w') as fhout:
+        # chunks come back in input order, so the output follows the map
+        for text, tax_count, rank_count, missing, n in results:
+            fhout.write(text)
+            tax_counts.append(tax_count)
+            rank_counts.append(rank_count)
+            for taxid in missing:
                 sys.stderr.write("WARNING: Taxid {} missing from db\n".format(taxid))
-                continue
-            
-            ranks = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
-            names = {}
-            for rank in ranks:
-                names[rank] = "unclassified"
-            
-            lineage =  ncbitaxa.get_rank(ncbitaxa.get_lineage(taxid))
-            for id, rank in lineage.items():
-                if rank not in ranks:
-                    continue
-                name = ncbitaxa.translate_to_names([id])[0]
-                if rank == "superkingdom": names[rank] = "k__" + name
-                if rank == "phylum": names[rank] = "p__" + name
-                if rank == "class": names[rank] = "c__" + name
-                if rank == "order": names[rank] = "o__" + name
-                if rank == "family": names[rank] = "f__" + name
-                if rank == "genus": names[rank] = "g__" + name
-                if rank == "species": names[rank] = "s__" + name
-            
-            if summary_rank not in names.keys():
-                rank_name = "Unknown"
-            else:
-                rank_name = names[summary_rank]
-            
-            kingdom = names["superkingdom"]
-            
-            if not kingdom in summary1:
-                summary1[kingdom] = {taxid: 0}
-            else:
-                if not taxid in summary1[kingdom]:
-                    summary1[kingdom][taxid] = 0
-            
-            if not kingdom in summary2:
-                summary2[kingdom] = {rank_name: 0}
-            else:
-                if not rank_name in summary2[kingdom]:
-                    summary2[kingdom][rank_name] = 0
-            
-            summary1[kingdom][taxid] += 1
-            summary2[kingdom][rank_name] += 1
-            
-            name_string = ""
-            for rank in ranks:
-                if rank == "species": name_string+="{}".format(names[rank])
-                else: name_string+="{}\t".format(names[rank])
-            
-            fhout.write("{}\t{}\t{}\t{}\n".format(seqid, taxid, seq_name, name_string))
-            
-    fhout.close()
-    
-    return summary1,summary2
+            num_lines += n
+            if time.time() - last_report >= report_seconds:
+                last_report = time.time()
+                sys.stderr.write("Read {} lines ({:.0f} lines/s)...\n".format(
+                    num_lines, num_lines / (last_report - start)))
+    if threads > 1:
+        pool.close()
+        pool.join()
+    sys.stderr.write("Read {} lines in {:.0f}s\n".format(num_lines, time.time() - start))
+
+    # per kingdom: sequences of each taxid and of each rank name
+    summary1, summary2 = {}, {}
+    if tax_counts:
+        for (kingdom, taxid), n in pd.concat(tax_counts).groupby(level=[0, 1]).sum().items():
+            summary1.setdefault(kingdom, {})[taxid] = n
+        for (kingdom, rank_name), n in pd.concat(rank_counts).groupby(level=[0, 1]).sum().items():
+            summary2.setdefault(kingdom, {})[rank_name] = n
+    return summary1, summary2
 
 def main():
     parser = ArgumentParser()
@@ -87,11 +112,16 @@ def main():
                         help="Summarize sequences and sizes at this rank (default = species)")
     parser.add_argument("--mapTaxafile", default="seqid2taxa.map",
                         help="Add taxa info into seqid2taxidmap file (default = seqid2taxa.map)")
-    parser.add_argument("--taxdbfile", required=True,
-                        help="Ete3 sqlite database file.")
+    parser.add_argument("--taxtable", required=True,
+                        help="Compiled taxonomy table of the ete3 sqlite database (see scripts/taxtable.py).")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of summarizing processes (default = 1)")
+    parser.add_argument("--chunksize", type=int, default=200000,
+                        help="Number of map lines summarized at a time (default = 200000)")
                         
     args = parser.parse_args()
-    summary_tax, summary_rank = summarize_to_ranks(args.seqid2taxidmap, args.rank, args.mapTaxafile, args.taxdbfile)
+    summary_tax, summary_rank = summarize_to_ranks(args.seqid2taxidmap, args.rank, args.mapTaxafile,
+                                                   args.taxtable, args.threads, args.chunksize)
 
     print("{}\t{}\t{}".format("Superkingdom","Taxa number", "Sequence numer"))
     for kingdom in sorted(summary_tax.keys()):
@@ -103,4 +133,4 @@ def main():
     
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
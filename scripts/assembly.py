@@ -3,64 +3,193 @@
 from argparse import ArgumentParser
 import subprocess
 from subprocess import check_output
+import shutil
+import signal
+import time
 import os
 import sys
 
+# job sizing for the scheduler: one thread per this many reads and
+# 1 GB of memory plus 1 GB per this many reads, bounded by the budget
+READS_PER_THREAD = 20000
+READS_PER_GB = 250000
+
 def get_hit_fq(fastqInput,readIDFile,fastqOutput):
     cmd = "seqtk subseq " + fastqInput + " " + readIDFile + ">" + fastqOutput
     try:
         seqtk_out = check_output(cmd,shell=True)
     except subprocess.CalledProcessError as e:
         print(e.output)
-    
+
     return fastqOutput;
 
-def do_assembly(args):
-    fastq = get_hit_fq(args.fastqInput, args.readIDFile, args.fastqOutput)
-    if args.spades:
+def assembly_cmd(fastq, outdir, threads, spades, memory=None):
+    """Return the assembler command line and the name of its contigs file"""
+    if spades:
         # In metagenemomics dataset, generally assigned reads are with high GC, low or uneven coverage
-        # spades assembly contigs are in "scaffolds.fasta" 
-        cmd = "spades.py -t " + str(args.threads) + " --iontorrent --sc -s " + fastq + " --careful -k 21,33,55 -o " + args.outdir
-        try:
-            spades_out = check_output(cmd,shell=True)
-        except subprocess.CalledProcessError as e:
-            print(e.returncode)
-            open(args.outdir + "/scaffolds.fasta", 'a').close()
-        os.rename(args.outdir + "/scaffolds.fasta", args.outdir + "/contigs.fa")
-    
+        # spades assembly contigs are in "scaffolds.fasta"
+        cmd = "spades.py -t " + str(threads) + " --iontorrent --sc -s " + fastq + " --careful -k 21,33,55 -o " + outdir
+        if memory: cmd += " -m " + str(memory)
+        return cmd, "scaffolds.fasta"
     else:
         # use megahit, and assembly contigs are in "final.contigs.fa"
-        cmd = "megahit -t " + str(args.threads) + " -r " + fastq + " -o " + args.outdir
-        try:
-            megahit_out = check_output(cmd,shell=True);
-        except subprocess.CalledProcessError as e:
-            print(e.returncode)
-            open(args.outdir + "/final.contigs.fa", 'a').close()
-        os.rename(args.outdir + "/final.contigs.fa", args.outdir + "/contigs.fa")
+        cmd = "megahit -t " + str(threads) + " -r " + fastq + " -o " + outdir
+        if memory: cmd += " -m " + str(memory * 1000000000)
+        return cmd, "final.contigs.fa"
+
+def collect_contigs(outdir, contigs, target):
+    """Move the assembler contigs to target, an empty file if the assembly failed"""
+    os.makedirs(outdir, exist_ok=True)
+    if not os.path.exists(outdir + "/" + contigs):
+        open(outdir + "/" + contigs, 'a').close()
+    os.rename(outdir + "/" + contigs, target)
+
+def do_assembly(args):
+    if args.readIDFile:
+        fastq = get_hit_fq(args.fastqInput, args.readIDFile, args.fastqOutput)
+    else:
+        # input reads are already those of the target taxa
+        fastq = args.fastqInput
+    cmd, contigs = assembly_cmd(fastq, args.outdir, args.threads, args.spades)
+    try:
+        assembly_out = check_output(cmd,shell=True)
+    except subprocess.CalledProcessError as e:
+        print(e.returncode)
+    collect_contigs(args.outdir, contigs, args.outdir + "/contigs.fa")
+
+def count_reads(fastq):
+    with open(fastq) as fh:
+        return sum(1 for line in fh) // 4
+
+def plan_assemblies(taxidHitFolder, outdir, threads, memory, min_reads=3):
+    """
+    One job per taxon with read ids from the current run ({taxid}.txt) and at
+    least min_reads reads in {taxid}.fq, largest first; the .fq files of
+    taxa of an earlier run are left out
+    """
+    jobs = []
+    for file in os.listdir(taxidHitFolder):
+        if not file.endswith(".txt"):
+            continue
+        taxid = file.replace(".txt","")
+        fastq = taxidHitFolder + "/" + taxid + ".fq"
+        if not os.path.exists(fastq): continue
+        reads = count_reads(fastq)
+        if reads < min_reads: continue
+        jobs.append({"taxid": taxid,
+                     "fastq": fastq,
+                     "reads": reads,
+                     "outdir": outdir + "/" + taxid,
+                     "threads": max(1, min(threads, -(-reads // READS_PER_THREAD))),
+                     "memory": max(1, min(memory, 1 + reads // READS_PER_GB))})
+    return sorted(jobs, key=lambda job: -job["reads"])
+
+def is_done(job):
+    """A job is done if it succeeded on the same reads it would assemble now"""
+    done = job["outdir"] + "/.done"
+    if not os.path.exists(done) or os.path.getmtime(done) < os.path.getmtime(job["fastq"]):
+        return False
+    with open(done) as fh:
+        return fh.read().strip() == str(job["reads"])
+
+def schedule_assemblies(jobs, threads, memory, spades, timeout=None, poll=1):
+    """
+    Run the assembly jobs concurrently within a global thread and memory
+    budget. The largest job that fits is started first and smaller jobs
+    fill the remaining threads. Jobs running longer than timeout seconds
+    are killed. Each finished job leaves {taxid}.contigs.fa in its
+    directory, plus a .done marker if the assembler succeeded.
+    """
+    pending = list(jobs)
+    running = []
+    free_threads, free_memory = threads, memory
+    while pending or running:
+        for job in list(pending):
+            if job["threads"] > free_threads or job["memory"] > free_memory:
+                continue
+            # megahit refuses to write into an existing directory
+            if os.path.exists(job["outdir"]): shutil.rmtree(job["outdir"])
+            cmd, job["contigs"] = assembly_cmd(job["fastq"], job["outdir"], job["threads"], spades, job["memory"])
+            job["log"] = open(job["outdir"] + ".log", "w")
+            # in its own process group, so a timeout kills the assembler and not only the shell
+            job["proc"] = subprocess.Popen(cmd, shell=True, stdout=job["log"], stderr=subprocess.STDOUT,
+                                           start_new_session=True)
+            job["start"] = time.time()
+            free_threads -= job["threads"]
+            free_memory -= job["memory"]
+            pending.remove(job)
+            running.append(job)
+        time.sleep(poll)
+        for job in list(running):
+            returncode = job["proc"].poll()
+            elapsed = time.time() - job["start"]
+            if returncode is None and timeout and elapsed > timeout:
+                os.killpg(job["proc"].pid, signal.SIGKILL)
+                returncode = job["proc"].wait()
+                job["status"] = "timeout"
+            elif returncode is None:
+                continue
+            else:
+                job["status"] = "ok" if returncode == 0 else "failed"
+            job["log"].close()
+            job["seconds"] = int(elapsed)
+            collect_contigs(job["outdir"], job["contigs"], job["outdir"] + "/" + job["taxid"] + ".contigs.fa")
+            if job["status"] == "ok":
+                with open(job["outdir"] + "/.done", 'w') as fh:
+                    fh.write("{}\n".format(job["reads"]))
+            sys.stderr.write("Assembly of taxid {} ({} reads, {} threads, {} GB): {} in {}s\n".format(
+                job["taxid"], job["reads"], job["threads"], job["memory"], job["status"], job["seconds"]))
+            free_threads += job["threads"]
+            free_memory += job["memory"]
+            running.remove(job)
+    return jobs
+
+def run_scheduler(args):
+    os.makedirs(args.outdir, exist_ok=True)
+    jobs = plan_assemblies(args.taxidHitFolder, args.outdir, args.threads, args.memory)
+    todo = [job for job in jobs if not (args.resume and is_done(job))]
+    sys.stderr.write("Doing assembly for {} target taxa ({} already done) with {} threads and {} GB.\n".format(
+        len(todo), len(jobs) - len(todo), args.threads, args.memory))
+    schedule_assemblies(todo, args.threads, args.memory, args.spades, args.timeout)
+    with open(args.outdir + "/assembly.jobs.tsv", "w") as fhout:
+        fhout.write("taxid\treads\tthreads\tmemory\tstatus\tseconds\n")
+        for job in jobs:
+            fhout.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(job["taxid"], job["reads"], job["threads"],
+                        job["memory"], job.get("status", "done"), job.get("seconds", 0)))
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument("-i", "--fastqInput", type=str, required=True,
+    parser.add_argument("-i", "--fastqInput", type=str,
                         help="FastqInput for reads extracting.")
     parser.add_argument("-o", "--fastqOutput", type=str,
                         help="Extracted hit reads.")
     parser.add_argument("--readIDFile", type=str,
-                        help="Read ids hitting to one specific taxa.")
+                        help="Read ids hitting to one specific taxa. If not given, all input reads are assembled.")
+    parser.add_argument("--taxidHitFolder", type=str,
+                        help="Assemble every {taxid}.fq in this filefolder concurrently instead of a single input.")
     parser.add_argument("--spades", action="store_true",
                         help="Use SPAdes to assembly hit reads.")
     parser.add_argument("--outdir", type=str,
                         help="Assembly output directory.")
     parser.add_argument("--threads", type=int,
-                        help="Number of CPU threads.")
-    #parser.add_argument("--taxidHitFolder", type=str,
-    #                    help="A filefoler to put readIDs for each taxid hit.")
+                        help="Number of CPU threads, shared by all assemblies with --taxidHitFolder.")
+    parser.add_argument("--memory", type=int, default=16,
+                        help="Memory budget in GB shared by all assemblies with --taxidHitFolder (default = 16)")
+    parser.add_argument("--timeout", type=int,
+                        help="Kill an assembly running longer than this many seconds.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Only assemble taxa without a finished assembly in the output directory.")
 
     args = parser.parse_args()
 
-    sys.stderr.write("Doing assembly for each target taxa.\n")
-    
-    do_assembly(args)
+    if args.taxidHitFolder:
+        run_scheduler(args)
+    elif args.fastqInput:
+        sys.stderr.write("Doing assembly for each target taxa.\n")
+        do_assembly(args)
+    else:
+        parser.error("one of --fastqInput or --taxidHitFolder is required")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
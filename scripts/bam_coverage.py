@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""
+Per-reference and per-taxon mapping statistics from one pass over a
+coordinate-sorted BAM file, read --chunksize alignments at a time:
+mapped reads at each MAPQ cutoff and, for the reads passing --min_mapQ,
+mean MAPQ, breadth (covered bp), mean depth, and the number of
+non-overlapping mapped regions. A binned depth profile of each strand is
+written for the coverage plots of the report. Only the statistics of the
+reference being read are kept, so memory does not grow with the number of
+mapped reads.
+"""
+
+from argparse import ArgumentParser
+from intervals import covered_length
+from stagetimer import StageTimer
+import subprocess
+import pandas as pd
+import numpy as np
+import sys
+import os
+
+# CIGAR operations consuming the reference, the subset counted in the depth
+# (as in a pileup with deletions) and those making up the query width
+REF_OPS = "MDN=X"
+DEPTH_OPS = "MD=X"
+QUERY_OPS = "MIS=X"
+
+COLUMNS = ["seqID", "genome_size", "avg_depth", "covered_bp", "perc_covered", "avg_mapq", "num_regions"]
+
+def read_lengths(bam):
+    """Reference lengths from the BAM header"""
+    lengths = {}
+    out = subprocess.check_output("samtools view -H {}".format(bam), shell=True).decode("utf-8")
+    for line in out.splitlines():
+        if line.startswith("@SQ"):
+            fields = dict(f.split(":", 1) for f in line.split("\t")[1:])
+            lengths[fields["SN"]] = int(fields["LN"])
+    return lengths
+
+def cigar_lengths(cigars, ops):
+    """Total length of the given CIGAR operations of each alignment"""
+    parts = cigars.str.extractall(r"(\d+)([MIDNSHP=X])")
+    parts = parts.loc[parts[1].isin(list(ops))]
+    sums = parts[0].astype(np.int64).groupby(level=0).sum()
+    return sums.reindex(cigars.index, fill_value=0).values
+
+def read_alignments(bam, chunksize):
+    """Mapped alignments of a BAM file, chunksize at a time, as DataFrames of rname, pos, end, depth, qwidth, reverse, mapq"""
+    # pipefail, so that a samtools failure is not hidden behind the status of cut
+    cmd = "set -o pipefail; samtools view -F 4 {} | cut -f 2-6".format(bam)
+    proc = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE)
+    reader = pd.read_csv(proc.stdout, sep="\t", header=None, names=["flag", "rname", "pos", "mapq", "cigar"],
+                         dtype={"rname": str, "cigar": str}, chunksize=chunksize)
+    for df in reader:
+        df = df.loc[df.cigar != "*"].reset_index(drop=True)
+        span = cigar_lengths(df.cigar, REF_OPS)
+        yield pd.DataFrame({"rname": df.rname.values,
+                            # 0-based, half-open reference interval
+                            "pos": df.pos.values - 1,
+                            "end": df.pos.values - 1 + span,
+                            "depth": cigar_lengths(df.cigar, DEPTH_OPS),
+                            "qwidth": cigar_lengths(df.cigar, QUERY_OPS),
+                            "reverse": (df.flag.values & 16) > 0,
+                            "mapq": df.mapq.values})
+    proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def count_regions(keys, starts, ends):
+    """
+    Number of non-overlapping mapped regions per group, and the end of the
+    last one: reads are taken in order of position and a read is a new region
+    if it starts after the end of the last region taken, as the report used
+    to count them
+    """
+    ngroups = keys.max() + 1 if len(keys) else 0
+    counts = np.zeros(ngroups, dtype=np.int64)
+    last = np.full(ngroups, -1, dtype=np.int64)
+    if len(keys) == 0:
+        return counts, last
+    order = np.lexsort((starts, keys))
+    keys, starts, ends = keys[order], starts[order], ends[order]
+    # next read starting after the end of each read, within its group
+    block = np.int64(starts.max() + ends.max() + 1)
+    coords = keys * block + starts
+    nxt = np.searchsorted(coords, keys * block + ends, side="right").tolist()
+    bounds = np.searchsorted(keys, np.arange(ngroups + 1)).tolist()
+    for g in range(ngroups):
+        i = bounds[g]
+        while i < bounds[g+1]:
+            counts[g] += 1
+            last[g] = ends[i]
+            i = nxt[i]
+    return counts, last
+
+def depth_integral(starts, ends, bounds):
+    """Aligned bases of the reads left of each bound: sum over reads of min(x, end) - start, for reads starting before x"""
+    starts, ends = np.sort(starts), np.sort(ends)
+    ns = np.searchsorted(starts, bounds, side="left")
+    ne = np.searchsorted(ends, bounds, side="left")
+    cs = np.append(0, np.cumsum(starts))
+    ce = np.append(0, np.cumsum(ends))
+    return ns * bounds - cs[ns] - (ne * bounds - ce[ne])
+
+class ReferenceCoverage(object):
+    """
+    Running statistics of the alignments on one reference, added chunk by
+    chunk in order of position. Only the end of the coverage and of the last
+    region so far are carried from one chunk to the next, and the depth
+    profile as the aligned bases left of each bin bound.
+    """
+
+    def __init__(self, name, length, ncutoffs, max_bins):
+        self.name, self.length = name, length
+        self.reads = np.zeros(ncutoffs, dtype=np.int64)
+        self.aligned = 0
+        self.depth_bp = 0
+        self.mapq = 0
+        self.covered_bp = 0
+        self.reach = 0
+        self.regions = 0
+        self.region_end = -1
+        # start of the last alignment added, to check the order of the next chunk
+        self.last_pos = 0
+        width = max(1, -(-length // max_bins))
+        self.bounds = np.append(np.arange(0, length, width), length).astype(np.int64)
+        self.integral = np.zeros((2, len(self.bounds)), dtype=np.int64)
+
+    def stats(self):
+        return (self.name, self.length, self.depth_bp / self.length, self.covered_bp,
+                100 * self.covered_bp / self.length, self.mapq / self.aligned, self.regions)
+
+    def profile(self):
+        """Mean depth in up to max_bins bins of each strand"""
+        profile = []
+        for reverse in (0, 1):
+            depth = np.diff(self.integral[reverse]) / np.diff(self.bounds)
+            keep = depth > 0
+            if not keep.any():
+                continue
+            profile.append(pd.DataFrame({"seqnames": self.name, "pos": self.bounds[:-1][keep] + 1,
+                                         "strand": "-" if reverse else "+", "count": np.round(depth[keep], 2)},
+                                        columns=["seqnames", "pos", "strand", "count"]))
+        return profile
+
+def add_chunk(refs, aln, min_mapq, cutoffs):
+    """Add a chunk of alignments to the ReferenceCoverage of their references, refs in order of factorized rname"""
+    codes = pd.factorize(aln.rname)[0]
+    n = len(refs)
+    for i, c in enumerate(cutoffs):
+        for ref, count in zip(refs, np.bincount(codes[aln.mapq.values >= c], minlength=n)):
+            ref.reads[i] += count
+
+    keep = aln.mapq.values >= min_mapq
+    codes, aln = codes[keep], aln.loc[keep]
+    pos, end = aln.pos.values, aln.end.values
+    reach = np.array([ref.reach for ref in refs], dtype=np.int64)
+    region_end = np.array([ref.region_end for ref in refs], dtype=np.int64)
+    # the starts of a reference only grow, so what a chunk adds to its
+    # coverage lies beyond the end of the coverage so far
+    covered_bp = covered_length(codes, np.maximum(pos, reach[codes]), end)
+    np.maximum.at(reach, codes, end)
+    region_ends = pos + aln.qwidth.values - 1
+    new = pos > region_end[codes]
+    regions, last = count_regions(codes[new], pos[new], region_ends[new])
+    aligned = np.bincount(codes, minlength=n)
+    depth_bp = np.bincount(codes, weights=aln.depth.values, minlength=n)
+    mapq = np.bincount(codes, weights=aln.mapq.values, minlength=n)
+    for k, ref in enumerate(refs):
+        ref.aligned += aligned[k]
+        ref.depth_bp += int(depth_bp[k])
+        ref.mapq += int(mapq[k])
+        ref.reach = reach[k]
+        if k < len(covered_bp):
+            ref.covered_bp += covered_bp[k]
+        if k < len(regions) and regions[k]:
+            ref.regions += regions[k]
+            ref.region_end = last[k]
+
+    groups = pd.Series(np.arange(len(codes))).groupby([codes, aln.reverse.values]).indices
+    for (code, reverse), sel in groups.items():
+        ref = refs[code]
+        ref.integral[int(reverse)] += depth_integral(pos[sel], end[sel], ref.bounds)
+
+def bam_coverage(bam, taxfile, min_mapq, cutoffs, max_bins, chunksize):
+    """Statistics of each reference, finished once the alignments of the next reference start"""
+    lengths = read_lengths(bam)
+    stats, profile, done = [], [], set()
+    current, total = None, 0
+
+    def flush(ref):
+        done.add(ref.name)
+        # references with reads below min_mapQ only are left out
+        if ref.aligned:
+            stats.append(ref.stats() + tuple(ref.reads))
+            profile.extend(ref.profile())
+
+    for aln in read_alignments(bam, chunksize):
+        if not len(aln):
+            continue
+        total += len(aln)
+        codes, names = pd.factorize(aln.rname)
+        unsorted = (np.diff(codes) < 0) | ((np.diff(codes) == 0) & (np.diff(aln.pos.values) < 0))
+        if unsorted.any() or done.intersection(names) or \
+                (current is not None and names[0] == current.name and aln.pos.values[0] < current.last_pos):
+            raise SystemExit("{} is not sorted by coordinate, sort it with samtools sort".format(bam))
+        if current is not None and names[0] != current.name:
+            flush(current)
+            current = None
+        refs = []
+        for name in names:
+            if current is None or name != current.name:
+                current = ReferenceCoverage(name, lengths[name], len(cutoffs), max_bins)
+            refs.append(current)
+        add_chunk(refs, aln, min_mapq, cutoffs)
+        # all but the last reference of the chunk are done
+        for ref in refs[:-1]:
+            flush(ref)
+        current.last_pos = aln.pos.values[-1]
+    if current is not None:
+        flush(current)
+    sys.stderr.write("Read {} mapped alignments on {} references from {}\n".format(total, len(lengths), bam))
+
+    stats = pd.DataFrame(stats, columns=COLUMNS + ["mapq{}_reads".format(c) for c in cutoffs]).sort_values("seqID")
+    profile = pd.concat(profile, ignore_index=True) if profile else \
+        pd.DataFrame(columns=["seqnames", "pos", "strand", "count"])
+
+    taxa = taxon_coverage(stats, taxfile, cutoffs)
+    return stats, taxa, profile
+
+def taxon_coverage(stats, taxfile, cutoffs):
+    """Sum the per-reference statistics over the references of each taxon"""
+    id2tax = pd.read_csv(taxfile, sep="\t", dtype={"seq": str}).drop_duplicates("seq")
+    df = stats.merge(id2tax[["seq", "taxID"]], left_on="seqID", right_on="seq")
+    df = df.assign(depth_bp=df.avg_depth * df.genome_size)
+    agg = {"genome_size": "sum", "covered_bp": "sum", "depth_bp": "sum", "num_regions": "sum"}
+    agg.update({"mapq{}_reads".format(c): "sum" for c in cutoffs})
+    taxa = df.groupby("taxID").agg(agg)
+    taxa = taxa.assign(avg_depth=taxa.depth_bp / taxa.genome_size,
+                       perc_covered=100 * taxa.covered_bp / taxa.genome_size).drop("depth_bp", axis=1)
+    return taxa.reset_index()
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--bam", type=str, required=True,
+                        help="Coordinate-sorted BAM file.")
+    parser.add_argument("--taxfile", type=str, required=True,
+                        help="Table of the mapped genomes with seq and taxID columns.")
+    parser.add_argument("--min_mapQ", type=int, default=0,
+                        help="Minimum mapping quality of the reads used for depth, breadth and regions (default = 0)")
+    parser.add_argument("--mapq_cutoffs", type=str, default="0,1,10,20,30",
+                        help="Comma-separated MAPQ cutoffs at which mapped reads are counted (default = 0,1,10,20,30)")
+    parser.add_argument("--max_bins", type=int, default=2000,
+                        help="Maximum number of bins of the depth profile of each reference (default = 2000)")
+    parser.add_argument("--chunksize", type=int, default=1000000,
+                        help="Number of alignments read at a time (default = 1000000)")
+    parser.add_argument("--out", type=str, required=True,
+                        help="Output per-reference table.")
+    parser.add_argument("--out_taxa", type=str, required=True,
+                        help="Output per-taxon table.")
+    parser.add_argument("--out_profile", type=str, required=True,
+                        help="Output binned depth profile.")
+    parser.add_argument("--timings", type=str,
+                        help="Write the wall time and peak memory of each stage to this table.")
+    args = parser.parse_args()
+
+    timer = StageTimer("bam_coverage", args.timings)
+    cutoffs = [int(c) for c in args.mapq_cutoffs.split(",")]
+    if os.path.getsize(args.bam) == 0:
+        # no genomes were mapped
+        stats = pd.DataFrame(columns=COLUMNS + ["mapq{}_reads".format(c) for c in cutoffs])
+        taxa = pd.DataFrame(columns=["taxID", "genome_size", "covered_bp", "num_regions"] +
+                            ["mapq{}_reads".format(c) for c in cutoffs] + ["avg_depth", "perc_covered"])
+        profile = pd.DataFrame(columns=["seqnames", "pos", "strand", "count"])
+    else:
+        with timer.stage("coverage"):
+            stats, taxa, profile = bam_coverage(args.bam, args.taxfile, args.min_mapQ, cutoffs,
+                                                args.max_bins, args.chunksize)
+    with timer.stage("write"):
+        stats.to_csv(args.out, sep="\t", index=False)
+        taxa.to_csv(args.out_taxa, sep="\t", index=False)
+        profile.to_csv(args.out_profile, sep="\t", index=False)
+    timer.save()
+
+if __name__ == '__main__':
+    main()
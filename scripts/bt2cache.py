@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""
+Shared, content-addressed cache of bowtie2 indexes of filtered genome panels.
+
+An index is keyed by the sha1 of the sorted sequence ids of the panel and
+the bowtie2-build version, so a panel seen in an earlier sample or run is
+linked instead of rebuilt. The cache directory holds:
+    {key}/             published index (index.*.bt2l), never modified
+    {key}/refs/        one file per linked prefix, the reference count
+    {key}/last_used    touched on every use, for LRU eviction
+    locks/             per-key build locks
+    cache.log.tsv      hit/miss log
+
+Entries are built in a temporary directory and published with an atomic
+rename. Entries whose refs all point to removed links are evicted, least
+recently used first, while the cache is over its disk quota.
+"""
+
+from argparse import ArgumentParser
+from subprocess import check_output
+import subprocess
+import hashlib
+import shutil
+import fcntl
+import time
+import sys
+import os
+
+INDEX_SUFFIXES = ["1.bt2l", "2.bt2l", "3.bt2l", "4.bt2l", "rev.1.bt2l", "rev.2.bt2l"]
+
+def fasta_seqids(fasta):
+    seqids = set()
+    with open(fasta) as fh:
+        for line in fh:
+            if line.startswith(">"):
+                seqids.add(line[1:].split(None, 1)[0])
+    return sorted(seqids)
+
+def bowtie2_version():
+    out = check_output("bowtie2-build --version", shell=True).decode("utf-8")
+    return out.splitlines()[0].strip()
+
+def cache_key(seqids, version):
+    h = hashlib.sha1()
+    h.update(version.encode("utf-8"))
+    for seqid in seqids:
+        h.update(b"\n" + seqid.encode("utf-8"))
+    return h.hexdigest()
+
+class locked(object):
+    """Exclusive (or shared) flock on a lock file, as a context manager"""
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+
+    def __enter__(self):
+        self.fh = open(self.path, "a")
+        fcntl.flock(self.fh, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fh, fcntl.LOCK_UN)
+        self.fh.close()
+
+class IndexCache(object):
+    def __init__(self, path, quota_gb=None):
+        self.path = path
+        self.quota = quota_gb * 1e9 if quota_gb else None
+        os.makedirs(os.path.join(path, "locks"), exist_ok=True)
+
+    def entry(self, key):
+        return os.path.join(self.path, key)
+
+    def global_lock(self):
+        return locked(os.path.join(self.path, "locks", "cache.lock"))
+
+    def log(self, key, status, nseqs, prefix, seconds):
+        with open(os.path.join(self.path, "cache.log.tsv"), "a") as fh:
+            fh.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"),
+                     key, status, nseqs, prefix, seconds))
+
+    def add_ref(self, key, prefix):
+        """Register prefix as a user of the entry and mark it as recently used"""
+        entry = self.entry(key)
+        ref = hashlib.sha1(os.path.abspath(prefix).encode("utf-8")).hexdigest()
+        with open(os.path.join(entry, "refs", ref), "w") as fh:
+            fh.write(os.path.abspath(prefix) + "\n")
+        with open(os.path.join(entry, "last_used"), "w") as fh:
+            fh.write("{}\n".format(time.time()))
+
+    def live_refs(self, key):
+        """Number of prefixes whose index links still point into the entry"""
+        entry = self.entry(key)
+        n = 0
+        for ref in os.listdir(os.path.join(entry, "refs")):
+            with open(os.path.join(entry, "refs", ref)) as fh:
+                link = fh.readline().strip() + "." + INDEX_SUFFIXES[0]
+            if os.path.realpath(link) == os.path.realpath(os.path.join(entry, "index." + INDEX_SUFFIXES[0])):
+                n += 1
+            else:
+                os.remove(os.path.join(entry, "refs", ref))
+        return n
+
+    def entries(self):
+        """(last used, size in bytes, key) of each published entry"""
+        out = []
+        for key in os.listdir(self.path):
+            entry = self.entry(key)
+            if key.startswith(".") or not os.path.exists(os.path.join(entry, "last_used")):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)
+                       if os.path.isfile(os.path.join(entry, f)))
+            out.append((os.path.getmtime(os.path.join(entry, "last_used")), size, key))
+        return sorted(out)
+
+    def evict(self):
+        """Remove unreferenced entries, least recently used first, until the cache fits the quota"""
+        if not self.quota:
+            return
+        entries = self.entries()
+        total = sum(size for last_used, size, key in entries)
+        for last_used, size, key in entries:
+            if total <= self.quota:
+                break
+            if self.live_refs(key) == 0:
+                shutil.rmtree(self.entry(key))
+                total -= size
+                sys.stderr.write("Evicted bowtie2 index {} ({} bytes) from the cache\n".format(key, size))
+
+    def link(self, key, prefix):
+        os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+        for suffix in INDEX_SUFFIXES:
+            target = os.path.join(self.entry(key), "index." + suffix)
+            link = prefix + "." + suffix
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(os.path.abspath(target), link)
+
+    def acquire(self, fasta, prefix, threads=1):
+        """Link the bowtie2 index of fasta to prefix, building and publishing it on a miss"""
+        seqids = fasta_seqids(fasta)
+        key = cache_key(seqids, bowtie2_version())
+        start = time.time()
+        status = None
+        # the per-key lock makes concurrent jobs with the same panel wait for one build,
+        # the global lock keeps eviction away from an entry between lookup and linking
+        with locked(os.path.join(self.path, "locks", key + ".lock")):
+            with self.global_lock():
+                if os.path.exists(self.entry(key)):
+                    self.add_ref(key, prefix)
+                    self.link(key, prefix)
+                    status = "hit"
+            if status != "hit":
+                status = "miss"
+                tmpdir = os.path.join(self.path, ".tmp.{}.{}".format(key, os.getpid()))
+                if os.path.exists(tmpdir):
+                    shutil.rmtree(tmpdir)
+                os.makedirs(os.path.join(tmpdir, "refs"))
+                cmd = "bowtie2-build --large-index --threads {} {} {}".format(
+                    threads, fasta, os.path.join(tmpdir, "index"))
+                try:
+                    check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError as e:
+                    shutil.rmtree(tmpdir)
+                    sys.stderr.write(e.output.decode("utf-8"))
+                    raise
+                open(os.path.join(tmpdir, "last_used"), "w").close()
+                with self.global_lock():
+                    os.rename(tmpdir, self.entry(key))
+                    self.add_ref(key, prefix)
+                    self.link(key, prefix)
+            seconds = int(time.time() - start)
+            with self.global_lock():
+                self.log(key, status, len(seqids), prefix, seconds)
+                self.evict()
+        sys.stderr.write("bowtie2 index cache {} for {} sequences ({}): {}s\n".format(
+            status, len(seqids), key, seconds))
+        return key, status
+
+    def stats(self):
+        hits = misses = 0
+        log = os.path.join(self.path, "cache.log.tsv")
+        if os.path.exists(log):
+            with open(log) as fh:
+                for line in fh:
+                    status = line.split("\t")[2]
+                    hits += status == "hit"
+                    misses += status == "miss"
+        entries = self.entries()
+        return {"entries": len(entries), "bytes": sum(size for last_used, size, key in entries),
+                "hits": hits, "misses": misses}
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--cache", type=str, required=True,
+                        help="Shared bowtie2 index cache directory.")
+    parser.add_argument("--quota", type=float,
+                        help="Disk quota of the cache in GB, unreferenced indexes are evicted above it.")
+    parser.add_argument("--fasta", type=str,
+                        help="Genomes to index.")
+    parser.add_argument("--prefix", type=str,
+                        help="Index prefix to link the cached index to.")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of threads for bowtie2-build (default = 1)")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print the hits, misses and size of the cache.")
+    args = parser.parse_args()
+
+    cache = IndexCache(args.cache, args.quota)
+    if args.stats:
+        stats = cache.stats()
+        print("entries\tbytes\thits\tmisses")
+        print("{}\t{}\t{}\t{}".format(stats["entries"], stats["bytes"], stats["hits"], stats["misses"]))
+    elif args.fasta and args.prefix:
+        cache.acquire(args.fasta, args.prefix, args.threads)
+    else:
+        parser.error("--fasta and --prefix, or --stats, are required")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+
+"""
+Classification of several samples in one centrifuge run, so the index is
+loaded once per batch instead of once per sample.
+
+    tag    write the reads of the samples of a batch as one FASTQ stream,
+           with the index of the sample in the batch prefixed to each read
+           id ("3:READID" for the fourth sample)
+    split  demultiplex the centrifuge output of the batch into the output
+           and report of each sample, with the original read ids
+
+The per-sample report takes names, ranks and genome sizes from the batch
+report. Read counts are recounted from the sample's own assignments, and
+the abundance is re-estimated from them by expectation-maximization over
+the taxa each read is assigned to, normalized by genome size.
+"""
+
+from argparse import ArgumentParser
+import pandas as pd
+import numpy as np
+import gzip
+import sys
+import os
+
+REPORT_COLUMNS = ["name", "taxID", "taxRank", "genomeSize", "numReads", "numUniqueReads", "abundance"]
+
+def open_reads(fp):
+    if fp.endswith(".gz"):
+        return gzip.open(fp, "rb")
+    return open(fp, "rb")
+
+def tag_reads(read_files, out):
+    """Write the FASTQ records of read_files to out with read ids prefixed by the index of their file"""
+    for i, fp in enumerate(read_files):
+        tag = "@{}:".format(i).encode("utf-8")
+        with open_reads(fp) as fh:
+            for n, line in enumerate(fh):
+                out.write(tag + line[1:] if n % 4 == 0 else line)
+
+class SampleCounts(object):
+    """Read counts of the taxa of a sample and the sets of taxa its reads are assigned to"""
+    def __init__(self):
+        self.reads = {}
+        self.unique = {}
+        self.classes = {}
+
+    def update(self, df):
+        df = df.loc[df.taxID != 0]
+        for counts, rows in ((self.reads, df), (self.unique, df.loc[df.numMatches == 1])):
+            for taxid, n in rows.taxID.value_counts().items():
+                counts[taxid] = counts.get(taxid, 0) + n
+        # reads with a single assignment form a class of their own taxon
+        single = df.loc[df.numMatches == 1].taxID.value_counts()
+        for taxid, n in single.items():
+            self.classes[(taxid,)] = self.classes.get((taxid,), 0) + n
+        multi = df.loc[df.numMatches > 1]
+        if len(multi):
+            sets = multi.groupby("readID", sort=False).taxID.agg(lambda t: tuple(sorted(set(t))))
+            for taxa, n in sets.value_counts().items():
+                self.classes[taxa] = self.classes.get(taxa, 0) + n
+
+def estimate_abundance(classes, genome_size, iterations=1000, tol=1e-10):
+    """
+    Abundance of each taxon from the counts of reads assigned to each set of
+    taxa: EM of the fraction of reads from each taxon, divided by genome size
+    """
+    taxa = sorted(set(t for c in classes for t in c))
+    if not taxa:
+        return {}
+    index = {t: i for i, t in enumerate(taxa)}
+    single = np.zeros(len(taxa))
+    multi = []
+    for c, n in classes.items():
+        if len(c) == 1:
+            single[index[c[0]]] += n
+        else:
+            multi.append((np.array([index[t] for t in c]), n))
+    theta = np.full(len(taxa), 1.0 / len(taxa))
+    for _ in range(iterations):
+        new = single.copy()
+        for ix, n in multi:
+            w = theta[ix]
+            total = w.sum()
+            new[ix] += n * (w / total if total > 0 else 1.0 / len(ix))
+        new /= new.sum()
+        done = np.abs(new - theta).max() < tol
+        theta = new
+        if done:
+            break
+    size = np.array([genome_size.get(t, 0) for t in taxa], dtype=float)
+    per_genome = np.where(size > 0, theta / np.where(size > 0, size, 1), 0)
+    if per_genome.sum() > 0:
+        per_genome /= per_genome.sum()
+    return dict(zip(taxa, per_genome))
+
+def sample_report(counts, batch_report):
+    """Report of one sample in the layout of a centrifuge report, in the taxon order of the batch report"""
+    report = batch_report.drop_duplicates("taxID")
+    report = report.loc[report.taxID.isin(list(counts.reads))].copy()
+    missing = set(counts.reads) - set(report.taxID)
+    if missing:
+        sys.stderr.write("WARNING: {} taxa missing from the batch report\n".format(len(missing)))
+    abundance = estimate_abundance(counts.classes, dict(zip(report.taxID, report.genomeSize)))
+    report["numReads"] = report.taxID.map(counts.reads).astype(np.int64)
+    report["numUniqueReads"] = report.taxID.map(counts.unique).fillna(0).astype(np.int64)
+    report["abundance"] = ["{:g}".format(round(abundance.get(t, 0.0), 6)) for t in report.taxID]
+    return report[REPORT_COLUMNS]
+
+def split_batch(outfile, reportfile, samples, outdir, chunksize=1000000):
+    """Write {outdir}/{sample}.out and {outdir}/{sample}.report.tsv of each sample of the batch"""
+    os.makedirs(outdir, exist_ok=True)
+    batch_report = pd.read_csv(reportfile, sep="\t")
+    counts = [SampleCounts() for s in samples]
+    outs = [open(os.path.join(outdir, s + ".out"), "w") for s in samples]
+    try:
+        reader = pd.read_csv(outfile, sep="\t", dtype={"readID": str, "seqID": str}, chunksize=chunksize)
+        header = None
+        carry = None
+        for chunk in reader:
+            if header is None:
+                header = "\t".join(chunk.columns) + "\n"
+                for fh in outs:
+                    fh.write(header)
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            # the assignments of a read are consecutive, the last read may continue in the next chunk
+            last = chunk.readID.values[-1]
+            tail = (chunk.readID == last).values
+            carry, chunk = chunk.loc[tail], chunk.loc[~tail]
+            write_chunk(chunk, counts, outs)
+        if carry is not None:
+            write_chunk(carry, counts, outs)
+    finally:
+        for fh in outs:
+            fh.close()
+    for sample, c in zip(samples, counts):
+        sample_report(c, batch_report).to_csv(os.path.join(outdir, sample + ".report.tsv"), sep="\t", index=False)
+        sys.stderr.write("{}: {} taxa\n".format(sample, len(c.reads)))
+
+def write_chunk(chunk, counts, outs):
+    if chunk.empty:
+        return
+    tag = chunk.readID.str.split(":", n=1, expand=True)
+    chunk = chunk.assign(readID=tag[1].values)
+    for i, rows in chunk.groupby(tag[0].astype(int).values, sort=False):
+        counts[i].update(rows)
+        rows.to_csv(outs[i], sep="\t", index=False, header=False)
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    tag = subparsers.add_parser("tag", help="Write the reads of a batch as one FASTQ stream with sample-tagged read ids.")
+    tag.add_argument("--reads", type=str, nargs="+", required=True,
+                     help="FASTQ files of the samples of the batch, plain or gzipped, in batch order.")
+    split = subparsers.add_parser("split", help="Demultiplex the centrifuge output of a batch.")
+    split.add_argument("--out", type=str, required=True,
+                       help="Centrifuge output of the batch.")
+    split.add_argument("--report", type=str, required=True,
+                       help="Centrifuge report of the batch.")
+    split.add_argument("--samples", type=str, nargs="+", required=True,
+                       help="Sample names, in batch order.")
+    split.add_argument("--outdir", type=str, required=True,
+                       help="Output directory of the per-sample outputs and reports.")
+    split.add_argument("--chunksize", type=int, default=1000000,
+                       help="Number of centrifuge output lines read at a time (default = 1000000)")
+    args = parser.parse_args()
+
+    if args.command == "tag":
+        tag_reads(args.reads, sys.stdout.buffer)
+    elif args.command == "split":
+        split_batch(args.out, args.report, args.samples, args.outdir, args.chunksize)
+    else:
+        parser.error("one of tag or split is required")
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,18 @@
 #!/usr/bin/env python
 
-from ete3 import NCBITaxa
+from taxtable import open_taxtable
+from seqidindex import SeqidIndex
+from stagetimer import StageTimer
 import pandas as pd
 from argparse import ArgumentParser
 
-def get_seqids(df, seqid2taxid, ncbitaxa):
-    filtered = pd.DataFrame()
-    for i in df.index:
-        taxid = df.loc[i,"taxID"]
-        # Intersect descendants with those we have genomes for
-        descendants = seqid2taxid.loc[seqid2taxid["taxID"].isin(ncbitaxa.get_descendant_taxa(taxid)+[taxid])].copy()
-        if len(descendants) == 0:
-            continue
-        # we still use the ancestry taxid for those descendant genomes
-        descendants["taxID"] = taxid
-        filtered = pd.concat([filtered,descendants])
-    return filtered
+def get_seqids(df, seqindex):
+    # Intersect descendants with those we have genomes for,
+    # we still use the ancestry taxid for those descendant genomes
+    return seqindex.descendant_seqids(df.taxID.values)
 
-def filter_genomes(input,db,mapfile,min_read_count,min_abundance,host_taxid,output):
+def filter_genomes(input,taxtable,seqindex,min_read_count,min_abundance,host_taxid,output,timings=None):
+    timer = StageTimer("centrifuge_filter_genomes", timings)
     df = pd.read_csv(input, sep="\t")
     # Filter to number of reads >= 3
     df = df.loc[df.numReads >= 3] # for each classification, at least 3 different reads
@@ -26,35 +21,16 @@ def filter_genomes(input,db,mapfile,min_read_count,min_abundance,host_taxid,outp
     # discard host: human genome
     df = df.loc[df.taxID != int(host_taxid)]
     
-    # Read the centrifuge sqlite database
-    ncbitaxa = NCBITaxa(db)
+    # Read the compiled taxonomy table for batch lineage lookups
+    with timer.stage("load"):
+        taxtable = open_taxtable(taxtable)
     
-    df["genus"] = ""
-    df["family"] = ""
-    df["kingdom"] = ""
-    genus = []
-    family = []
-    kingdom = []
-    HERV_taxids = []
-    for taxid in df.taxID:
-        lineage = ncbitaxa.get_lineage(taxid)
-        ranks = ncbitaxa.get_rank(lineage)
-        genus_name = ""
-        family_name = ""
-        kingdom_name = ""
-        for key, value in ranks.items():
-            name = ncbitaxa.get_taxid_translator([key]).get(key)
-            if(name == "Human endogenous retroviruses"): HERV_taxids.append(taxid)
-            if(value == "genus"): genus_name = name
-            if(value == "family"): family_name = name
-            if(value == "superkingdom"): kingdom_name = name
-        genus.append(genus_name)
-        family.append(family_name)
-        kingdom.append(kingdom_name)
-    
-    df["genus"] = genus
-    df["family"] = family
-    df["kingdom"] = kingdom
+    with timer.stage("lineage"):
+        df["genus"] = taxtable.rank_names_of(df.taxID.values, "genus")
+        df["family"] = taxtable.rank_names_of(df.taxID.values, "family")
+        df["kingdom"] = taxtable.superkingdom(df.taxID.values)
+        HERV = taxtable.name_translator(["Human endogenous retroviruses"]).get("Human endogenous retroviruses", [])
+        HERV_taxids = df.taxID.loc[taxtable.has_ancestor(df.taxID.values, HERV)]
     # for virus, keep all records, and 
     # for non-virus, filter based on defined cutoffs
     df_virus = df.loc[df.kingdom == "Viruses"]
@@ -70,34 +46,31 @@ def filter_genomes(input,db,mapfile,min_read_count,min_abundance,host_taxid,outp
         loc2 = df.abundance.idxmax()
         df_filtered = df.loc[list(set([loc1,loc2]))]
     
-    # Read the seqid -> taxid map file
-    seqid2taxid = pd.read_csv(mapfile, header=None, names=["seq", "taxID"], sep="\s+")
-    filtered = get_seqids(df_filtered, seqid2taxid, ncbitaxa)
+    # Read the seqid -> taxid index sorted in taxonomy pre-order
+    with timer.stage("seqids"):
+        seqindex = SeqidIndex(seqindex, taxtable)
+        filtered = get_seqids(df_filtered, seqindex)
     if len(filtered) == 0:
         filtered = pd.DataFrame(columns=["seq","taxID"])
     # add taxonomy information based on taxID by merging df_filtered
     ids2tax = pd.merge(filtered,df_filtered[["taxID","name","genus","family","kingdom"]],on="taxID")
-    ids2tax.to_csv(output, sep="\t",index=False)
-
-#def main(args):
-    #filter_genomes(args.input, args.db, args.mapfile, args.min_read_count, args.min_abundance, args.host_taxid, args.output)
-
-## -i snakemake.input[0] -d snakemake.input[1] -M snakemake.input[2] -r snakemake.params[0] 
-## -a snakemake.params[1] -t snakemake.params[2] -o snakemake.output[0]
+    with timer.stage("write"):
+        ids2tax.to_csv(output, sep="\t",index=False)
+    timer.save()
 
-def main():
-    filter_genomes(snakemake.input[0],snakemake.input[1],snakemake.input[2],snakemake.params[0],\
-                   snakemake.params[1],snakemake.params[2],snakemake.output[0])
+def main(args):
+    filter_genomes(args.input, args.taxtable, args.seqindex, args.min_read_count, args.min_abundance,
+                   args.host_taxid, args.output, args.timings)
 
 if __name__ == '__main__':
-    #parser = ArgumentParser()
-    #parser.add_argument("-i", "--input", type=str, required=True)
-    #parser.add_argument("-d", "--db", type=str, required=True)
-    #parser.add_argument("-r", "--min_read_count", type=int, required=True)
-    #parser.add_argument("-a", "--min_abundance", type=float, required=True)
-    #parser.add_argument("-t", "--host_taxid", type=str, required=True)
-    #parser.add_argument("-M", "--mapfile", type=str, required=True)
-    #parser.add_argument("-o", "--output", type=str, required=True)
-    #args = parser.parse_args()
-    #main(args)
-    main()
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--input", type=str, required=True)
+    parser.add_argument("-d", "--taxtable", type=str, required=True)
+    parser.add_argument("-r", "--min_read_count", type=int, required=True)
+    parser.add_argument("-a", "--min_abundance", type=float, required=True)
+    parser.add_argument("-t", "--host_taxid", type=str, required=True)
+    parser.add_argument("-M", "--seqindex", type=str, required=True)
+    parser.add_argument("-o", "--output", type=str, required=True)
+    parser.add_argument("--timings", type=str)
+    args = parser.parse_args()
+    main(args)
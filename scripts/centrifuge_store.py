@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+Compressed columnar store of a centrifuge classification output.
+
+The rows of the .out file are kept in row groups, and every column of a
+row group is a zlib-compressed block:
+    meta.json               columns, dtypes and row count of each row group,
+                            with the min and max of its numeric columns
+    {column}.bin,
+    {column}.idx.npy        compressed blocks of a column and their offsets
+    {column}.dict.bin,
+    {column}.dict.idx.npy   dictionaries of the string columns (readID,
+                            seqID): the distinct values of each row group,
+                            newline-separated, referenced by the codes in
+                            {column}.bin (or by the number of consecutive rows
+                            of each value, as for the rows of one read)
+
+Numeric columns are stored as int32 where their values fit, and read as
+int64 like the columns of the text output. Readers ask for the columns
+they use and for filters such as ("numMatches", "==", 1): row groups
+whose min/max rule a filter out are skipped, the filter columns are
+decompressed first, and the other columns only for row groups with
+matching rows.
+
+    python scripts/centrifuge_store.py build --out sample_se.out --store sample_se.out.store
+    python scripts/centrifuge_store.py text --store sample_se.out.store > sample_se.out
+"""
+
+from argparse import ArgumentParser
+import pandas as pd
+import numpy as np
+import json
+import zlib
+import sys
+import os
+
+VERSION = 1
+ROW_GROUP = 262144
+LEVEL = 3
+
+OPS = {"==": lambda a, v: a == v,
+       "!=": lambda a, v: a != v,
+       ">=": lambda a, v: a >= v,
+       ">": lambda a, v: a > v,
+       "<=": lambda a, v: a <= v,
+       "<": lambda a, v: a < v,
+       "in": lambda a, v: np.isin(a, list(v)),
+       "not in": lambda a, v: ~np.isin(a, list(v))}
+
+def may_match(op, value, lo, hi):
+    """False when no value in [lo, hi] can pass the filter"""
+    if op == "==":
+        return lo <= value <= hi
+    if op == ">=":
+        return hi >= value
+    if op == ">":
+        return hi > value
+    if op == "<=":
+        return lo <= value
+    if op == "<":
+        return lo < value
+    if op == "!=":
+        return not lo == hi == value
+    if op == "in":
+        return any(lo <= v <= hi for v in value)
+    return True
+
+class BlockWriter(object):
+    """Compressed blocks appended to {name}.bin, with their offsets"""
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.fh = open(os.path.join(path, name + ".bin"), "wb")
+        self.offsets = [0]
+
+    def write(self, data):
+        block = zlib.compress(data, LEVEL)
+        self.fh.write(block)
+        self.offsets.append(self.offsets[-1] + len(block))
+
+    def close(self):
+        self.fh.close()
+        np.save(os.path.join(self.path, self.name + ".idx.npy"), np.array(self.offsets, dtype=np.int64))
+
+def encode_numeric(values):
+    """Values as int32 where they fit, otherwise in their own dtype"""
+    if values.dtype.kind in "iu" and len(values) and \
+            values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max:
+        values = values.astype("<i4")
+    elif values.dtype.kind in "iu":
+        values = values.astype("<i8")
+    else:
+        values = values.astype("<f8")
+    return values, values.dtype.str
+
+def encode_strings(values):
+    """Dictionary encoding: distinct values, and run lengths or codes of the rows"""
+    codes, uniques = pd.factorize(values)
+    steps = np.diff(codes)
+    if len(codes) and codes[0] == 0 and ((steps == 0) | (steps == 1)).all():
+        return "\n".join(uniques).encode("utf-8"), np.bincount(codes).astype("<i4"), "runs"
+    return "\n".join(uniques).encode("utf-8"), codes.astype("<i4"), "codes"
+
+def build_store(outfile, store, row_group=ROW_GROUP):
+    os.makedirs(store, exist_ok=True)
+    meta = {"version": VERSION, "row_group": row_group, "columns": None, "groups": []}
+    writers = {}
+    reader = pd.read_csv(outfile, sep="\t", dtype={"readID": str, "seqID": str}, chunksize=row_group,
+                         keep_default_na=False)
+    try:
+        for chunk in reader:
+            if meta["columns"] is None:
+                meta["columns"] = list(chunk.columns)
+                for column in chunk.columns:
+                    writers[column] = BlockWriter(store, column)
+                    if chunk[column].dtype == object:
+                        writers[column + ".dict"] = BlockWriter(store, column + ".dict")
+            group = {"rows": len(chunk), "dtypes": {}, "min": {}, "max": {}}
+            for column in chunk.columns:
+                values = chunk[column].values
+                if values.dtype == object:
+                    strings, codes, encoding = encode_strings(values)
+                    writers[column + ".dict"].write(strings)
+                    writers[column].write(codes.tobytes())
+                    group["dtypes"][column] = encoding
+                else:
+                    values, dtype = encode_numeric(values)
+                    writers[column].write(values.tobytes())
+                    group["dtypes"][column] = dtype
+                    group["min"][column] = values.min().item()
+                    group["max"][column] = values.max().item()
+            meta["groups"].append(group)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    if meta["columns"] is None:
+        raise ValueError("No header in {}".format(outfile))
+    with open(os.path.join(store, "meta.json"), "w") as fh:
+        json.dump(meta, fh)
+    rows = sum(g["rows"] for g in meta["groups"])
+    sys.stderr.write("Stored {} rows in {} row groups in {}\n".format(rows, len(meta["groups"]), store))
+
+class CentrifugeStore(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as fh:
+            self.meta = json.load(fh)
+        if self.meta["version"] != VERSION:
+            raise ValueError("Unsupported store version {} in {}".format(self.meta["version"], path))
+        self.columns = self.meta["columns"]
+        self.groups = self.meta["groups"]
+        self._offsets = {}
+
+    def __len__(self):
+        return sum(g["rows"] for g in self.groups)
+
+    def _block(self, name, g):
+        if name not in self._offsets:
+            self._offsets[name] = np.load(os.path.join(self.path, name + ".idx.npy"))
+        start, end = self._offsets[name][g], self._offsets[name][g + 1]
+        with open(os.path.join(self.path, name + ".bin"), "rb") as fh:
+            fh.seek(start)
+            return zlib.decompress(fh.read(end - start))
+
+    def column(self, g, column):
+        """Values of a column in row group g"""
+        dtype = self.groups[g]["dtypes"][column]
+        data = self._block(column, g)
+        if dtype not in ("runs", "codes"):
+            # integers are widened to int64, as read from the text output
+            values = np.frombuffer(data, dtype=dtype)
+            return values.astype(np.int64) if values.dtype.kind in "iu" else values
+        strings = self._block(column + ".dict", g).decode("utf-8")
+        uniques = np.array(strings.split("\n") if self.groups[g]["rows"] else [], dtype=object)
+        codes = np.frombuffer(data, dtype="<i4")
+        if dtype == "runs":
+            return np.repeat(uniques, codes)
+        return uniques[codes]
+
+    def chunks(self, columns=None, filters=None):
+        """DataFrames of the rows of each row group passing all filters, with the given columns"""
+        columns = list(columns or self.columns)
+        filters = list(filters or [])
+        for column, op, value in filters:
+            if column not in self.columns or op not in OPS:
+                raise ValueError("Invalid filter {} {} {}".format(column, op, value))
+        for g, group in enumerate(self.groups):
+            if not all(column not in group["min"] or
+                       may_match(op, value, group["min"][column], group["max"][column])
+                       for column, op, value in filters):
+                continue
+            values = {}
+            mask = None
+            for column, op, value in filters:
+                if column not in values:
+                    values[column] = self.column(g, column)
+                passed = OPS[op](values[column], value)
+                mask = passed if mask is None else mask & passed
+            if mask is not None and not mask.any():
+                continue
+            df = pd.DataFrame({column: values[column] if column in values else self.column(g, column)
+                               for column in columns}, columns=columns)
+            yield df if mask is None or mask.all() else df.loc[mask].reset_index(drop=True)
+
+    def write_text(self, out):
+        """Write the rows as the centrifuge output they were stored from"""
+        out.write("\t".join(self.columns) + "\n")
+        for df in self.chunks():
+            df.to_csv(out, sep="\t", index=False, header=False)
+
+def read_chunks(path, columns, filters=None, chunksize=1000000):
+    """
+    DataFrames of the columns of a centrifuge output, text or store, with the
+    rows passing the filters; the store reads only the row groups and columns needed
+    """
+    if os.path.isdir(path):
+        for df in CentrifugeStore(path).chunks(columns, filters):
+            yield df
+        return
+    filters = list(filters or [])
+    usecols = list(columns) + [c for c, op, v in filters if c not in columns]
+    reader = pd.read_csv(path, header=0, sep="\t", usecols=usecols, dtype={"readID": str}, chunksize=chunksize)
+    for df in reader:
+        for column, op, value in filters:
+            df = df.loc[OPS[op](df[column].values, value)]
+        yield df[list(columns)]
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    build = subparsers.add_parser("build", help="Store a centrifuge output in compressed columns.")
+    build.add_argument("--out", type=str, required=True,
+                       help="Centrifuge output.")
+    build.add_argument("--store", type=str, required=True,
+                       help="Output directory of the store.")
+    build.add_argument("--row_group", type=int, default=ROW_GROUP,
+                       help="Number of rows of each row group (default = {})".format(ROW_GROUP))
+    text = subparsers.add_parser("text", help="Write a store as centrifuge output to stdout.")
+    text.add_argument("--store", type=str, required=True,
+                      help="Store directory.")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_store(args.out, args.store, args.row_group)
+    elif args.command == "text":
+        CentrifugeStore(args.store).write_text(sys.stdout)
+    else:
+        parser.error("one of build or text is required")
+
+if __name__ == '__main__':
+    main()
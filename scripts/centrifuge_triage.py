@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+"""
+Triage classification of a sample, for a fast first result on large runs.
+
+The reads are streamed to one centrifuge run, and the per-taxon counts of
+parse_centrifuge.py are updated from its output every --chunk reads. Once
+the profile has converged the input is closed, and centrifuge writes the
+output and report of the reads classified so far, in the layout of a full
+run.
+
+The profile has converged when, at --checks consecutive checkpoints after
+at least --min_reads reads,
+    - no taxon's share of the counted reads changed by more than --tolerance
+    - the --top most abundant taxa are the same (in any order, as close
+      taxa swap places between checkpoints)
+    - no viral taxon with fewer than --rare_reads counted reads gained reads
+The last condition guards rare pathogens: a viral taxon that has just
+appeared is followed until it reaches the reads required downstream, or the
+reads run out. Without convergence all reads are classified, as in a full
+run.
+
+Every checkpoint is logged to --log, and the number of classified reads
+and whether the profile converged to --state.
+"""
+
+from argparse import ArgumentParser
+from parse_centrifuge import TaxaCounter, centrifuge_filters, viral_taxa, OUT_COLUMNS
+from centrifuge_store import OPS
+from taxtable import TaxTable
+import pandas as pd
+import subprocess
+import threading
+import gzip
+import json
+import io
+import sys
+
+LOG_COLUMNS = ["reads", "counted", "taxa", "max_change", "top_changed", "rare_growing", "stable", "converged"]
+
+def open_reads(fp):
+    if fp.endswith(".gz"):
+        return gzip.open(fp, "rb")
+    return open(fp, "rb")
+
+def feed_reads(fastq, stdin, stop, batch=4000):
+    """Write the FASTQ records of fastq to stdin until they run out or stop is set, then close stdin"""
+    try:
+        with open_reads(fastq) as fh:
+            lines = []
+            for line in fh:
+                lines.append(line)
+                if len(lines) == batch:
+                    stdin.write(b"".join(lines))
+                    lines = []
+                    if stop.is_set():
+                        break
+            else:
+                stdin.write(b"".join(lines))
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+class Convergence(object):
+    """Convergence of the taxa profile between checkpoints"""
+    def __init__(self, tolerance, top, checks, min_reads, rare_reads, is_viral):
+        self.tolerance = tolerance
+        self.top = top
+        self.checks = checks
+        self.min_reads = min_reads
+        self.rare_reads = rare_reads
+        self.is_viral = is_viral
+        self.counts = pd.Series(dtype=float)
+        self.stable = 0
+        self.log = []
+
+    def top_taxa(self, counts):
+        return set(counts.sort_index().sort_values(ascending=False, kind="mergesort").index[:self.top])
+
+    def check(self, counts, reads):
+        """Record the checkpoint of the cumulative per-taxon counts after reads reads; True when converged"""
+        counts = counts.loc[counts > 0]
+        share = counts / counts.sum() if len(counts) else counts
+        previous = self.counts / self.counts.sum() if len(self.counts) else self.counts
+        change = share.subtract(previous, fill_value=0).abs()
+        max_change = float(change.max()) if len(change) else 0.0
+        top_changed = self.top_taxa(counts) != self.top_taxa(self.counts)
+        gained = counts.subtract(self.counts, fill_value=0)
+        rare = [taxid for taxid in gained.index[gained > 0]
+                if counts[taxid] < self.rare_reads and self.is_viral(taxid)]
+        stable = len(self.counts) > 0 and max_change <= self.tolerance and not top_changed and not rare
+        self.stable = self.stable + 1 if stable else 0
+        converged = reads >= self.min_reads and self.stable >= self.checks
+        self.log.append((reads, float(counts.sum()), len(counts), round(max_change, 6),
+                         int(top_changed), len(rare), self.stable, int(converged)))
+        self.counts = counts
+        return converged
+
+def triage(args):
+    taxtable = TaxTable(args.taxdb)
+    convergence = Convergence(args.tolerance, args.top, args.checks, args.min_reads, args.rare_reads,
+                              viral_taxa(taxtable))
+    filters = centrifuge_filters(args)
+    counter = TaxaCounter()
+
+    command = ["centrifuge", "-k", str(args.k), "-U", "-", "-x", args.index,
+               "--report-file", args.report, "-p", str(args.threads)]
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stop = threading.Event()
+    feeder = threading.Thread(target=feed_reads, args=(args.reads, proc.stdin, stop))
+    feeder.start()
+
+    def checkpoint(lines, reads):
+        df = pd.read_csv(io.BytesIO(b"".join(lines)), sep="\t", header=None, names=columns,
+                         usecols=OUT_COLUMNS[1:])
+        for column, op, value in filters:
+            df = df.loc[OPS[op](df[column].values, value)]
+        counter.update(df)
+        counts = counter.totals["count"] if counter.totals is not None else pd.Series(dtype=float)
+        if convergence.check(counts, reads) and not stop.is_set():
+            sys.stderr.write("Taxa profile converged after {} reads, closing the input\n".format(reads))
+            stop.set()
+            converged_at.append(reads)
+
+    reads = 0
+    converged_at = []
+    try:
+        with open(args.out, "wb") as out:
+            header = proc.stdout.readline()
+            out.write(header)
+            columns = header.decode("utf-8").rstrip("\n").split("\t")
+            lines, last, pending = [], None, 0
+            for line in proc.stdout:
+                out.write(line)
+                readid = line[:line.find(b"\t")]
+                # the assignments of a read are consecutive, checkpoints fall between reads
+                if readid != last:
+                    if pending >= args.chunk:
+                        checkpoint(lines, reads)
+                        lines, pending = [], 0
+                    reads += 1
+                    pending += 1
+                    last = readid
+                lines.append(line)
+            if lines:
+                checkpoint(lines, reads)
+    except BaseException:
+        # centrifuge may be blocked on its undrained output, with the feeder blocked on its input
+        proc.kill()
+        raise
+    finally:
+        stop.set()
+        feeder.join()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, " ".join(command))
+
+    with open(args.log, "w") as fh:
+        fh.write("\t".join(LOG_COLUMNS) + "\n")
+        for row in convergence.log:
+            fh.write("\t".join(str(v) for v in row) + "\n")
+    # reads already sent to centrifuge when the input was closed are classified too
+    state = {"reads": reads, "checkpoints": len(convergence.log),
+             "converged": bool(converged_at), "converged_reads": converged_at[0] if converged_at else None}
+    with open(args.state, "w") as fh:
+        json.dump(state, fh, indent=2)
+    sys.stderr.write("{} reads classified, profile {}\n".format(reads, "converged" if converged_at else "not converged"))
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--reads", type=str, required=True,
+                        help="FASTQ file of the sample, plain or gzipped.")
+    parser.add_argument("--index", type=str, required=True,
+                        help="Centrifuge index prefix.")
+    parser.add_argument("-k", type=int, default=1,
+                        help="Maximum number of assignments per read (default = 1)")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Centrifuge threads (default = 1)")
+    parser.add_argument("--taxdb", type=str, required=True,
+                        help="Compiled taxonomy table (see taxtable.py), to find viral taxa.")
+    parser.add_argument("--unique", action="store_true",
+                        help="Only count reads mapping uniquely")
+    parser.add_argument("--min_score", type=int,
+                        help="Require a minimum score for reads to be counted")
+    parser.add_argument("--min_length", type=int,
+                        help="Require a minimum alignment length to the read")
+    parser.add_argument("--host_taxid", type=str,
+                        help="Host taxonomy id that will be excluded.")
+    parser.add_argument("--chunk", type=int, default=500000,
+                        help="Number of reads between checkpoints (default = 500000)")
+    parser.add_argument("--min_reads", type=int, default=2000000,
+                        help="Minimum number of reads classified before stopping (default = 2000000)")
+    parser.add_argument("--tolerance", type=float, default=0.005,
+                        help="Largest change of a taxon's share of the reads between converged checkpoints (default = 0.005)")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of most abundant taxa that must be unchanged (default = 10)")
+    parser.add_argument("--checks", type=int, default=2,
+                        help="Number of consecutive converged checkpoints required (default = 2)")
+    parser.add_argument("--rare_reads", type=float, default=3,
+                        help="Viral taxa with fewer reads that still gain reads prevent stopping (default = 3)")
+    parser.add_argument("--out", type=str, required=True,
+                        help="Centrifuge output.")
+    parser.add_argument("--report", type=str, required=True,
+                        help="Centrifuge report.")
+    parser.add_argument("--log", type=str, required=True,
+                        help="Table of the checkpoints.")
+    parser.add_argument("--state", type=str, required=True,
+                        help="JSON with the number of classified reads and whether the profile converged.")
+    args = parser.parse_args()
+
+    triage(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+
+"""
+Persistent samples x taxa store of the results of a cohort.
+
+Each finished sample is appended once, from its taxa lineage report
+(parse_centrifuge.py), its centrifuge-kreport, its sourmash coverage of the
+filtered genomes and its per-taxon mapping statistics (bam_coverage.py).
+The store is a
+directory of columnar tables, one row per sample and taxon:
+    samples.tsv        code (the number of its segment), sample name and
+                       time of each append; a sample appended again
+                       replaces its earlier rows
+    taxa.tsv           name, rank, genome size and lineage of each taxon
+    segments/{n}/      rows of one append, sorted by taxID
+    main.{n}/          the rows of the compacted segments, sorted by taxID
+                       and sample
+    meta.json          the current main table and the last segment in it
+    store.lock         appends and compactions hold an exclusive lock,
+                       queries a shared one
+Every table is a directory of .npy columns (sample, taxID and the METRICS),
+sorted by taxID, so the rows of a taxon are found by binary search. Appends
+write a new segment; once there are more than --max_segments, the segments
+are merged into a new main table. Columns missing from tables written
+before they were added read as NaN.
+
+numReads is the read count of the centrifuge report, without the score
+filter of parse_centrifuge.py and with a read assigned to several taxa
+counted for each; kreportReads is the taxon read count of the kreport
+(centrifuge-kreport --min-score), which the Krona charts show, as for the
+per-sample charts.
+
+    python scripts/cohort_store.py append --store cohort --sample S1 --lineage S1_se.report.taxLineage.tsv \\
+        --kreport S1_se.report --sourmash S1_se.sourmash.tsv --genomes S1_se.filtered_genomes --coverage S1_se.coverage.taxa.tsv
+    python scripts/cohort_store.py query --store cohort --taxid 10239 --metric abundance --min 0.01
+    python scripts/cohort_store.py matrix --store cohort --metric numUniqueReads --out matrix.tsv
+    python scripts/cohort_store.py krona --store cohort --outdir krona
+"""
+
+from argparse import ArgumentParser
+from bt2cache import locked
+import pandas as pd
+import numpy as np
+import shutil
+import json
+import time
+import sys
+import os
+
+METRICS = ["numReads", "numUniqueReads", "abundance", "alignedNorm", "kreportReads", "f_match",
+           "mapped_reads", "perc_covered", "avg_depth", "num_regions"]
+COLUMNS = ["sample", "taxID"] + METRICS
+TAXA_COLUMNS = ["taxID", "name", "taxRank", "genomeSize", "taxaLineage"]
+MAX_SEGMENTS = 64
+KREPORT_COLUMNS = ["percent", "cladeReads", "taxonReads", "rankCode", "taxID", "name"]
+KREPORT_RANKS = {"U": "unclassified", "R": "root", "D": "superkingdom", "K": "kingdom", "P": "phylum",
+                 "C": "class", "O": "order", "F": "family", "G": "genus", "S": "species", "-": "no rank"}
+
+def read_kreport(kreport):
+    """Taxon reads, rank and name of the taxa of a centrifuge-kreport"""
+    df = pd.read_csv(kreport, sep="\t", header=None, names=KREPORT_COLUMNS, quoting=3)
+    df["name"] = df["name"].astype(str).str.strip()
+    df["taxRank"] = df.rankCode.map(KREPORT_RANKS).fillna("no rank")
+    return df.loc[df.taxonReads > 0].drop_duplicates("taxID")
+
+def sample_rows(lineage, sourmash=None, genomes=None, coverage=None, kreport=None):
+    """One row per taxon of a sample with the METRICS, and the names and lineages of its taxa"""
+    report = pd.read_csv(lineage, sep="\t").drop_duplicates("taxID")
+    rows = report.set_index("taxID")[["numReads", "numUniqueReads", "abundance", "alignedNorm"]].astype(float)
+    taxa = report[[c for c in TAXA_COLUMNS if c in report.columns]]
+    if kreport:
+        # the kreport also holds the taxa filtered out by parse_centrifuge.py, and the unclassified reads
+        kreport = read_kreport(kreport)
+        rows = rows.join(kreport.set_index("taxID").taxonReads.rename("kreportReads").astype(float), how="outer")
+        taxa = pd.concat([taxa, kreport.loc[~kreport.taxID.isin(taxa.taxID), ["taxID", "name", "taxRank"]]],
+                         ignore_index=True, sort=False)
+    if sourmash and genomes and os.path.getsize(genomes) >= 40:
+        # sourmash coverage is per genome, a taxon gets that of its best covered genome
+        cov = pd.read_csv(sourmash, sep="\t", dtype={"seq": str})[["seq", "f_match"]]
+        seq2taxid = pd.read_csv(genomes, sep="\t", dtype={"seq": str})[["seq", "taxID"]]
+        f_match = cov.merge(seq2taxid, on="seq").groupby("taxID").f_match.max()
+        rows = rows.join(f_match, how="outer")
+    if coverage:
+        cov = pd.read_csv(coverage, sep="\t")
+        # reads mapped at the lowest MAPQ cutoff
+        mapq = sorted((c for c in cov.columns if c.startswith("mapq") and c.endswith("_reads")),
+                      key=lambda c: int(c[len("mapq"):-len("_reads")]))
+        cov = cov.rename(columns={mapq[0]: "mapped_reads"}) if mapq else cov.assign(mapped_reads=np.nan)
+        rows = rows.join(cov.set_index("taxID")[["mapped_reads", "perc_covered", "avg_depth", "num_regions"]],
+                         how="outer")
+    rows = rows.reindex(columns=METRICS).astype(float).sort_index()
+    return rows, taxa
+
+def save_table(path, columns):
+    """Write the columns of a table to a new directory, published by rename"""
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp, name + ".npy"), values)
+    os.rename(tmp, path)
+
+def load_table(path):
+    table = {}
+    for name in COLUMNS:
+        fp = os.path.join(path, name + ".npy")
+        table[name] = np.load(fp, mmap_mode="r") if os.path.exists(fp) else None
+    # metrics added after the table was written
+    for name in COLUMNS:
+        if table[name] is None:
+            table[name] = np.full(len(table["taxID"]), np.nan)
+    return table
+
+class CohortStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.segments_path = os.path.join(path, "segments")
+        self.meta_file = os.path.join(path, "meta.json")
+        self.lock = os.path.join(path, "store.lock")
+        os.makedirs(self.segments_path, exist_ok=True)
+
+    def meta(self):
+        if not os.path.exists(self.meta_file):
+            return {"main": None, "merged": 0}
+        with open(self.meta_file) as fh:
+            return json.load(fh)
+
+    def samples(self):
+        """Sample name -> code of its latest append"""
+        fp = os.path.join(self.path, "samples.tsv")
+        if not os.path.exists(fp):
+            return {}
+        df = pd.read_csv(fp, sep="\t", dtype={"sample": str})
+        return dict(zip(df["sample"], df["code"]))
+
+    def taxa(self):
+        fp = os.path.join(self.path, "taxa.tsv")
+        if not os.path.exists(fp):
+            return pd.DataFrame(columns=TAXA_COLUMNS).set_index("taxID")
+        return pd.read_csv(fp, sep="\t").drop_duplicates("taxID", keep="last").set_index("taxID")
+
+    def segments(self, meta):
+        """Segment numbers not yet merged into the main table"""
+        numbers = [int(d) for d in os.listdir(self.segments_path) if d.isdigit()]
+        return sorted(n for n in numbers if n > meta["merged"])
+
+    def append(self, sample, rows, taxa, max_segments=MAX_SEGMENTS):
+        with locked(self.lock):
+            meta = self.meta()
+            numbers = [int(d) for d in os.listdir(self.segments_path) if d.isdigit()]
+            # segment numbers are never reused, so they also serve as the codes of the appends
+            code = max(numbers + [meta["merged"]]) + 1
+            samples_file = os.path.join(self.path, "samples.tsv")
+            save_table(os.path.join(self.segments_path, "{:06d}".format(code)), {
+                "sample": np.full(len(rows), code, dtype=np.int32),
+                "taxID": rows.index.values.astype(np.int64),
+                **{m: rows[m].values.astype(np.float64) for m in METRICS}})
+            # rows of a segment without a line in samples.tsv (an interrupted append) are never read
+            new = not os.path.exists(samples_file)
+            with open(samples_file, "a") as fh:
+                if new:
+                    fh.write("code\tsample\tadded\n")
+                fh.write("{}\t{}\t{}\n".format(code, sample, time.strftime("%Y-%m-%d %H:%M:%S")))
+            known = self.taxa()
+            taxa = taxa.loc[~taxa.taxID.isin(known.index)].reindex(columns=TAXA_COLUMNS)
+            if len(taxa):
+                taxa_file = os.path.join(self.path, "taxa.tsv")
+                taxa.to_csv(taxa_file, sep="\t", index=False, mode="a", header=not os.path.exists(taxa_file))
+            if len(self.segments(meta)) > max_segments:
+                self.compact()
+        return code
+
+    def compact(self):
+        """Merge the main table and the segments into a new main table (exclusive lock held)"""
+        meta = self.meta()
+        segments = self.segments(meta)
+        if not segments:
+            return
+        active = np.array(sorted(self.samples().values()), dtype=np.int32)
+        tables = [load_table(os.path.join(self.path, meta["main"]))] if meta["main"] else []
+        tables += [load_table(os.path.join(self.segments_path, "{:06d}".format(n))) for n in segments]
+        merged = {c: np.concatenate([np.asarray(t[c]) for t in tables]) for c in COLUMNS}
+        keep = np.isin(merged["sample"], active)
+        order = np.lexsort((merged["sample"][keep], merged["taxID"][keep]))
+        merged = {c: v[keep][order] for c, v in merged.items()}
+        main = "main.{:06d}".format(segments[-1])
+        # left by a compaction interrupted before meta.json was replaced
+        shutil.rmtree(os.path.join(self.path, main), ignore_errors=True)
+        save_table(os.path.join(self.path, main), merged)
+        tmp = self.meta_file + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump({"main": main, "merged": segments[-1]}, fh)
+        os.replace(tmp, self.meta_file)
+        if meta["main"]:
+            shutil.rmtree(os.path.join(self.path, meta["main"]), ignore_errors=True)
+        for n in segments:
+            shutil.rmtree(os.path.join(self.segments_path, "{:06d}".format(n)), ignore_errors=True)
+        sys.stderr.write("Compacted {} segments, {} rows in {}\n".format(len(segments), len(merged["taxID"]), main))
+
+    def rows(self, taxids=None):
+        """Rows of the latest append of each sample, of the given taxa or all, with sample names"""
+        with locked(self.lock, shared=True):
+            meta = self.meta()
+            samples = self.samples()
+            names = pd.Series(list(samples.keys()), index=list(samples.values()))
+            tables = [load_table(os.path.join(self.path, meta["main"]))] if meta["main"] else []
+            tables += [load_table(os.path.join(self.segments_path, "{:06d}".format(n))) for n in self.segments(meta)]
+            parts = []
+            for table in tables:
+                taxid = table["taxID"]
+                if taxids is None:
+                    index = np.arange(len(taxid))
+                else:
+                    # tables are sorted by taxID
+                    lo = np.searchsorted(taxid, taxids, side="left")
+                    hi = np.searchsorted(taxid, taxids, side="right")
+                    index = np.concatenate([np.arange(l, h) for l, h in zip(lo, hi)] + [np.zeros(0, dtype=np.int64)])
+                part = pd.DataFrame({c: np.asarray(table[c][index]) for c in COLUMNS})
+                parts.append(part.loc[part["sample"].isin(names.index)])
+        if not parts:
+            return pd.DataFrame(columns=COLUMNS)
+        df = pd.concat(parts, ignore_index=True)
+        df["sample"] = names.reindex(df["sample"].values).values
+        return df.sort_values(["taxID", "sample"]).reset_index(drop=True)
+
+def krona_inputs(store, outdir, samples=None):
+    """
+    Write {outdir}/{sample}.krona.tsv (percent, reads, reads, rank, taxID, name)
+    for ktImportTaxonomy -t 5 -m 3, with the kreport taxon reads of the sample
+    """
+    os.makedirs(outdir, exist_ok=True)
+    df = store.rows()
+    taxa = store.taxa()
+    df = df.assign(taxRank=taxa.taxRank.reindex(df.taxID).values, name=taxa.name.reindex(df.taxID).values)
+    samples = samples or sorted(store.samples())
+    for sample in samples:
+        rows = df.loc[df["sample"] == sample]
+        metric = "kreportReads"
+        if rows.kreportReads.isnull().all():
+            sys.stderr.write("WARNING: {} was appended without --kreport, its chart shows the numReads of its report\n".format(sample))
+            metric = "numReads"
+        rows = rows.loc[rows[metric] > 0]
+        out = pd.DataFrame({"percent": (100 * rows[metric] / rows[metric].sum()).round(2),
+                            "clade_reads": rows[metric].astype(np.int64),
+                            "taxon_reads": rows[metric].astype(np.int64),
+                            "rank": rows.taxRank, "taxID": rows.taxID, "name": rows["name"]})
+        out.to_csv(os.path.join(outdir, sample + ".krona.tsv"), sep="\t", index=False, header=False)
+    return samples
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    append = subparsers.add_parser("append", help="Append the results of a sample, replacing earlier ones.")
+    append.add_argument("--store", type=str, required=True,
+                        help="Cohort store directory, created if missing.")
+    append.add_argument("--sample", type=str, required=True,
+                        help="Sample name.")
+    append.add_argument("--lineage", type=str, required=True,
+                        help="Taxa lineage report of the sample (parse_centrifuge.py).")
+    append.add_argument("--kreport", type=str,
+                        help="Centrifuge-kreport of the sample, for the taxon reads shown in the Krona charts.")
+    append.add_argument("--sourmash", type=str,
+                        help="Sourmash coverage of the filtered genomes of the sample.")
+    append.add_argument("--genomes", type=str,
+                        help="Filtered genomes of the sample, to assign the sourmash coverage to taxa.")
+    append.add_argument("--coverage", type=str,
+                        help="Per-taxon mapping statistics of the sample (bam_coverage.py).")
+    append.add_argument("--max_segments", type=int, default=MAX_SEGMENTS,
+                        help="Merge the appended segments into the main table beyond this many (default = {})".format(MAX_SEGMENTS))
+    query = subparsers.add_parser("query", help="Rows of the samples with a taxon, optionally above a value of a metric.")
+    query.add_argument("--store", type=str, required=True,
+                       help="Cohort store directory.")
+    query.add_argument("--taxid", type=int, nargs="+", required=True,
+                       help="Taxonomy ids.")
+    query.add_argument("--metric", type=str, default="abundance", choices=METRICS,
+                       help="Metric of the --min threshold (default = abundance)")
+    query.add_argument("--min", type=float,
+                       help="Only samples with at least this value of --metric.")
+    query.add_argument("--out", type=str,
+                       help="Output table (default = stdout).")
+    matrix = subparsers.add_parser("matrix", help="Samples x taxa table of a metric.")
+    matrix.add_argument("--store", type=str, required=True,
+                        help="Cohort store directory.")
+    matrix.add_argument("--metric", type=str, default="abundance", choices=METRICS,
+                        help="Metric (default = abundance)")
+    matrix.add_argument("--out", type=str, required=True,
+                        help="Output table, one row per sample and one column per taxon.")
+    krona = subparsers.add_parser("krona", help="Krona input of each sample.")
+    krona.add_argument("--store", type=str, required=True,
+                       help="Cohort store directory.")
+    krona.add_argument("--samples", type=str, nargs="+",
+                       help="Samples (default = all).")
+    krona.add_argument("--outdir", type=str, required=True,
+                       help="Output directory of the {sample}.krona.tsv files.")
+    compact = subparsers.add_parser("compact", help="Merge the appended segments into the main table.")
+    compact.add_argument("--store", type=str, required=True,
+                         help="Cohort store directory.")
+    args = parser.parse_args()
+
+    if args.command == "append":
+        rows, taxa = sample_rows(args.lineage, args.sourmash, args.genomes, args.coverage, args.kreport)
+        store = CohortStore(args.store)
+        code = store.append(args.sample, rows, taxa, args.max_segments)
+        sys.stderr.write("Appended {} taxa of {} to {} (code {})\n".format(len(rows), args.sample, args.store, code))
+    elif args.command == "query":
+        df = CohortStore(args.store).rows(np.unique(args.taxid))
+        if args.min is not None:
+            df = df.loc[df[args.metric] >= args.min]
+        df.to_csv(args.out or sys.stdout, sep="\t", index=False)
+    elif args.command == "matrix":
+        df = CohortStore(args.store).rows()
+        df.pivot(index="sample", columns="taxID", values=args.metric).to_csv(args.out, sep="\t")
+    elif args.command == "krona":
+        samples = krona_inputs(CohortStore(args.store), args.outdir, args.samples)
+        sys.stderr.write("Wrote the Krona input of {} samples to {}\n".format(len(samples), args.outdir))
+    elif args.command == "compact":
+        store = CohortStore(args.store)
+        with locked(store.lock):
+            store.compact()
+    else:
+        parser.error("one of append, query, matrix, krona or compact is required")
+
+if __name__ == '__main__':
+    main()
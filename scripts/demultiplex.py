@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from centrifuge_store import read_chunks
+import pandas as pd
+import numpy as np
+import gzip
+import sys
+import os
+
+def open_fastq(fp):
+    if fp.endswith(".gz"):
+        return gzip.open(fp, "rt")
+    return open(fp, "r")
+
+def hash_ids(ids):
+    """64-bit hashes of read ids, used as a compact membership index"""
+    return pd.util.hash_pandas_object(pd.Series(ids, dtype=object), index=False).values
+
+def read_viral_hits(taxidHitFolder):
+    """Dictionary of read id -> viral taxids from the {taxid}.txt files of parse_centrifuge.py"""
+    viral = {}
+    for f in os.listdir(taxidHitFolder):
+        if not f.endswith(".txt"):
+            continue
+        taxid = f[:-len(".txt")]
+        with open(os.path.join(taxidHitFolder, f)) as fh:
+            for line in fh:
+                readid = line.rstrip()
+                if readid:
+                    viral.setdefault(readid, []).append(taxid)
+    return viral
+
+def nonviral_index(outfile, host_taxid, chunksize):
+    """
+    Sorted hashes of the ids of reads classified by centrifuge to anything but
+    the host, unclassified (0) or root (1)
+    """
+    hashes = []
+    filters = [("taxID", "not in", [int(host_taxid), 0, 1])]
+    for chunk in read_chunks(outfile, ["readID"], filters, chunksize):
+        hashes.append(np.unique(hash_ids(chunk.readID.values)))
+    if not hashes:
+        return np.zeros(0, dtype=np.uint64)
+    return np.unique(np.concatenate(hashes))
+
+def read_fastq_batches(fastq, batchsize):
+    """Yield lists of (read id, 4-line record) from a FASTQ file"""
+    batch = []
+    with open_fastq(fastq) as fh:
+        while True:
+            header = fh.readline()
+            if not header:
+                break
+            record = header + fh.readline() + fh.readline() + fh.readline()
+            batch.append((header[1:].split(None, 1)[0], record))
+            if len(batch) >= batchsize:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def demultiplex(args):
+    viral = read_viral_hits(args.taxidHitFolder)
+    sys.stderr.write("{} viral hit reads in {}\n".format(len(viral), args.taxidHitFolder))
+    nonviral = nonviral_index(args.centrifuge_out, args.host_taxid, args.chunksize)
+    sys.stderr.write("{} classified non-host reads in {}\n".format(len(nonviral), args.centrifuge_out))
+
+    # per-taxon FASTQ files are appended batch by batch, so start from empty files
+    for taxid in set(t for taxa in viral.values() for t in taxa):
+        open(os.path.join(args.taxidHitFolder, taxid + ".fq"), "w").close()
+
+    num_reads = num_viral = num_nonviral = 0
+    with open(args.viral, "w") as viral_fq, open(args.nonviral, "w") as nonviral_fq, \
+         open(args.nonviral_ids, "w") as nonviral_ids:
+        for batch in read_fastq_batches(args.fastq, args.batchsize):
+            num_reads += len(batch)
+            hashes = hash_ids([readid for readid, record in batch])
+            pos = np.searchsorted(nonviral, hashes)
+            pos[pos >= len(nonviral)] = 0
+            classified = (nonviral[pos] == hashes) if len(nonviral) else np.zeros(len(batch), dtype=bool)
+            by_taxon = {}
+            for (readid, record), hit in zip(batch, classified):
+                taxa = viral.get(readid)
+                if taxa is not None:
+                    viral_fq.write(record)
+                    num_viral += 1
+                    for taxid in taxa:
+                        by_taxon.setdefault(taxid, []).append(record)
+                elif hit:
+                    nonviral_fq.write(record)
+                    nonviral_ids.write(readid + "\n")
+                    num_nonviral += 1
+            for taxid, records in by_taxon.items():
+                with open(os.path.join(args.taxidHitFolder, taxid + ".fq"), "a") as fh:
+                    fh.writelines(records)
+    sys.stderr.write("{} reads: {} viral hits, {} non-viral hits\n".format(num_reads, num_viral, num_nonviral))
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--fastq", type=str, required=True,
+                        help="Sample reads in FASTQ format.")
+    parser.add_argument("--centrifuge_out", type=str, required=True,
+                        help="Centrifuge output, or its store directory (see centrifuge_store.py).")
+    parser.add_argument("--taxidHitFolder", type=str, required=True,
+                        help="A filefoler with readIDs for each viral taxid hit, per-taxid FASTQ files are written here.")
+    parser.add_argument("--host_taxid", type=str, required=True,
+                        help="Host taxonomy id that will be excluded.")
+    parser.add_argument("--viral", type=str, required=True,
+                        help="Output FASTQ of viral hit reads.")
+    parser.add_argument("--nonviral", type=str, required=True,
+                        help="Output FASTQ of non-viral, non-host classified reads.")
+    parser.add_argument("--nonviral_ids", type=str, required=True,
+                        help="Output read ids of the non-viral reads.")
+    parser.add_argument("--chunksize", type=int, default=1000000,
+                        help="Number of centrifuge output lines read at a time (default = 1000000)")
+    parser.add_argument("--batchsize", type=int, default=100000,
+                        help="Number of FASTQ records processed at a time (default = 100000)")
+    args = parser.parse_args()
+
+    demultiplex(args)
+
+if __name__ == '__main__':
+    main()
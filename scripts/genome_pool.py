@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+Persistent, append-only pool of the reference genomes selected for a cohort.
+
+The filtered genomes of the samples of a cohort overlap heavily, and a
+cohort grows a few samples at a time, so each record is extracted from the
+centrifuge library (a seqstore.py store) once, into a pool shared by all
+samples and runs:
+    genomes.fna    FASTA records, appended as new genomes are selected
+    index.tsv      seqid, start and length of each record in genomes.fna,
+                   and its start in the library, the order of the views
+    library.json   the library store the records come from; the pool is
+                   emptied when the store changes
+    pool.lock      appends hold an exclusive lock, views a shared one
+
+Records are appended before their index lines, and a pool opened after an
+interrupted append is truncated to its indexed records.
+
+    python scripts/genome_pool.py fetch --pool pool --store input-sequences.store --seqids seqids.txt --out genomes.fna
+fetch first appends the requested records missing from the pool, then
+writes the requested records from the pool, in library order.
+"""
+
+from argparse import ArgumentParser
+from seqstore import SeqStore, read_seqids
+from bt2cache import locked
+import json
+import sys
+import os
+
+class GenomePool(object):
+    def __init__(self, path, library):
+        self.path = path
+        self.library = library
+        self.fasta = os.path.join(path, "genomes.fna")
+        self.index_file = os.path.join(path, "index.tsv")
+        self.meta_file = os.path.join(path, "library.json")
+        self.lock = os.path.join(path, "pool.lock")
+        os.makedirs(path, exist_ok=True)
+
+    def library_id(self):
+        """Path of the library store, and size and mtime of its index"""
+        st = os.stat(os.path.join(self.library, "hash.npy"))
+        return {"store": os.path.realpath(self.library), "size": st.st_size, "mtime": int(st.st_mtime)}
+
+    def read_index(self):
+        """seqid -> [(library start, start, length)] of its records in the pool"""
+        index = {}
+        if not os.path.exists(self.index_file):
+            return index
+        with open(self.index_file) as fh:
+            for line in fh:
+                # a line without newline is left by an interrupted append
+                if not line.endswith("\n"):
+                    break
+                seqid, start, length, library_start = line.rstrip("\n").split("\t")
+                index.setdefault(seqid, []).append((int(library_start), int(start), int(length)))
+        return index
+
+    def recover(self):
+        """
+        Index of the pool, after emptying it if the library changed and
+        dropping what an interrupted append left; the exclusive lock is held
+        """
+        library = self.library_id()
+        known = None
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as fh:
+                known = json.load(fh)
+        if known != library:
+            if known is not None:
+                sys.stderr.write("WARNING: the library store changed, emptying the genome pool {}\n".format(self.path))
+            for fp in (self.fasta, self.index_file):
+                if os.path.exists(fp):
+                    os.remove(fp)
+            with open(self.meta_file, "w") as fh:
+                json.dump(library, fh)
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "rb+") as fh:
+                data = fh.read()
+                fh.truncate(data.rfind(b"\n") + 1)
+        index = self.read_index()
+        end = max([start + length for records in index.values() for _, start, length in records] or [0])
+        if os.path.exists(self.fasta) and os.path.getsize(self.fasta) > end:
+            with open(self.fasta, "rb+") as fh:
+                fh.truncate(end)
+        return index
+
+    def add(self, seqids):
+        """Append the records of seqids missing from the pool; returns the number of records appended"""
+        with locked(self.lock):
+            index = self.recover()
+            missing = sorted(set(seqids) - set(index))
+            if not missing:
+                return 0
+            store = SeqStore(self.library)
+            library_starts = store.locate(missing)[0]
+            lines = []
+            with open(self.fasta, "ab") as fh:
+                pos = fh.tell()
+                for library_start, record in zip(library_starts.tolist(), store.fetch(missing)):
+                    if not record.endswith(b"\n"):
+                        record += b"\n"
+                    seqid = record[1:record.index(b"\n")].split(None, 1)[0].decode("utf-8")
+                    fh.write(record)
+                    lines.append("{}\t{}\t{}\t{}\n".format(seqid, pos, len(record), library_start))
+                    pos += len(record)
+                fh.flush()
+                os.fsync(fh.fileno())
+            with open(self.index_file, "a") as fh:
+                fh.write("".join(lines))
+            return len(lines)
+
+    def write_fasta(self, seqids, output):
+        """Write the records of seqids in the pool to a FASTA file, in library order; returns the number of records"""
+        with locked(self.lock, shared=True):
+            index = self.read_index()
+            records = sorted(set(r for seqid in set(seqids) for r in index.get(seqid, [])))
+            missing = [seqid for seqid in set(seqids) if seqid not in index]
+            if missing:
+                sys.stderr.write("WARNING: {} sequence ids are not in the genome pool {}, e.g. {}\n".format(
+                    len(missing), self.path, missing[0]))
+            with open(output, "wb") as fhout:
+                if records:
+                    with open(self.fasta, "rb") as fh:
+                        for _, start, length in records:
+                            fh.seek(start)
+                            fhout.write(fh.read(length))
+        return len(records)
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    fetch = subparsers.add_parser("fetch", help="Extract records through the genome pool.")
+    fetch.add_argument("--pool", type=str, required=True,
+                       help="Genome pool directory, created if missing.")
+    fetch.add_argument("--store", type=str, required=True,
+                       help="Sequence store of the library (see seqstore.py).")
+    fetch.add_argument("--seqids", type=str, required=True,
+                       help="File with one sequence id per line.")
+    fetch.add_argument("--out", type=str, required=True,
+                       help="Output FASTA file.")
+    args = parser.parse_args()
+
+    if args.command == "fetch":
+        seqids = read_seqids(args.seqids)
+        pool = GenomePool(args.pool, args.store)
+        added = pool.add(seqids)
+        n = pool.write_fasta(seqids, args.out)
+        sys.stderr.write("Added {} records to the genome pool {}, extracted {} records to {}\n".format(
+            added, args.pool, n, args.out))
+    else:
+        parser.error("fetch is required")
+
+if __name__ == '__main__':
+    main()
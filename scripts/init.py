@@ -45,7 +45,6 @@ def _write_samples_csv(samples, out):
 def build_sample_list(data_fp, format_str, output_file, is_single_end):
 
     data_fp = data_fp.resolve()
-    fnames = [f.name for f in data_fp.iterdir() if f.is_file()]
 
     if not format_str:
         format_str = "{sample}.bam"
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+"""
+Interval arithmetic shared by the coverage scripts (parse_ARG.py,
+bam_coverage.py), kept free of their plotting and CLI dependencies.
+"""
+
+import numpy as np
+
+def covered_length(keys, starts, ends):
+    """
+    Total length covered by the half-open intervals [start, end) of each
+    group (keys 0..n-1), overlaps counted once. Sort the intervals by group
+    and start, shift each group to its own coordinate block and sweep once
+    with a running maximum of the ends.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    ngroups = keys.max() + 1 if len(keys) else 0
+    valid = ends > starts
+    keys, starts, ends = keys[valid], starts[valid], ends[valid]
+    if len(keys) == 0:
+        return np.zeros(ngroups, dtype=np.int64)
+    offset = ends.max() - min(starts.min(), 0) + 1
+    starts = starts + keys*offset
+    ends = ends + keys*offset
+    order = np.lexsort((starts, keys))
+    keys, starts, ends = keys[order], starts[order], ends[order]
+    reach = np.maximum.accumulate(ends)
+    # an interval opens a new segment when it starts beyond everything before it
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > reach[:-1]
+    first = np.nonzero(new)[0]
+    seg_len = np.maximum.reduceat(ends, first) - starts[first]
+    return np.bincount(keys[first], weights=seg_len, minlength=ngroups).astype(np.int64)
@@ -5,6 +5,8 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import click
+from intervals import covered_length
+from stagetimer import StageTimer
 
 def arg_png(out_png, arg_pd):
     #1 药物类型饼图
@@ -35,77 +37,50 @@ def read_amr_len(ARG_length):
         d_arg_avg_len[k]=avg
     return d_arg_avg_len
 
-#去除覆盖区间的overlap区域,计算ARG的cover region
-def cover_region_depth(num_list):
-    '''
-    输入：线段起点、终点
-    输出：总的覆盖长度
-    '''
-    start=10000
-    end=0
-    for one_list in num_list:
-        if one_list[0]<start:
-            start=one_list[0]
-        if one_list[1]>end:
-            end=one_list[1]
-    #print start, end
-    flag=['false']*end
-    for i in range(len(num_list)):
-        for j in range(num_list[i][0], num_list[i][1]):
-            flag[j]=True
-    #print flag
-    return flag.count(True)
+def arg_table(arg_pd, d_arg_avg_len):
+    columns = ['predicted_ARG-class','ARG','num_reads','covered_length','ARG_length','perc_covered','perc_identity']
+    if arg_pd.empty:
+        final = pd.DataFrame(columns=columns)
+        return final
+    arg, start, end, identity = arg_pd.columns[[0, 1, 2, 7]]
 
-def arg_table(deeparg_file, arg_pd, d_arg_avg_len):
     #2 drug class ARG的reads数
-    drug_class_arg=arg_pd.loc[:, ['predicted_ARG-class','#ARG','counts']]
-    arg_count=drug_class_arg.groupby(['predicted_ARG-class','#ARG'],as_index=False).sum()
-    if arg_count.empty:
-        final = pd.DataFrame(columns=['predicted_ARG-class','ARG','num_reads','covered_length','ARG_length','perc_covered','perc_identity'])
-        return final
+    arg_count=arg_pd.groupby(['predicted_ARG-class', arg], as_index=False)['counts'].sum()
 
     #3 计算cover、深度、相似度
-    d_arg_cover={}
-    d_arg_identity={}
-    with open (deeparg_file,'r') as f:
-        next(f)  # skip the first line.
-        for line in f:    
-            info=line.rstrip().split()
-            #temp=[]
-            temp=[int(info[1]),int(info[2])]
-            #d_arg_reads[info[0]]+=1
-            d_arg_cover.setdefault(info[0],[]).append(temp)
-            d_arg_identity.setdefault(info[0],[]).append(float(info[7]))
-    #d_arg_avg_len=read_amr_len(test2)
-
-    temp_list = []
-    for arg in d_arg_cover.keys():
-        cover_len=cover_region_depth(d_arg_cover[arg])
-        cover_p=format(cover_len*100/d_arg_avg_len[arg],'.1f')
-        id=max(d_arg_identity[arg])
-        #cover_p=cover_len/read_amr_len(arg)
-        #print("%s\t%d\t%.2f%%\t%.2f%%" % (arg, cover_region_depth(d_arg_cover[arg]),cover_p,id))
-        temp_list.append([arg, cover_region_depth(d_arg_cover[arg]),d_arg_avg_len[arg],cover_p,id])
-    cover_id_pd=pd.DataFrame(temp_list,columns=['#ARG', 'covered_length','gene_length','perc_covered', 'perc_identity'])
-    final=pd.merge(arg_count, cover_id_pd, on='#ARG')
+    codes, args = pd.factorize(arg_pd[arg])
+    cover_id_pd = pd.DataFrame({'#ARG': args,
+                                'covered_length': covered_length(codes, arg_pd[start].values, arg_pd[end].values),
+                                'perc_identity': arg_pd.groupby(codes)[identity].max().values})
+    cover_id_pd['gene_length'] = cover_id_pd['#ARG'].map(d_arg_avg_len)
+    cover_id_pd['perc_covered'] = [format(p,'.1f') for p in cover_id_pd.covered_length*100/cover_id_pd.gene_length]
+    cover_id_pd = cover_id_pd[['#ARG', 'covered_length','gene_length','perc_covered', 'perc_identity']]
+    final=pd.merge(arg_count.rename(columns={arg:'#ARG'}), cover_id_pd, on='#ARG')
     final=final.rename(columns={'counts':'num_reads','#ARG':'ARG', 'gene_length': 'ARG_length'})
-    return final
+    return final[columns]
 
 @click.command()
 @click.option('--deeparg_file', help='the deeparg results as: XXX.mapping.ARG')
 @click.option('--out_table', help='The output ARG table.')
 @click.option('--out_png', help='The output ARG drug class png.')
 @click.option('--features_gene_length', default="./data/database/v2/features.gene.length", help='The database ARG length file.')
+@click.option('--timings', default=None, help='Write the wall time and peak memory of each stage to this table.')
 
-def main(features_gene_length, deeparg_file, out_png, out_table):
+def main(features_gene_length, deeparg_file, out_png, out_table, timings):
+    timer = StageTimer("parse_ARG", timings)
     #features_gene_length="./data/database/v2/features.gene.length"
-    d_arg_avg_len=read_amr_len(features_gene_length)
-    arg_pd=pd.read_table(deeparg_file, header=0)
-    arg_png(out_png, arg_pd)
-    final=arg_table(deeparg_file, arg_pd, d_arg_avg_len)
+    with timer.stage("load"):
+        d_arg_avg_len=read_amr_len(features_gene_length)
+        arg_pd=pd.read_csv(deeparg_file, header=0, sep="\t")
+    with timer.stage("plot"):
+        arg_png(out_png, arg_pd)
+    with timer.stage("coverage"):
+        final=arg_table(arg_pd, d_arg_avg_len)
     #xls=open(out_table,'w')
     #xls.write(final)
-    final.to_csv(out_table,sep="\t",index=False)
+    with timer.stage("write"):
+        final.to_csv(out_table,sep="\t",index=False)
+    timer.save()
 
 if __name__=="__main__":
     main()
\ No newline at end of file
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
 from argparse import ArgumentParser
-from ete3 import NCBITaxa
+from taxtable import open_taxtable
+from stagetimer import StageTimer
+from centrifuge_store import read_chunks
 import pandas as pd
 import sys
-import re
+import os
+
+# columns of the centrifuge classification output used for counting
+OUT_COLUMNS = ["readID", "taxID", "score", "hitLength", "numMatches"]
 
 def read_centrifuge_report(reportfile):
     df = pd.read_csv(reportfile, header=0, sep="\t")
@@ -12,103 +17,112 @@ def read_centrifuge_report(reportfile):
     genomesizes = tmp.to_dict()["genomeSize"]
     return df, genomesizes
 
+def centrifuge_filters(args):
+    """Row filters of the centrifuge output, pushed down to the row groups of a store"""
+    filters = []
+    if args.unique:     filters.append(("numMatches", "==", 1))
+    if args.min_score:  filters.append(("score", ">=", int(args.min_score)))
+    if args.min_length: filters.append(("hitLength", ">=", int(args.min_length)))
+    if args.host_taxid: filters.append(("taxID", "!=", int(args.host_taxid)))
+    return filters
+
+class TaxaCounter(object):
+    """
+    Accumulate per-taxon read counts, aligned length and score over chunks
+    of the centrifuge output, so that memory is bounded by the number of
+    taxa rather than the number of reads.
+    """
+    def __init__(self):
+        self.totals = None
+        self.num_reads = 0
+
+    def update(self, df):
+        df = df.assign(count = 1/df.numMatches, aligned = df.hitLength/df.numMatches)
+        agg = df.groupby("taxID")[["count", "aligned", "score"]].sum()
+        if self.totals is None:
+            self.totals = agg.astype(float)
+        else:
+            self.totals = self.totals.add(agg, fill_value=0)
+        self.num_reads += len(df)
+        return agg
 
-def read_centrifuge_result(args):
-    taxa_counts = {}
-    df = pd.read_csv(args.infile, header=0, sep="\t")
-    if args.host_taxid: df = df.loc[df.taxID != int(args.host_taxid)]
-    if args.unique:     df = df.loc[df.numMatches == 1]
-    if args.min_length: df = df.loc[df.hitLength >= int(args.min_length)]
-    if args.min_score:  df = df.loc[df.score >= int(args.min_score)]
-    
-    df['count'] = 1/df.numMatches
-    df['aligned'] = df.hitLength/df.numMatches
-    
-    taxids = list(set([ taxid for taxid in df.taxID]))
-    
-    for taxID in taxids:
-        if not taxID in taxa_counts.keys():
-                taxa_counts[taxID] = {"count": 0, "aligned": 0, "score":0, "readID": "" }
-        
-        taxa_counts[taxID]["count"] = int(sum(df.loc[df.taxID == taxID,'count']))
-        taxa_counts[taxID]["aligned"] = sum(df.loc[df.taxID == taxID,'aligned'])
-        taxa_counts[taxID]["score"] = int(sum(df.loc[df.taxID == taxID,'score']))
-        taxa_counts[taxID]["readID"] = ",".join(df.loc[df.taxID == taxID,'readID'])
-        
-    return taxa_counts
-
-def generate_ete3db(taxdbfile):
-    taxdb = NCBITaxa(taxdbfile)
-    return taxdb
-
-def get_lineage_names(lineage, taxdb):
-    ranks = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
-    names = {}
-    for rank in ranks:
-        names[rank] = "unclassified"
-    for id, rank in lineage.items():
-        if rank not in ranks:
+    def table(self):
+        if self.totals is None:
+            taxa_counts = pd.DataFrame(columns=["count", "aligned", "score"], dtype=float)
+            taxa_counts.index.name = "taxID"
+        else:
+            taxa_counts = self.totals.copy()
+        taxa_counts["count"] = taxa_counts["count"].astype(int)
+        taxa_counts["score"] = taxa_counts["score"].astype(int)
+        return taxa_counts
+
+def spill_read_ids(df, keep_taxid, outdir):
+    """Append read ids of the taxa selected by keep_taxid to {outdir}/{taxid}.txt"""
+    for taxid, readids in df.groupby("taxID")["readID"]:
+        if not keep_taxid(taxid):
             continue
-        name = taxdb.translate_to_names([id])[0]
-        if rank == "superkingdom": names[rank] = "k__" + name
-        if rank == "phylum": names[rank] = "p__" + name
-        if rank == "class": names[rank] = "c__" + name
-        if rank == "order": names[rank] = "o__" + name
-        if rank == "family": names[rank] = "f__" + name
-        if rank == "genus": names[rank] = "g__" + name
-        if rank == "species": names[rank] = "s__" + name
-    name_string = ""
-    for rank in ranks:
-        if rank == "species": name_string+="{}".format(names[rank])
-        else: name_string+="{}|".format(names[rank])
-    return name_string
-
-def generate_taxlineage_table(taxa_counts, reportdf, args, genomesizes):
-    taxdb = generate_ete3db(args.taxdb)
-    lineage_dict = {}
-    with open(args.reportTaxalineage, 'w') as fhout:
-        fhout.write("name\ttaxID\ttaxRank\tgenomeSize\tnumReads\tnumUniqueReads\tabundance\ttaxaLineage\ttotalScore\talignedNorm\n");
-        for taxid in taxa_counts.keys():
-            try:
-                name_string = lineage_dict[taxid]
-            except KeyError:
-                try:
-                    lineage = taxdb.get_rank(taxdb.get_lineage(taxid))
-                    name_string = get_lineage_names(lineage, taxdb)
-                except ValueError:
-                    name_string = "|".join(["Unknown"]*7)
-                lineage_dict[taxid] = name_string
-            count = taxa_counts[taxid]["count"]
-            aligned = taxa_counts[taxid]["aligned"]
-            score = taxa_counts[taxid]['score']
-            report = reportdf.loc[reportdf['taxID'] == int(taxid) ]
-            report = report.values.tolist()
-            report = report[0]
-            if args.normalize and genomesizes:
-                try:
-                    genomesize = genomesizes[int(taxid)]
-                except KeyError:
-                    continue
-                # Normalized is aligned bases per kb of genome
-                try:
-                    norm = aligned / float(genomesize) * 1000
-                except ZeroDivisionError:
-                    norm = 0
-                fhout.write("{}\t{}\t{}\t{}\n".format("\t".join(map(str,report)), name_string,score,norm))
-            else:
-                fhout.write("{}\t{}\t{}\t{}\n".format("\t".join(map(str,report)), name_string,score,count))
-            
-            # for virus hits, extract mapped read ids
-            if re.search(r"k__Viruses",name_string):
-                #if taxa_counts[taxid]['count'] >= 3:
-                    with open(args.taxidHitFolder + "/" + str(taxid) + ".txt","w") as readIDFile:
-                        readIDFile.write(taxa_counts[taxid]['readID'].replace(",","\n") )
-                        readIDFile.write("\n")
-            
+        with open(os.path.join(outdir, str(taxid) + ".txt"), "a") as readIDFile:
+            readIDFile.write("\n".join(readids))
+            readIDFile.write("\n")
+
+def read_centrifuge_result(args, keep_taxid=None):
+    """
+    Stream the centrifuge output (text or centrifuge_store.py store) in chunks
+    and aggregate it with one groupby per chunk.
+    When keep_taxid is given, read ids of the matching taxa are written to
+    args.taxidHitFolder as they are seen instead of being kept in memory.
+    """
+    counter = TaxaCounter()
+    spill = keep_taxid is not None and args.taxidHitFolder
+    if spill:
+        # read ids are appended chunk by chunk, so start from empty files
+        for f in os.listdir(args.taxidHitFolder):
+            if f.endswith(".txt"):
+                os.remove(os.path.join(args.taxidHitFolder, f))
+    usecols = OUT_COLUMNS if spill else OUT_COLUMNS[1:]
+    for chunk in read_chunks(args.infile, usecols, centrifuge_filters(args), args.chunksize):
+        counter.update(chunk)
+        if spill:
+            spill_read_ids(chunk, keep_taxid, args.taxidHitFolder)
+    return counter.table()
+
+def viral_taxa(taxtable):
+    """Return a memoized taxid -> bool function selecting viral hits"""
+    viral = {}
+    def is_viral(taxid):
+        try:
+            return viral[taxid]
+        except KeyError:
+            viral[taxid] = taxtable.superkingdom([taxid])[0] == "Viruses"
+            return viral[taxid]
+    return is_viral
+
+def generate_taxlineage_table(taxa_counts, reportdf, args, genomesizes, taxtable, timer=None):
+    timer = timer or StageTimer("parse_centrifuge")
+    report = reportdf.drop_duplicates("taxID").set_index("taxID", drop=False)
+    missing = taxa_counts.index.difference(report.index)
+    if len(missing) > 0:
+        sys.stderr.write("WARNING: {} taxa missing from centrifuge report\n".format(len(missing)))
+    with timer.stage("lineage"):
+        # indexed join of the counts against the report, one row per taxon
+        table = report.join(taxa_counts, how="inner")
+        table["taxaLineage"] = taxtable.lineage_names(table.taxID.values)
+    table["totalScore"] = table["score"]
+    if args.normalize and genomesizes:
+        # Normalized is aligned bases per kb of genome
+        genomesize = table.genomeSize.astype(float)
+        norm = table.aligned / genomesize * 1000
+        table["alignedNorm"] = norm.where(genomesize != 0, 0)
+    else:
+        table["alignedNorm"] = table["count"]
+    columns = list(reportdf.columns) + ["taxaLineage", "totalScore", "alignedNorm"]
+    with timer.stage("write"):
+        table[columns].to_csv(args.reportTaxalineage, sep="\t", index=False)
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("-i", "--infile", type=str, required=True,
-                        help="Centrifuge output.")
+                        help="Centrifuge output, or its store directory (see centrifuge_store.py).")
     parser.add_argument("-r", "--reportfile", type=str,
                         help="Centrifuge report file.")
     parser.add_argument("--reportTaxalineage", type=str,
@@ -121,29 +135,41 @@ def main():
                         help="Require a minimum score for reads to be counted")
     parser.add_argument("--min_length", type=int,
                         help="Require a minimum alignment length to the read")
-    parser.add_argument("--taxdb", type=str,
-                        help="Ete3 sqlite database file or path to one that will be created.")
+    parser.add_argument("--taxdb", type=str, required=True,
+                        help="Compiled taxonomy table of the ete3 sqlite database (see taxtable.py).")
     parser.add_argument("--host_taxid", type=str,
                         help="Host taxonomy id that will be excluded.")
     parser.add_argument("--taxidHitFolder", type=str,
                         help="A filefoler to put readIDs for each taxid hit.")
+    parser.add_argument("--chunksize", type=int, default=1000000,
+                        help="Number of centrifuge output lines read at a time (default = 1000000)")
+    parser.add_argument("--timings", type=str,
+                        help="Write the wall time and peak memory of each stage to this table.")
     #parser.add_argument("--ranksplit", action="store_true",
     #                    help="")
 
     args = parser.parse_args()
 
+    timer = StageTimer("parse_centrifuge", args.timings)
+    with timer.stage("load"):
+        taxtable = open_taxtable(args.taxdb)
+
     sys.stderr.write("Reading centrifuge results\n")
-    taxa_counts = read_centrifuge_result(args)
+    with timer.stage("aggregate"):
+        # for virus hits, extract mapped read ids
+        taxa_counts = read_centrifuge_result(args, keep_taxid=viral_taxa(taxtable))
     sys.stderr.write("{} taxa parsed\n".format(len(taxa_counts)))
 
     if args.reportfile:
-        reportdf, genomesizes = read_centrifuge_report(args.reportfile)
+        with timer.stage("report"):
+            reportdf, genomesizes = read_centrifuge_report(args.reportfile)
     else:
         genomesizes = False
 
     if args.reportTaxalineage:
-        generate_taxlineage_table(taxa_counts, reportdf, args, genomesizes)
+        generate_taxlineage_table(taxa_counts, reportdf, args, genomesizes, taxtable, timer)
+    timer.save()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
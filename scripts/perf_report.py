@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Per-sample performance table of a workflow run.
+
+Collects the benchmark files of the rules and the stage timings of the
+scripts (see stagetimer.py) from the benchmark folder:
+    {rule}.tsv                 jobs without wildcards
+    {rule}/{sample}.tsv        jobs of a sample
+    {rule}/{sample}.stages.tsv stages of the script run by the job
+and writes one row per job and per script stage, with the share of the
+sample's total job time and the slowest jobs and stages flagged. With
+--since, only jobs that finished after that time (the start of the run)
+are included.
+
+    python scripts/perf_report.py --benchmarks results/benchmarks --out performance.tsv --json performance.json
+"""
+
+from argparse import ArgumentParser
+import pandas as pd
+import datetime
+import glob
+import json
+import sys
+import os
+
+COLUMNS = ["sample", "rule", "stage", "s", "cpu_time", "max_rss", "io_in", "io_out",
+           "finished", "share", "rank", "slowest"]
+
+def read_table(fp):
+    try:
+        return pd.read_csv(fp, sep="\t")
+    except (pd.errors.EmptyDataError, pd.errors.ParserError):
+        sys.stderr.write("WARNING: skipping unreadable benchmark file {}\n".format(fp))
+        return None
+
+def collect(benchdir, since=None):
+    """Rows of rule-level jobs and script stages below benchdir"""
+    rows = []
+    files = glob.glob(os.path.join(benchdir, "*.tsv")) + glob.glob(os.path.join(benchdir, "*", "*.tsv"))
+    for fp in sorted(files):
+        mtime = os.path.getmtime(fp)
+        if since and mtime < since:
+            continue
+        rel = os.path.relpath(fp, benchdir).split(os.sep)
+        stages = fp.endswith(".stages.tsv")
+        name = rel[-1][:-len(".stages.tsv")] if stages else rel[-1][:-len(".tsv")]
+        rule, sample = (rel[0], name) if len(rel) == 2 else (name, "")
+        df = read_table(fp)
+        if df is None or df.empty:
+            continue
+        finished = datetime.datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S")
+        if stages:
+            for stage in df.itertuples(index=False):
+                rows.append({"sample": sample, "rule": rule, "stage": "{}:{}".format(stage.script, stage.stage),
+                             "s": stage.s, "cpu_time": stage.cpu_time, "max_rss": stage.max_rss,
+                             "finished": finished})
+        else:
+            # repeated benchmarks of a job are averaged; columns missing in older snakemake versions are left empty
+            mean = df.select_dtypes("number").mean()
+            row = {"sample": sample, "rule": rule, "stage": "", "finished": finished}
+            for column in ("s", "cpu_time", "max_rss", "io_in", "io_out"):
+                row[column] = mean.get(column, float("nan"))
+            rows.append(row)
+    return pd.DataFrame(rows, columns=COLUMNS[:-3])
+
+def summarize(df, top):
+    """Share of each job in its sample's total job time, and the top slowest jobs and stages flagged"""
+    df = df.copy()
+    jobs = df.stage == ""
+    totals = df.loc[jobs].groupby("sample").s.sum()
+    df["share"] = (df.s / df["sample"].map(totals)).round(4)
+    df["rank"] = 0
+    for mask in (jobs, ~jobs):
+        df.loc[mask, "rank"] = df.loc[mask, "s"].rank(ascending=False, method="first").astype(int)
+    # the top jobs and stages of the run, and the slowest job of every sample
+    slowest = (df["rank"] <= top)
+    per_sample = df.loc[jobs & (df["sample"] != "")].groupby("sample").s.idxmax()
+    slowest[per_sample.values] = True
+    df["slowest"] = slowest.map({True: "*", False: ""})
+    # jobs of a sample slowest first, each followed by the stages of its script
+    job_s = df.loc[jobs].set_index(["sample", "rule"]).s
+    df["job_s"] = [job_s.get((sample, rule), 0) for sample, rule in zip(df["sample"], df.rule)]
+    df["is_stage"] = ~jobs
+    df = df.sort_values(["sample", "job_s", "rule", "is_stage", "s"], ascending=[True, False, True, True, False])
+    return df[COLUMNS]
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--benchmarks", type=str, required=True,
+                        help="Folder of the benchmark files of the rules.")
+    parser.add_argument("--since", type=float,
+                        help="Only include jobs finished after this time (seconds since the epoch).")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of slowest jobs and stages flagged (default = 10)")
+    parser.add_argument("--out", type=str, required=True,
+                        help="Output table.")
+    parser.add_argument("--json", type=str,
+                        help="Output the table and the slowest jobs and stages as JSON.")
+    args = parser.parse_args()
+
+    df = collect(args.benchmarks, args.since)
+    if df.empty:
+        sys.stderr.write("No benchmark files found in {}\n".format(args.benchmarks))
+        df = pd.DataFrame(columns=COLUMNS)
+    else:
+        df = summarize(df, args.top)
+    df.to_csv(args.out, sep="\t", index=False, float_format="%.4g")
+
+    jobs = df.loc[df.stage == ""]
+    slowest = df.loc[df.slowest == "*"].sort_values("s", ascending=False)
+    if args.json:
+        records = lambda d: json.loads(d.to_json(orient="records"))
+        summary = {"generated": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                   "since": args.since,
+                   "samples": {sample: {"s": float(g.s.sum()), "slowest_rule": g.loc[g.s.idxmax(), "rule"]}
+                               for sample, g in jobs.groupby("sample") if sample},
+                   "slowest": records(slowest),
+                   "jobs": records(df)}
+        with open(args.json, "w") as fh:
+            json.dump(summary, fh, indent=2)
+
+    sys.stderr.write("{} jobs, {:.0f} s in total. Slowest:\n".format(len(jobs), jobs.s.sum()))
+    for row in slowest.head(args.top).itertuples(index=False):
+        sys.stderr.write("  {:>10.1f} s {:>8.0f} MB  {} {} {}\n".format(
+            row.s, row.max_rss, row.rule, row.sample, row.stage))
+
+if __name__ == '__main__':
+    main()
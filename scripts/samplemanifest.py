@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Sample list of a project, cached in a manifest of the resolved read files.
+
+Checking and resolving every read file is slow for large projects on
+network storage, and the Snakefile does it on every invocation. The loaded
+sample list is saved to a JSON manifest next to the sample list, with stat
+fingerprints of the sample list and of the directories holding the read
+files. While none of them changes the manifest is used as is, without
+touching any read file: adding, removing or renaming a file changes the
+fingerprint of its directory.
+"""
+
+from pathlib import Path
+import json
+import time
+import csv
+import sys
+import os
+
+MANIFEST_VERSION = 1
+
+# mtimes this close to the time a manifest was written may hide a later change
+MTIME_RESOLUTION = 2
+
+def manifest_path(samplelist_fp):
+    return str(samplelist_fp) + ".manifest.json"
+
+def fingerprint(path):
+    st = os.stat(path)
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+def _verify_path(fp):
+    if not fp:
+        raise ValueError("Missing filename")
+    path = Path(fp)
+    if not path.is_file():
+        raise ValueError("File not found")
+    return str(path.resolve())
+
+def read_sample_list(samplelist_fp, paired_end):
+    """
+    Build a list of samples from a sample list file.
+    :param samplelist_fp: a Path to a comma-delimited samplelist file,
+       where the first entry is the sample name.
+    :returns: A dictionary of samples with sample name and associated file(s),
+       and the directories of the files, as listed and as resolved
+    """
+    Samples = {}
+    dirs = set()
+    with open(str(samplelist_fp)) as f:
+        reader = csv.DictReader(f, fieldnames=['sample','1','2'])
+        for row in reader:
+            sample = row['sample']
+            try:
+                r1 = _verify_path(row['1'])
+            except ValueError:
+                raise ValueError("Associated file for {} not found.".format(
+                    sample))
+            r2 = ''
+            if paired_end:
+                try:
+                    r2 = _verify_path(row['2'])
+                except ValueError:
+                    raise ValueError(
+                        "Paired-end files specified, but mate pair for '{}' "
+                        "is missing or does not exist.".format(sample))
+            Samples[sample] = {'1': r1, '2': r2}
+            for fp in (row['1'], r1, row['2'] if paired_end else '', r2):
+                if fp:
+                    dirs.add(os.path.dirname(os.path.abspath(fp)))
+    return Samples, sorted(dirs)
+
+def load_manifest(manifest_fp, samplelist_fp, paired_end):
+    """Samples of the manifest, None if it is missing or out of date"""
+    try:
+        with open(manifest_fp) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("paired_end") != paired_end or \
+            manifest.get("samplelist") != os.path.abspath(str(samplelist_fp)):
+        return None
+    for path, fp in manifest["fingerprints"].items():
+        try:
+            current = fingerprint(path)
+        except OSError:
+            return None
+        if current != fp or current[2] >= manifest["written"] - MTIME_RESOLUTION:
+            return None
+    return manifest["samples"]
+
+def save_manifest(manifest_fp, samplelist_fp, paired_end, Samples, dirs):
+    samplelist = os.path.abspath(str(samplelist_fp))
+    paths = [samplelist] + dirs
+    manifest = {"version": MANIFEST_VERSION,
+                "samplelist": samplelist,
+                "paired_end": paired_end,
+                "written": time.time(),
+                "fingerprints": {path: fingerprint(path) for path in paths},
+                "samples": Samples}
+    tmp = "{}.{}.tmp".format(manifest_fp, os.getpid())
+    try:
+        with open(tmp, "w") as fh:
+            json.dump(manifest, fh)
+        os.rename(tmp, manifest_fp)
+    except OSError as e:
+        sys.stderr.write("WARNING: could not write sample manifest {}: {}\n".format(manifest_fp, e))
+
+def load_sample_list(samplelist_fp, paired_end, manifest_fp=None):
+    """
+    Samples of a sample list file, see read_sample_list. With manifest_fp, the
+    samples are taken from the manifest while it is up to date, and it is
+    rewritten otherwise.
+    """
+    if manifest_fp:
+        Samples = load_manifest(manifest_fp, samplelist_fp, paired_end)
+        if Samples is not None:
+            return Samples
+    Samples, dirs = read_sample_list(samplelist_fp, paired_end)
+    if manifest_fp:
+        save_manifest(manifest_fp, samplelist_fp, paired_end, Samples, dirs)
+    return Samples
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""
+Table logic of the genome selection rules: the sourmash coverage filter of
+the candidate genomes of a sample (rule sourmash_filter).
+"""
+
+import pandas as pd
+
+def coverage_filter(sourmash_table, genomes_file, min_cov):
+    """
+    Candidate genomes of a sample reaching min_cov sourmash coverage (f_match),
+    all viral candidates, and one genome per taxid and per seq
+    """
+    df = pd.read_csv(sourmash_table, sep="\t", dtype={"seq": str})
+    df = df[["seq","f_match"]]
+
+    seqid2taxid = pd.read_csv(genomes_file, sep="\t")
+
+    # intersect two tables
+    seqid2taxidCov = pd.merge(seqid2taxid,df,on="seq",how="left")
+
+    # keep virus results, and filter non-virus results according to min coverage cutoff
+    seqid2taxidCov_filtered = seqid2taxidCov.loc[seqid2taxidCov.f_match >= min_cov]
+    seqid2taxidCov_virus = seqid2taxidCov.loc[seqid2taxidCov.kingdom == "Viruses"].copy()
+
+    # set all NaN of f_match as 0 for virus
+    if not seqid2taxidCov_virus.empty:
+        seqid2taxidCov_virus = seqid2taxidCov_virus.fillna(0)
+        seqid2taxidCov_filtered = seqid2taxidCov_filtered.append(seqid2taxidCov_virus)
+
+    # if no genomes meet the coverage requirement,
+    # then keep the one with max coverage for mapping
+    if seqid2taxidCov_filtered.empty:
+        seqid2taxidCov_filtered = seqid2taxidCov.loc[seqid2taxidCov.f_match.idxmax()]
+
+    # when only one record is in it, seqid2taxidCov_filtered is pandas.core.series.Series
+    # convert seqid2taxidCov_filtered to a DataFrame
+    if not isinstance(seqid2taxidCov_filtered, pd.DataFrame):
+        seqid2taxidCov_filtered = pd.DataFrame([seqid2taxidCov_filtered])
+
+    # for same taxid with multiple genomes (eg, different species/strains within one genus),
+    # select the one with the highest percent coverage as a representative
+    seqid2taxidCov_filtered = seqid2taxidCov_filtered.sort_values("f_match",ascending=False).drop_duplicates(['taxID'])
+    # Make unique by seqid
+    return seqid2taxidCov_filtered.sort_values("f_match",ascending=False).drop_duplicates(['seq'])
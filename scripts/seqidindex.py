@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+Binary, memory-mapped sidecar of the centrifuge seqid2taxid.map.
+
+Sequences are stored sorted by the pre-order (Euler tour) number of their
+taxid in a compiled TaxTable, so all sequences belonging to the descendants
+of a taxid form one contiguous range that is found with two binary searches:
+    tour.npy          pre-order number of the taxid of each sequence, sorted
+    taxid.npy         taxid of each sequence
+    seqid_offset.npy,
+    seqids.bin        sequence ids, concatenated
+    meta.json         number of nodes of the TaxTable the index was built on
+
+Build it once per centrifuge database with:
+    python scripts/seqidindex.py --mapfile seqid2taxid.map --taxtable taxdb.taxtable --out seqid2taxid.index
+"""
+
+from argparse import ArgumentParser
+from taxtable import TaxTable, StringPool, write_strings
+import pandas as pd
+import numpy as np
+import json
+import sys
+import os
+
+def read_seqid2taxid(mapfile):
+    """Read the two-column seqid -> taxid map, tab or space separated"""
+    df = pd.read_csv(mapfile, header=None, names=["seq", "taxID"], sep="\t",
+                     dtype={"seq": str})
+    if df.taxID.isnull().all() and len(df) > 0:
+        df = pd.read_csv(mapfile, header=None, names=["seq", "taxID"], sep=" ",
+                         dtype={"seq": str})
+    return df
+
+def build_seqid_index(mapfile, taxtablefile, outdir):
+    taxtable = TaxTable(taxtablefile)
+    df = read_seqid2taxid(mapfile)
+    sys.stderr.write("Read {} sequences from {}\n".format(len(df), mapfile))
+    idx = taxtable.index(df.taxID.values)
+    missing = idx < 0
+    if missing.any():
+        sys.stderr.write("WARNING: {} sequences have taxids missing from the taxonomy and are not indexed\n".format(missing.sum()))
+    df = df.loc[~missing]
+    tour = taxtable.tour_in[idx[~missing]]
+    order = np.argsort(tour, kind="stable")
+
+    os.makedirs(outdir, exist_ok=True)
+    np.save(os.path.join(outdir, "tour.npy"), tour[order])
+    np.save(os.path.join(outdir, "taxid.npy"), df.taxID.values[order].astype(np.int64))
+    np.save(os.path.join(outdir, "seqid_offset.npy"),
+            write_strings(df.seq.values[order].tolist(), os.path.join(outdir, "seqids.bin")))
+    with open(os.path.join(outdir, "meta.json"), "w") as fh:
+        json.dump({"taxtable_nodes": len(taxtable)}, fh)
+    sys.stderr.write("Sequence index written to {}\n".format(outdir))
+
+class SeqidIndex(object):
+    """Range queries for the sequences of all descendants of taxids"""
+    def __init__(self, path, taxtable):
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        with open(os.path.join(path, "meta.json")) as fh:
+            meta = json.load(fh)
+        if meta["taxtable_nodes"] != len(taxtable):
+            raise ValueError("Sequence index {} was built on a different taxonomy table than {}".format(
+                path, taxtable.path))
+        self.taxtable = taxtable
+        self.tour = load("tour.npy")
+        self.taxid = load("taxid.npy")
+        self.seqids = StringPool(load("seqid_offset.npy"), os.path.join(path, "seqids.bin"))
+
+    def __len__(self):
+        return len(self.tour)
+
+    def ranges(self, taxids):
+        """Start and end positions of the sequences under each taxid (itself included)"""
+        idx = self.taxtable.index(taxids)
+        found = idx >= 0
+        idx = np.maximum(idx, 0)
+        lo = np.searchsorted(self.tour, self.taxtable.tour_in[idx], side="left")
+        hi = np.searchsorted(self.tour, self.taxtable.tour_out[idx], side="right")
+        hi = np.where(found, hi, lo)
+        return lo, hi
+
+    def descendant_seqids(self, taxids):
+        """
+        DataFrame of seq, taxID with every sequence assigned to a descendant
+        of each taxid, labelled with that (ancestor) taxid
+        """
+        taxids = np.atleast_1d(np.asarray(taxids, dtype=np.int64))
+        lo, hi = self.ranges(taxids)
+        counts = hi - lo
+        starts = np.cumsum(counts) - counts
+        pos = np.arange(counts.sum()) - np.repeat(starts, counts) + np.repeat(lo, counts)
+        return pd.DataFrame({"seq": [self.seqids[i] for i in pos],
+                             "taxID": np.repeat(taxids, counts)}, columns=["seq", "taxID"])
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--mapfile", type=str, required=True,
+                        help="Sequence id to taxid mapping file.")
+    parser.add_argument("--taxtable", type=str, required=True,
+                        help="Compiled taxonomy table (see taxtable.py).")
+    parser.add_argument("--out", type=str, required=True,
+                        help="Output directory of the sequence index.")
+    args = parser.parse_args()
+    build_seqid_index(args.mapfile, args.taxtable, args.out)
+
+if __name__ == '__main__':
+    main()
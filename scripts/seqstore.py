@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+Random access to the records of a large FASTA file, such as the centrifuge
+reference library input-sequences.fna.gz.
+
+The store is a directory with a BGZF (blocked gzip, readable by gzip and
+samtools faidx) copy of the FASTA and a faidx-style record index:
+    sequences.fna.gz   the FASTA, compressed in independent 64 kB blocks
+    block_offset.npy,
+    block_start.npy    compressed offset and uncompressed start of each block
+    hash.npy           64-bit hashes of the sequence ids, sorted
+    start.npy,
+    length.npy         uncompressed offset and length of each record, in hash order
+    seqid_offset.npy,
+    seqids.bin         sequence ids in hash order, to resolve hash collisions
+
+Build it once per centrifuge database with:
+    python scripts/seqstore.py build --fasta input-sequences.fna.gz --out input-sequences.store
+and extract records with:
+    python scripts/seqstore.py fetch --store input-sequences.store --seqids seqids.txt --out genomes.fna
+Fetching decompresses only the blocks holding the requested records.
+"""
+
+from argparse import ArgumentParser
+from taxtable import StringPool, write_strings
+from Bio import bgzf
+import pandas as pd
+import numpy as np
+import struct
+import gzip
+import sys
+import os
+
+def hash_ids(ids):
+    """64-bit hashes of sequence ids"""
+    return pd.util.hash_pandas_object(pd.Series(ids, dtype=object), index=False).values
+
+def open_fasta(fp):
+    if fp.endswith(".gz"):
+        return gzip.open(fp, "rb")
+    return open(fp, "rb")
+
+def scan_blocks(bgzffile):
+    """Compressed offset and uncompressed start of each BGZF block, read from the block headers"""
+    offsets, sizes = [], []
+    with open(bgzffile, "rb") as fh:
+        offset = 0
+        while True:
+            header = fh.read(18)
+            if len(header) < 18:
+                break
+            # BSIZE (total block size - 1) is the extra subfield of every BGZF header
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            fh.seek(offset + block_size - 4)
+            # ISIZE, the uncompressed size of the block, ends each gzip member
+            isize = struct.unpack("<I", fh.read(4))[0]
+            if isize > 0:
+                offsets.append(offset)
+                sizes.append(isize)
+            offset += block_size
+            fh.seek(offset)
+    offsets = np.array(offsets, dtype=np.int64)
+    starts = np.cumsum([0] + sizes[:-1]).astype(np.int64) if sizes else np.zeros(0, dtype=np.int64)
+    return offsets, starts
+
+def build_seqstore(fasta, outdir, bufsize=1 << 22):
+    os.makedirs(outdir, exist_ok=True)
+    bgzffile = os.path.join(outdir, "sequences.fna.gz")
+    seqids, starts = [], []
+    pos = 0
+    buf = []
+    buflen = 0
+    with open_fasta(fasta) as fh, bgzf.BgzfWriter(bgzffile, "wb") as writer:
+        for line in fh:
+            if line.startswith(b">"):
+                seqids.append(line[1:].split(None, 1)[0].decode("utf-8"))
+                starts.append(pos)
+            pos += len(line)
+            buf.append(line)
+            buflen += len(line)
+            if buflen >= bufsize:
+                writer.write(b"".join(buf))
+                buf, buflen = [], 0
+        writer.write(b"".join(buf))
+    sys.stderr.write("Compressed {} records ({} bytes) from {}\n".format(len(seqids), pos, fasta))
+
+    block_offset, block_start = scan_blocks(bgzffile)
+    np.save(os.path.join(outdir, "block_offset.npy"), block_offset)
+    np.save(os.path.join(outdir, "block_start.npy"), block_start)
+
+    starts = np.array(starts, dtype=np.int64)
+    lengths = np.diff(np.append(starts, pos))
+    hashes = hash_ids(seqids)
+    order = np.argsort(hashes, kind="stable")
+    np.save(os.path.join(outdir, "hash.npy"), hashes[order])
+    np.save(os.path.join(outdir, "start.npy"), starts[order])
+    np.save(os.path.join(outdir, "length.npy"), lengths[order])
+    np.save(os.path.join(outdir, "seqid_offset.npy"),
+            write_strings([seqids[i] for i in order], os.path.join(outdir, "seqids.bin")))
+    sys.stderr.write("Sequence store written to {}\n".format(outdir))
+
+class SeqStore(object):
+    """Fetch FASTA records by sequence id from a store built with build_seqstore"""
+    def __init__(self, path):
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.path = path
+        self.bgzffile = os.path.join(path, "sequences.fna.gz")
+        self.block_offset = load("block_offset.npy")
+        self.block_start = load("block_start.npy")
+        self.hash = load("hash.npy")
+        self.start = load("start.npy")
+        self.length = load("length.npy")
+        self.seqids = StringPool(load("seqid_offset.npy"), os.path.join(path, "seqids.bin"))
+
+    def __len__(self):
+        return len(self.hash)
+
+    def locate(self, seqids):
+        """
+        Uncompressed start and length of the records of seqids, in file
+        order, and the seqids that are not in the store
+        """
+        seqids = list(seqids)
+        hashes = hash_ids(seqids)
+        lo = np.searchsorted(self.hash, hashes, side="left")
+        hi = np.searchsorted(self.hash, hashes, side="right")
+        hits, missing = [], []
+        for seqid, l, h in zip(seqids, lo.tolist(), hi.tolist()):
+            found = [i for i in range(l, h) if self.seqids[i] == seqid]
+            if found:
+                hits.extend(found)
+            else:
+                missing.append(seqid)
+        hits = np.unique(np.array(hits, dtype=np.int64))
+        starts = np.asarray(self.start[hits])
+        order = np.argsort(starts, kind="stable")
+        return starts[order], np.asarray(self.length[hits])[order], missing
+
+    def virtual_offsets(self, starts):
+        """BGZF virtual offsets of uncompressed positions"""
+        block = np.searchsorted(self.block_start, starts, side="right") - 1
+        return (np.asarray(self.block_offset[block]) << 16) | (starts - np.asarray(self.block_start[block]))
+
+    def fetch(self, seqids):
+        """Yield the FASTA records (bytes) of seqids in file order"""
+        starts, lengths, missing = self.locate(seqids)
+        if missing:
+            sys.stderr.write("WARNING: {} sequence ids are not in {}, e.g. {}\n".format(
+                len(missing), self.path, missing[0]))
+        if len(starts) == 0:
+            return
+        with bgzf.BgzfReader(self.bgzffile, "rb") as reader:
+            for voffset, length in zip(self.virtual_offsets(starts).tolist(), lengths.tolist()):
+                reader.seek(voffset)
+                yield reader.read(length)
+
+    def write_fasta(self, seqids, output):
+        """Write the records of seqids to a plain FASTA file, returns the number of records"""
+        n = 0
+        with open(output, "wb") as fhout:
+            for record in self.fetch(seqids):
+                fhout.write(record)
+                n += 1
+        return n
+
+def read_seqids(fp):
+    with open(fp) as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    build = subparsers.add_parser("build", help="Build a sequence store from a (gzipped) FASTA file.")
+    build.add_argument("--fasta", type=str, required=True,
+                       help="Input FASTA, plain or gzipped.")
+    build.add_argument("--out", type=str, required=True,
+                       help="Output directory of the sequence store.")
+    fetch = subparsers.add_parser("fetch", help="Extract records from a sequence store.")
+    fetch.add_argument("--store", type=str, required=True,
+                       help="Sequence store directory.")
+    fetch.add_argument("--seqids", type=str, required=True,
+                       help="File with one sequence id per line.")
+    fetch.add_argument("--out", type=str, required=True,
+                       help="Output FASTA file.")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_seqstore(args.fasta, args.out)
+    elif args.command == "fetch":
+        n = SeqStore(args.store).write_fasta(read_seqids(args.seqids), args.out)
+        sys.stderr.write("Extracted {} records to {}\n".format(n, args.out))
+    else:
+        parser.error("one of build or fetch is required")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+Scaled MinHash sketches of the non-viral and viral hit reads of a sample,
+computed with the sourmash library in one pass over each FASTQ file.
+
+The non-viral reads are sketched at the fine scaled value while they are
+counted; once the read count exceeds --num_reads the sketch is downsampled
+to the coarse scaled value, which gives exactly the sketch that would have
+been computed at that value from the start. Batches of reads are sketched
+by worker processes and merged in the main process.
+"""
+
+from argparse import ArgumentParser
+from multiprocessing import Pool
+import sourmash
+import gzip
+import sys
+
+def open_fastq(fp):
+    if fp.endswith(".gz"):
+        return gzip.open(fp, "rt")
+    return open(fp, "r")
+
+def read_sequence_batches(fastq, batchsize):
+    """Yield lists of read sequences from a FASTQ file"""
+    batch = []
+    with open_fastq(fastq) as fh:
+        for i, line in enumerate(fh):
+            if i % 4 == 1:
+                batch.append(line.rstrip())
+                if len(batch) >= batchsize:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+def downsample(mh, scaled):
+    # sourmash < 4 names this downsample_scaled
+    if hasattr(mh, "downsample_scaled"):
+        return mh.downsample_scaled(scaled)
+    return mh.downsample(scaled=scaled)
+
+def sketch_batch(task):
+    ksize, scaled, seqs = task
+    mh = sourmash.MinHash(n=0, ksize=ksize, scaled=scaled)
+    for seq in seqs:
+        mh.add_sequence(seq, force=True)
+    return len(seqs), mh
+
+def sketch_reads(fastq, ksize, scaled, pool, batchsize, num_reads=None, coarse_scaled=None):
+    """
+    Sketch the reads of fastq, return the MinHash and the number of reads. If
+    num_reads is given, the sketch is downsampled to coarse_scaled as soon as
+    more than num_reads reads have been seen.
+    """
+    mh = sourmash.MinHash(n=0, ksize=ksize, scaled=scaled)
+    count = 0
+    tasks = ((ksize, scaled, batch) for batch in read_sequence_batches(fastq, batchsize))
+    for n, batch_mh in pool.imap(sketch_batch, tasks):
+        count += n
+        if num_reads is not None and count > num_reads and mh.scaled < coarse_scaled:
+            mh = downsample(mh, coarse_scaled)
+        if batch_mh.scaled < mh.scaled:
+            batch_mh = downsample(batch_mh, mh.scaled)
+        mh.merge(batch_mh)
+    return mh, count
+
+def save_signature(mh, name, output):
+    with open(output, "w") as fh:
+        sourmash.save_signatures([sourmash.SourmashSignature(mh, name=name)], fh)
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--nonviral", type=str, required=True,
+                        help="Non-viral hit reads in FASTQ format.")
+    parser.add_argument("--viral", type=str, required=True,
+                        help="Viral hit reads in FASTQ format.")
+    parser.add_argument("--name", type=str, required=True,
+                        help="Signature name, the sample name.")
+    parser.add_argument("--nonviral_sig", type=str, required=True,
+                        help="Output signature of the non-viral reads.")
+    parser.add_argument("--viral_sig", type=str, required=True,
+                        help="Output signature of the viral reads.")
+    parser.add_argument("--hash_fraction", type=str, required=True,
+                        help="Output file with the scaled value used for the non-viral reads.")
+    parser.add_argument("--num_reads", type=int, default=500000,
+                        help="Number of non-viral reads above which the coarse scaled value is used (default = 500000)")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="Number of sketching processes (default = 1)")
+    parser.add_argument("--batchsize", type=int, default=50000,
+                        help="Number of reads sketched per batch (default = 50000)")
+    args = parser.parse_args()
+
+    pool = Pool(args.threads)
+    # non-virus: k=31 and a scaled value of 100, or 1000 for large samples
+    mh, count = sketch_reads(args.nonviral, 31, 100, pool, args.batchsize,
+                             num_reads=args.num_reads, coarse_scaled=1000)
+    save_signature(mh, args.name, args.nonviral_sig)
+    with open(args.hash_fraction, "w") as fh:
+        fh.write("{}\n".format(mh.scaled))
+    sys.stderr.write("Sketched {} non-viral reads with k=31, scaled={}\n".format(count, mh.scaled))
+
+    # for virus, we use a less strigent kmer size and a small scaled value
+    mh, count = sketch_reads(args.viral, 21, 100, pool, args.batchsize)
+    save_signature(mh, args.name, args.viral_sig)
+    sys.stderr.write("Sketched {} viral reads with k=21, scaled={}\n".format(count, mh.scaled))
+    pool.close()
+    pool.join()
+
+if __name__ == '__main__':
+    main()
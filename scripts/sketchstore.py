@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+Database-level store of per-sequence scaled MinHash sketches of the
+centrifuge reference library, and greedy containment of sample sketches
+against candidate genomes looked up from it.
+
+The store is a directory with:
+    seqid_offset.npy,
+    seqids.bin          sequence ids, in library order
+    id_hash.npy,
+    id_record.npy       64-bit hashes of the sequence ids, sorted, and the
+                        record each one belongs to
+    k{ksize}.hashes.bin sorted sketch hashes of all records, concatenated (uint64)
+    k{ksize}.offset.npy start of the hashes of each record
+    meta.json           scaled value and k-mer sizes
+
+Build it once per centrifuge database with:
+    python scripts/sketchstore.py build --fasta input-sequences.fna.gz --out input-sequences.sketches
+"""
+
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from taxtable import StringPool, write_strings
+from seqstore import hash_ids, open_fasta
+import pandas as pd
+import numpy as np
+import sourmash
+import json
+import sys
+import os
+
+KSIZES = [21, 31]
+
+RESULT_COLUMNS = ["seq", "intersect_bp", "f_orig_query", "f_match", "f_unique_to_query", "group"]
+
+def read_fasta_records(fasta):
+    """Yield (seqid, sequence) from a FASTA file"""
+    seqid, parts = None, []
+    with open_fasta(fasta) as fh:
+        for line in fh:
+            if line.startswith(b">"):
+                if seqid is not None:
+                    yield seqid, b"".join(parts).decode("ascii")
+                seqid, parts = line[1:].split(None, 1)[0].decode("utf-8"), []
+            else:
+                parts.append(line.rstrip())
+    if seqid is not None:
+        yield seqid, b"".join(parts).decode("ascii")
+
+def minhash_hashes(mh):
+    """Sorted hashes of a MinHash as a uint64 array"""
+    # sourmash < 4 only has get_mins
+    hashes = mh.hashes if hasattr(mh, "hashes") else mh.get_mins()
+    return np.sort(np.fromiter(hashes, dtype=np.uint64, count=len(hashes)))
+
+def max_hash_for_scaled(scaled):
+    mh = sourmash.MinHash(n=0, ksize=KSIZES[0], scaled=scaled)
+    return mh._max_hash if hasattr(mh, "_max_hash") else mh.max_hash
+
+def sketch_record(task):
+    seqid, seq, scaled = task
+    sketches = []
+    for ksize in KSIZES:
+        mh = sourmash.MinHash(n=0, ksize=ksize, scaled=scaled)
+        mh.add_sequence(seq, force=True)
+        sketches.append(minhash_hashes(mh))
+    return seqid, sketches
+
+def build_sketchstore(fasta, outdir, scaled=100, threads=1):
+    os.makedirs(outdir, exist_ok=True)
+    seqids = []
+    offsets = [[0] for ksize in KSIZES]
+    outs = [open(os.path.join(outdir, "k{}.hashes.bin".format(ksize)), "wb") for ksize in KSIZES]
+    pool = Pool(threads)
+    tasks = ((seqid, seq, scaled) for seqid, seq in read_fasta_records(fasta))
+    for seqid, sketches in pool.imap(sketch_record, tasks, chunksize=16):
+        seqids.append(seqid)
+        for i, hashes in enumerate(sketches):
+            outs[i].write(hashes.tobytes())
+            offsets[i].append(offsets[i][-1] + len(hashes))
+        if len(seqids) % 10000 == 0:
+            sys.stderr.write("Sketched {} sequences\n".format(len(seqids)))
+    pool.close()
+    pool.join()
+    for i, ksize in enumerate(KSIZES):
+        outs[i].close()
+        np.save(os.path.join(outdir, "k{}.offset.npy".format(ksize)), np.array(offsets[i], dtype=np.int64))
+
+    np.save(os.path.join(outdir, "seqid_offset.npy"),
+            write_strings(seqids, os.path.join(outdir, "seqids.bin")))
+    id_hash = hash_ids(seqids)
+    order = np.argsort(id_hash, kind="stable")
+    np.save(os.path.join(outdir, "id_hash.npy"), id_hash[order])
+    np.save(os.path.join(outdir, "id_record.npy"), order.astype(np.int64))
+    with open(os.path.join(outdir, "meta.json"), "w") as fh:
+        json.dump({"scaled": scaled, "ksizes": KSIZES}, fh)
+    sys.stderr.write("Sketches of {} sequences written to {}\n".format(len(seqids), outdir))
+
+class SketchStore(object):
+    """Look up the sketches of sequences by seqid"""
+    def __init__(self, path):
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        with open(os.path.join(path, "meta.json")) as fh:
+            meta = json.load(fh)
+        self.path = path
+        self.scaled = meta["scaled"]
+        self.seqids = StringPool(load("seqid_offset.npy"), os.path.join(path, "seqids.bin"))
+        self.id_hash = load("id_hash.npy")
+        self.id_record = load("id_record.npy")
+        self.hashes, self.offsets = {}, {}
+        for ksize in meta["ksizes"]:
+            self.offsets[ksize] = load("k{}.offset.npy".format(ksize))
+            fp = os.path.join(path, "k{}.hashes.bin".format(ksize))
+            self.hashes[ksize] = np.memmap(fp, dtype=np.uint64, mode="r") if os.path.getsize(fp) \
+                else np.zeros(0, dtype=np.uint64)
+
+    def records(self, seqids):
+        """Record number of each seqid, -1 if it is not in the store"""
+        seqids = list(seqids)
+        hashes = hash_ids(seqids)
+        lo = np.searchsorted(self.id_hash, hashes, side="left")
+        hi = np.searchsorted(self.id_hash, hashes, side="right")
+        records = np.full(len(seqids), -1, dtype=np.int64)
+        for i, (seqid, l, h) in enumerate(zip(seqids, lo.tolist(), hi.tolist())):
+            for j in range(l, h):
+                if self.seqids[int(self.id_record[j])] == seqid:
+                    records[i] = self.id_record[j]
+                    break
+        return records
+
+    def sketch(self, record, ksize, max_hash=None):
+        """Sorted sketch hashes of a record, downsampled to max_hash"""
+        hashes = np.asarray(self.hashes[ksize][self.offsets[ksize][record]:self.offsets[ksize][record + 1]])
+        if max_hash:
+            hashes = hashes[:np.searchsorted(hashes, np.uint64(max_hash), side="right")]
+        return hashes
+
+def gather(query, candidates, scaled, threshold_bp=100):
+    """
+    Greedy containment of the sorted query hashes by the candidate sketches,
+    as sourmash gather: repeatedly take the candidate sharing most hashes
+    with the not yet explained part of the query, until that overlap is
+    below threshold_bp. Returns a list of (index, intersect_bp, f_orig_query,
+    f_match, f_unique_to_query) of the matches.
+    """
+    # positions in the query of the hashes shared with each candidate
+    shared = [np.intersect1d(query, hashes, assume_unique=True, return_indices=True)[1]
+              for hashes in candidates]
+    remaining = np.ones(len(query), dtype=bool)
+    results = []
+    active = [i for i in range(len(candidates)) if len(shared[i])]
+    while active:
+        overlaps = [int(remaining[shared[i]].sum()) for i in active]
+        best = int(np.argmax(overlaps))
+        overlap = overlaps[best]
+        if overlap == 0 or overlap * scaled < threshold_bp:
+            break
+        i = active.pop(best)
+        results.append((i, overlap * scaled, len(shared[i]) / len(query),
+                        overlap / len(candidates[i]), overlap / len(query)))
+        remaining[shared[i]] = False
+    return results
+
+def load_sketch(sigfile, ksize):
+    """Sorted hashes and scaled value of a sample signature"""
+    sig = sourmash.load_one_signature(sigfile, ksize=ksize)
+    return minhash_hashes(sig.minhash), sig.minhash.scaled
+
+def containment(store, groups, threshold_bp=100):
+    """
+    groups is a list of (name, signature file, ksize, candidate seqids). Returns a
+    DataFrame with the gather results of each group against its candidates.
+    """
+    rows = []
+    for name, sigfile, ksize, seqids in groups:
+        seqids = list(pd.unique(seqids))
+        if not seqids:
+            continue
+        query, scaled = load_sketch(sigfile, ksize)
+        if scaled < store.scaled:
+            raise ValueError("Signature {} has scaled={}, below the scaled={} of {}".format(
+                sigfile, scaled, store.scaled, store.path))
+        max_hash = max_hash_for_scaled(scaled)
+        records = store.records(seqids)
+        if (records < 0).any():
+            sys.stderr.write("WARNING: {} {} candidate sequences are not in {}\n".format(
+                (records < 0).sum(), name, store.path))
+        found = [(seqid, record) for seqid, record in zip(seqids, records.tolist()) if record >= 0]
+        candidates = [store.sketch(record, ksize, max_hash) for seqid, record in found]
+        for i, intersect_bp, f_orig_query, f_match, f_unique in gather(query, candidates, scaled, threshold_bp):
+            rows.append((found[i][0], intersect_bp, f_orig_query, f_match, f_unique, name))
+        sys.stderr.write("{}: {} of {} candidate sequences contained in {} (k={}, scaled={})\n".format(
+            name, sum(1 for row in rows if row[-1] == name), len(seqids), sigfile, ksize, scaled))
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    build = subparsers.add_parser("build", help="Build a sketch store from a (gzipped) FASTA file.")
+    build.add_argument("--fasta", type=str, required=True,
+                       help="Input FASTA, plain or gzipped.")
+    build.add_argument("--out", type=str, required=True,
+                       help="Output directory of the sketch store.")
+    build.add_argument("--scaled", type=int, default=100,
+                       help="Scaled value of the sketches (default = 100)")
+    build.add_argument("--threads", type=int, default=1,
+                       help="Number of sketching processes (default = 1)")
+    gather_parser = subparsers.add_parser("gather", help="Containment of sample sketches by candidate genomes.")
+    gather_parser.add_argument("--store", type=str, required=True,
+                               help="Sketch store directory.")
+    gather_parser.add_argument("--genomes", type=str, required=True,
+                               help="Candidate genomes of the sample (centrifuge_filter_genomes.py output).")
+    gather_parser.add_argument("--nonviral_sig", type=str, required=True,
+                               help="Signature of the non-viral reads (k=31).")
+    gather_parser.add_argument("--viral_sig", type=str, required=True,
+                               help="Signature of the viral reads (k=21).")
+    gather_parser.add_argument("--threshold_bp", type=int, default=100,
+                               help="Minimum overlap in bp reported (default = 100)")
+    gather_parser.add_argument("--out", type=str, required=True,
+                               help="Output table.")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_sketchstore(args.fasta, args.out, args.scaled, args.threads)
+    elif args.command == "gather":
+        genomes = pd.read_csv(args.genomes, sep="\t") if os.path.getsize(args.genomes) > 0 \
+            else pd.DataFrame(columns=["seq", "kingdom"])
+        virus = genomes.kingdom == "Viruses"
+        groups = [("nonvirus", args.nonviral_sig, 31, genomes.loc[~virus, "seq"].astype(str)),
+                  ("virus", args.viral_sig, 21, genomes.loc[virus, "seq"].astype(str))]
+        df = containment(SketchStore(args.store), groups, args.threshold_bp)
+        df.to_csv(args.out, sep="\t", index=False)
+    else:
+        parser.error("one of build or gather is required")
+
+if __name__ == '__main__':
+    main()
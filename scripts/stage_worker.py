@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""
+Warm workers for the short per-sample Python scripts of the workflow.
+
+Most of the run time of parse_centrifuge.py, parse_ARG.py and the like on a
+small sample is interpreter startup: importing pandas, matplotlib and
+sourmash, and opening the taxonomy table. The server imports the served
+scripts and opens the taxonomy table once, then forks a child for every
+request, which runs the script as `python script args` would, in the cwd and
+environment of the client and with its stdin, stdout and stderr:
+
+    python scripts/stage_worker.py serve --socket /tmp/ion-meta.sock --taxdb resources/taxonomy/taxdb.taxtable
+    python scripts/stage_worker.py run --socket /tmp/ion-meta.sock scripts/parse_centrifuge.py -i ...
+
+run only imports the standard library. When no server listens on the
+socket, or the server does not serve the script (another checkout, a
+module that failed to import, or scripts changed since the server started),
+run executes the script in a fresh interpreter instead. A client that is
+killed takes the child running its script with it.
+
+At startup the server times a cold start of each served script (a fresh
+interpreter importing it) and of run itself. Every request served is logged
+to the --log table (default {socket}.runs.tsv) with the startup time it
+saved, the cold start less the client and the fork; stats summarizes it.
+"""
+
+from argparse import ArgumentParser, REMAINDER
+import socket
+import signal
+import array
+import json
+import time
+import sys
+import os
+
+# modules of the scripts run by the rules through the worker
+SCRIPTS = ["parse_centrifuge", "centrifuge_filter_genomes", "parse_ARG", "bam_coverage",
+           "sketchstore", "cohort_store"]
+LOG_COLUMNS = ["finished", "script", "s", "returncode", "dispatch", "saved"]
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+MAX_FDS = 3
+
+def run_log(sock):
+    """Default log of the requests served on sock"""
+    return sock + ".runs.tsv"
+
+def read_line(conn, data=b""):
+    while b"\n" not in data:
+        chunk = conn.recv(65536)
+        if not chunk:
+            return None
+        data += chunk
+    return json.loads(data[:data.index(b"\n")].decode("utf-8"))
+
+def send_line(conn, message):
+    conn.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+#########
+## run ##
+#########
+
+def run_script(sock, script, argv):
+    """Exit status of script run by the server on sock, or None when it is not served there"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(sock)
+    except OSError:
+        conn.close()
+        return None
+    with conn:
+        request = json.dumps({"script": script, "argv": argv, "cwd": os.getcwd(),
+                              "env": dict(os.environ)}).encode("utf-8") + b"\n"
+        # stdin, stdout and stderr go with the first bytes of the request
+        sent = conn.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [0, 1, 2]))])
+        conn.sendall(request[sent:])
+        accepted = read_line(conn)
+        if accepted is None or not accepted.get("accepted"):
+            if accepted is not None:
+                sys.stderr.write("WARNING: the stage worker does not serve {}: {}\n".format(script, accepted.get("reason")))
+            return None
+        result = read_line(conn)
+    if result is None:
+        sys.stderr.write("ERROR: the stage worker running {} exited without a result\n".format(script))
+        return 1
+    return result["returncode"]
+
+############
+## server ##
+############
+
+def cold_start(code):
+    """Wall time of a fresh interpreter running code, with the scripts importable"""
+    import subprocess
+    start = time.time()
+    rc = subprocess.call([sys.executable, "-c", "import sys; sys.path.insert(0, {!r}); {}".format(SCRIPT_DIR, code)],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.time() - start if rc == 0 else None
+
+def script_mtimes():
+    return {f: os.path.getmtime(os.path.join(SCRIPT_DIR, f)) for f in os.listdir(SCRIPT_DIR) if f.endswith(".py")}
+
+def warm_taxtable(path):
+    """Open the taxonomy table and read all its pages, shared with every child"""
+    from taxtable import open_taxtable
+    import numpy as np
+    taxtable = open_taxtable(path)
+    for value in list(vars(taxtable).values()) + [taxtable.names.blob, taxtable._lookup.blob]:
+        if isinstance(value, np.ndarray) and len(value):
+            value.sum()
+    return taxtable
+
+def run_request(conn, server):
+    """Run the request on conn in this (forked) process"""
+    itemsize = array.array("i").itemsize
+    data, ancdata, flags, addr = conn.recvmsg(65536, socket.CMSG_LEN(MAX_FDS * itemsize))
+    received = array.array("i")
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            received.frombytes(cdata[:len(cdata) - len(cdata) % itemsize])
+    received = received.tolist()
+    request = read_line(conn, data)
+    if request is None or len(received) != 3:
+        return
+    script = os.path.join(request["cwd"], request["script"])
+    module = os.path.basename(script)[:-len(".py")] if script.endswith(".py") else None
+    reason = None
+    if os.path.dirname(os.path.realpath(script)) != SCRIPT_DIR:
+        reason = "not a script of {}".format(SCRIPT_DIR)
+    elif module not in server.served:
+        reason = "not served"
+    elif script_mtimes() != server.mtimes:
+        reason = "scripts changed since the worker started, restart it"
+    if reason:
+        send_line(conn, {"accepted": False, "reason": reason})
+        return
+    send_line(conn, {"accepted": True})
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    # the child goes when its client goes, e.g. when snakemake kills the job
+    def watch():
+        if not conn.recv(1):
+            os._exit(1)
+    import threading
+    threading.Thread(target=watch, daemon=True).start()
+
+    import runpy
+    import traceback
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for fd, target in zip(received, (0, 1, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    sys.argv = [request["script"]] + request["argv"]
+    dispatch = time.time() - server.accepted
+    start = time.time()
+    returncode = 0
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            sys.stderr.write("{}\n".format(e.code))
+            returncode = 1
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    seconds = time.time() - start
+    saved = max(server.cold[module] - server.client - dispatch, 0.0)
+    with open(server.log, "a") as fh:
+        fh.write("{:.3f}\t{}\t{:.4f}\t{}\t{:.4f}\t{:.4f}\n".format(time.time(), module, seconds, returncode, dispatch, saved))
+    send_line(conn, {"returncode": returncode, "s": seconds, "saved": saved})
+
+def serve(args):
+    import socketserver
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            run_request(self.request, self.server)
+
+    class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        max_children = args.workers
+
+        def process_request(self, request, client_address):
+            self.accepted = time.time()
+            socketserver.ForkingMixIn.process_request(self, request, client_address)
+
+    if os.path.exists(args.socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(args.socket)
+            raise SystemExit("A stage worker already listens on {}".format(args.socket))
+        except OSError:
+            os.remove(args.socket)
+        finally:
+            probe.close()
+
+    # figures are only saved to files
+    os.environ.setdefault("MPLBACKEND", "Agg")
+    sys.path.insert(0, SCRIPT_DIR)
+    client = cold_start("import socket, array, json, argparse")
+    cold, served = {}, []
+    for module in SCRIPTS:
+        seconds = cold_start("import {}".format(module))
+        try:
+            __import__(module)
+        except Exception as e:
+            sys.stderr.write("WARNING: {} is not served, it failed to import: {}\n".format(module, e))
+            continue
+        cold[module] = seconds or 0.0
+        served.append(module)
+        sys.stderr.write("{}: cold start {:.2f} s\n".format(module, cold[module]))
+    for path in args.taxdb or []:
+        start = time.time()
+        warm_taxtable(path)
+        sys.stderr.write("Taxonomy table {} loaded in {:.2f} s\n".format(path, time.time() - start))
+
+    log = args.log or run_log(args.socket)
+    if not os.path.exists(log):
+        with open(log, "w") as fh:
+            fh.write("\t".join(LOG_COLUMNS) + "\n")
+    old = os.umask(0o177)
+    try:
+        server = Server(args.socket, Handler)
+    finally:
+        os.umask(old)
+    server.served, server.cold, server.client = set(served), cold, client or 0.0
+    server.mtimes, server.log = script_mtimes(), log
+    sys.stderr.write("Serving {} on {} with up to {} workers\n".format(", ".join(served), args.socket, args.workers))
+    # stopped by SIGTERM or SIGINT, the socket is removed once the running scripts finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+###########
+## stats ##
+###########
+
+def stats(log, since=None):
+    """Requests, run time and saved startup time of each script served since the given time"""
+    import pandas as pd
+    df = pd.read_csv(log, sep="\t")
+    if since:
+        df = df.loc[df.finished >= since]
+    table = df.groupby("script").agg(runs=("s", "size"), s=("s", "sum"), failed=("returncode", lambda r: int((r != 0).sum())),
+                                     dispatch=("dispatch", "mean"), saved=("saved", "sum"))
+    return table.reset_index().round(4)
+
+def main():
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    server = subparsers.add_parser("serve", help="Serve the per-sample scripts on a UNIX socket.")
+    server.add_argument("--socket", type=str, required=True,
+                        help="Path of the UNIX socket.")
+    server.add_argument("--taxdb", type=str, nargs="+",
+                        help="Compiled taxonomy tables (see taxtable.py) to keep loaded.")
+    server.add_argument("--workers", type=int, default=8,
+                        help="Maximum number of scripts run at once (default = 8)")
+    server.add_argument("--log", type=str,
+                        help="Table of the requests served (default = {socket}.runs.tsv)")
+    run = subparsers.add_parser("run", help="Run a script through the server, or in a fresh interpreter without one.")
+    run.add_argument("--socket", type=str, required=True,
+                     help="Path of the UNIX socket.")
+    run.add_argument("script", type=str,
+                     help="Script to run.")
+    run.add_argument("args", nargs=REMAINDER,
+                     help="Arguments of the script.")
+    summary = subparsers.add_parser("stats", help="Startup time saved by the server.")
+    summary.add_argument("--log", type=str, required=True,
+                         help="Table of the requests served.")
+    summary.add_argument("--since", type=float,
+                         help="Only include requests finished after this time (seconds since the epoch).")
+    summary.add_argument("--out", type=str,
+                         help="Output table of each script.")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        returncode = run_script(args.socket, args.script, args.args)
+        if returncode is None:
+            os.execv(sys.executable, [sys.executable, args.script] + args.args)
+        sys.exit(returncode)
+    elif args.command == "serve":
+        serve(args)
+    elif args.command == "stats":
+        table = stats(args.log, args.since)
+        if args.out:
+            table.to_csv(args.out, sep="\t", index=False)
+        sys.stderr.write("The stage worker ran {} scripts, saving {:.1f} s of interpreter startup\n".format(
+            int(table.runs.sum()), table.saved.sum()))
+    else:
+        parser.error("one of serve, run or stats is required")
+
+if __name__ == '__main__':
+    main()
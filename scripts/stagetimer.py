@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""
+Wall time and peak memory of the stages of a script, e.g. the load,
+aggregate, lineage and write stages of parse_centrifuge.py.
+
+    timer = StageTimer("parse_centrifuge", args.timings)
+    with timer.stage("load"):
+        ...
+    timer.save()
+
+The timings file is a table of script, stage, s (wall seconds), cpu_time
+and max_rss (MB, peak of the process during the stage), written next to
+the benchmark files of the rules and collected by perf_report.py. Without
+a timings file nothing is written.
+"""
+
+from contextlib import contextmanager
+import resource
+import time
+import sys
+
+COLUMNS = ["script", "stage", "s", "cpu_time", "max_rss"]
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process to the current RSS, where the kernel allows it (Linux >= 4.0)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+def peak_rss():
+    """Peak RSS of the process in MB, from the kernel's high-water mark"""
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+class StageTimer(object):
+    def __init__(self, script, out=None):
+        self.script = script
+        self.out = out
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        reset_peak_rss()
+        start, cpu = time.time(), time.process_time()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.time() - start, time.process_time() - cpu, peak_rss()))
+
+    def save(self):
+        if not self.out:
+            return
+        with open(self.out, "w") as fh:
+            fh.write("\t".join(COLUMNS) + "\n")
+            for name, seconds, cpu, rss in self.stages:
+                fh.write("{}\t{}\t{:.4f}\t{:.4f}\t{:.2f}\n".format(self.script, name, seconds, cpu, rss))
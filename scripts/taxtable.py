@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+Compact, memory-mapped taxonomy table compiled from the ete3 sqlite database.
+
+The table is a directory of flat arrays indexed by node position (nodes are
+sorted by taxid):
+    taxid.npy        taxid of each node
+    parent.npy       position of the parent node (root points to itself)
+    rank.npy         rank code of each node, see ranks.json
+    name_offset.npy  offsets of each scientific name into names.bin
+    names.bin        utf-8 encoded scientific names, concatenated
+    tour_in.npy,
+    tour_out.npy     pre-order number of each node and the largest pre-order
+                     number in its subtree, so the descendants of a node are
+                     the nodes with tour_in in [tour_in, tour_out]
+    merged_old.npy,
+    merged_new.npy   merged (obsolete -> current) taxids, sorted by old taxid
+    lookup_*.npy,
+    lookup_names.bin case-folded scientific names and synonyms, sorted, for
+                     name -> taxid translation
+
+Build it once with:
+    python scripts/taxtable.py --taxdb taxdb.sqlite --out taxdb.taxtable
+and query it with TaxTable(path), which answers lineage, rank and name
+lookups for whole batches of taxids with array indexing instead of one
+sqlite query per node.
+"""
+
+from argparse import ArgumentParser
+import numpy as np
+import bisect
+import sqlite3
+import json
+import sys
+import os
+
+RANKS = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
+PREFIXES = ["k__", "p__", "c__", "o__", "f__", "g__", "s__"]
+
+def write_strings(strings, fp):
+    """Concatenate strings into fp and return their offsets"""
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    with open(fp, "wb") as fh:
+        pos = 0
+        for i, s in enumerate(strings):
+            b = s.encode("utf-8")
+            fh.write(b)
+            pos += len(b)
+            offsets[i+1] = pos
+    return offsets
+
+def euler_tour(parent):
+    """Pre-order numbering of the forest given by parent positions"""
+    n = len(parent)
+    order = np.argsort(parent, kind="stable")
+    sorted_parent = parent[order]
+    starts = np.searchsorted(sorted_parent, np.arange(n), side="left").tolist()
+    ends = np.searchsorted(sorted_parent, np.arange(n), side="right").tolist()
+    order = order.tolist()
+    tour_in = np.zeros(n, dtype=np.int64)
+    tour_out = np.zeros(n, dtype=np.int64)
+    counter = 0
+    stack = np.nonzero(parent == np.arange(n))[0][::-1].tolist()
+    while stack:
+        v = stack.pop()
+        if v < 0:
+            # all descendants of ~v have been numbered
+            tour_out[~v] = counter - 1
+            continue
+        tour_in[v] = counter
+        counter += 1
+        stack.append(~v)
+        stack.extend([c for c in reversed(order[starts[v]:ends[v]]) if c != v])
+    return tour_in, tour_out
+
+def build_taxtable(taxdb, outdir):
+    """Compile the ete3 sqlite taxonomy database into a TaxTable directory"""
+    con = sqlite3.connect(taxdb)
+    taxids = []
+    parents = []
+    ranks = []
+    names = []
+    for taxid, parent, rank, spname in con.execute(
+            "SELECT taxid, parent, rank, spname FROM species ORDER BY taxid"):
+        taxids.append(taxid)
+        # the root has an empty parent in the ete3 database
+        parents.append(int(parent) if parent not in (None, "") else taxid)
+        ranks.append(rank or "no rank")
+        names.append(spname or "")
+    merged = con.execute("SELECT taxid_old, taxid_new FROM merged ORDER BY taxid_old").fetchall()
+    synonyms = con.execute("SELECT taxid, spname FROM synonym").fetchall()
+    con.close()
+    sys.stderr.write("Read {} taxonomy nodes from {}\n".format(len(taxids), taxdb))
+
+    os.makedirs(outdir, exist_ok=True)
+    taxid = np.array(taxids, dtype=np.int64)
+    parent = np.searchsorted(taxid, np.array(parents, dtype=np.int64))
+    # parents missing from the table are treated as roots
+    parent[parent >= len(taxid)] = 0
+    orphan = taxid[parent] != np.array(parents, dtype=np.int64)
+    parent[orphan] = np.nonzero(orphan)[0]
+
+    tour_in, tour_out = euler_tour(parent)
+
+    rank_names = sorted(set(ranks))
+    rank_code = {r: i for i, r in enumerate(rank_names)}
+
+    np.save(os.path.join(outdir, "taxid.npy"), taxid)
+    np.save(os.path.join(outdir, "parent.npy"), parent.astype(np.int32))
+    np.save(os.path.join(outdir, "tour_in.npy"), tour_in)
+    np.save(os.path.join(outdir, "tour_out.npy"), tour_out)
+    np.save(os.path.join(outdir, "rank.npy"), np.array([rank_code[r] for r in ranks], dtype=np.uint8))
+    np.save(os.path.join(outdir, "name_offset.npy"), write_strings(names, os.path.join(outdir, "names.bin")))
+    with open(os.path.join(outdir, "ranks.json"), "w") as fh:
+        json.dump(rank_names, fh)
+
+    np.save(os.path.join(outdir, "merged_old.npy"), np.array([m[0] for m in merged], dtype=np.int64))
+    np.save(os.path.join(outdir, "merged_new.npy"), np.array([m[1] for m in merged], dtype=np.int64))
+
+    # case-insensitive name index over scientific names and synonyms,
+    # scientific names sort before synonyms with the same key
+    pos = np.searchsorted(taxid, np.array([s[0] for s in synonyms], dtype=np.int64))
+    entries = [(n.lower(), 0, i) for i, n in enumerate(names) if n]
+    entries += [(s[1].lower(), 1, int(p)) for s, p in zip(synonyms, pos)
+                if s[1] and p < len(taxid) and taxid[p] == s[0]]
+    entries.sort()
+    np.save(os.path.join(outdir, "lookup_node.npy"), np.array([e[2] for e in entries], dtype=np.int32))
+    np.save(os.path.join(outdir, "lookup_synonym.npy"), np.array([e[1] for e in entries], dtype=np.uint8))
+    np.save(os.path.join(outdir, "lookup_offset.npy"),
+            write_strings([e[0] for e in entries], os.path.join(outdir, "lookup_names.bin")))
+    sys.stderr.write("Taxonomy table written to {}\n".format(outdir))
+
+class StringPool(object):
+    """Read-only sequence view over strings stored with write_strings"""
+    def __init__(self, offsets, blobfile):
+        self.offsets = offsets
+        if os.path.getsize(blobfile) > 0:
+            self.blob = np.memmap(blobfile, dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]].tobytes().decode("utf-8")
+
+class TaxTable(object):
+    """Batch lineage, rank and name lookups over a compiled taxonomy table"""
+    def __init__(self, path):
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.path = path
+        self.taxid = load("taxid.npy")
+        self.parent = load("parent.npy")
+        self.rank = load("rank.npy")
+        self.tour_in = load("tour_in.npy")
+        self.tour_out = load("tour_out.npy")
+        self.names = StringPool(load("name_offset.npy"), os.path.join(path, "names.bin"))
+        self.merged_old = load("merged_old.npy")
+        self.merged_new = load("merged_new.npy")
+        self._lookup = StringPool(load("lookup_offset.npy"), os.path.join(path, "lookup_names.bin"))
+        self._lookup_node = load("lookup_node.npy")
+        self._lookup_synonym = load("lookup_synonym.npy")
+        with open(os.path.join(path, "ranks.json")) as fh:
+            self.rank_names = json.load(fh)
+        self.rank_code = {r: i for i, r in enumerate(self.rank_names)}
+
+    def __len__(self):
+        return len(self.taxid)
+
+    def index(self, taxids):
+        """Return node positions of taxids, merged taxids are translated and missing ones are -1"""
+        taxids = np.atleast_1d(np.asarray(taxids, dtype=np.int64))
+        if len(self.merged_old):
+            m = np.searchsorted(self.merged_old, taxids)
+            m[m >= len(self.merged_old)] = 0
+            hit = self.merged_old[m] == taxids
+            taxids = np.where(hit, self.merged_new[m], taxids)
+        if len(self.taxid) == 0:
+            return np.full(len(taxids), -1, dtype=np.int64)
+        idx = np.searchsorted(self.taxid, taxids)
+        idx[idx >= len(self.taxid)] = 0
+        return np.where(self.taxid[idx] == taxids, idx, -1)
+
+    def project(self, idx, ranks=RANKS):
+        """
+        Return a (len(idx), len(ranks)) array with the position of the ancestor
+        of each node at each rank, -1 where the lineage has no such rank.
+        The lineage includes the node itself.
+        """
+        idx = np.atleast_1d(np.asarray(idx, dtype=np.int64))
+        codes = [self.rank_code.get(r, -1) for r in ranks]
+        out = np.full((len(idx), len(ranks)), -1, dtype=np.int64)
+        rows = np.nonzero(idx >= 0)[0]
+        cur = idx[rows]
+        # walk all lineages up one level at a time, keeping the deepest node per rank
+        while len(rows):
+            rank = self.rank[cur]
+            for j, code in enumerate(codes):
+                hit = rank == code
+                sel = rows[hit]
+                unset = out[sel, j] < 0
+                out[sel[unset], j] = cur[hit][unset]
+            parent = self.parent[cur].astype(np.int64)
+            keep = parent != cur
+            rows = rows[keep]
+            cur = parent[keep]
+        return out
+
+    def name_of(self, idx):
+        """Scientific names of node positions, None for -1"""
+        return [self.names[i] if i >= 0 else None for i in np.atleast_1d(idx)]
+
+    def rank_of(self, taxids):
+        """Rank names of taxids, None for missing ones"""
+        idx = self.index(taxids)
+        return [self.rank_names[self.rank[i]] if i >= 0 else None for i in idx]
+
+    def translate(self, taxids):
+        """Dictionary of taxid -> scientific name, missing taxids are left out"""
+        taxids = np.atleast_1d(taxids)
+        return {int(t): n for t, n in zip(taxids, self.name_of(self.index(taxids))) if n is not None}
+
+    def rank_names_of(self, taxids, rank):
+        """Name of the ancestor of each taxid at one rank, '' when there is none"""
+        anc = self.project(self.index(taxids), [rank])[:, 0]
+        return [n or "" for n in self.name_of(anc)]
+
+    def superkingdom(self, taxids):
+        return self.rank_names_of(taxids, "superkingdom")
+
+    def lineage_names(self, taxids, ranks=RANKS, prefixes=PREFIXES, sep="|"):
+        """
+        Rank-projected lineage strings like k__Viruses|p__...|s__..., with
+        'unclassified' for absent ranks and 'Unknown' for missing taxids
+        """
+        idx = self.index(taxids)
+        proj = self.project(idx, ranks)
+        cache = {}
+        lineages = []
+        for i, row in zip(idx, proj):
+            if i < 0:
+                lineages.append(sep.join(["Unknown"]*len(ranks)))
+                continue
+            key = tuple(row)
+            if key not in cache:
+                cache[key] = sep.join([prefix + self.names[a] if a >= 0 else "unclassified"
+                                       for prefix, a in zip(prefixes, row)])
+            lineages.append(cache[key])
+        return lineages
+
+    def lineage(self, taxid):
+        """Taxids from the root down to taxid, like NCBITaxa.get_lineage"""
+        i = self.index([taxid])[0]
+        if i < 0:
+            raise ValueError("{} taxid not found".format(taxid))
+        track = [int(self.taxid[i])]
+        while self.parent[i] != i:
+            i = self.parent[i]
+            track.append(int(self.taxid[i]))
+        return track[::-1]
+
+    def has_ancestor(self, taxids, ancestors):
+        """Boolean array telling whether each taxid has one of ancestors in its lineage (itself included)"""
+        target = self.index(ancestors)
+        target = target[target >= 0]
+        pos = self.tour_in[np.maximum(self.index(taxids), 0)]
+        found = np.zeros(len(pos), dtype=bool)
+        for a in target:
+            found |= (pos >= self.tour_in[a]) & (pos <= self.tour_out[a])
+        found &= self.index(taxids) >= 0
+        return found
+
+    def descendants(self, taxid, intermediate_nodes=True):
+        """
+        Taxids of all descendants of taxid, itself excluded. With
+        intermediate_nodes=False only leaves are returned, like
+        NCBITaxa.get_descendant_taxa.
+        """
+        i = self.index([taxid])[0]
+        if i < 0:
+            raise ValueError("taxid not found:{}".format(taxid))
+        lo, hi = self.tour_in[i], self.tour_out[i]
+        nodes = np.nonzero((self.tour_in > lo) & (self.tour_in <= hi))[0]
+        if not intermediate_nodes:
+            nodes = nodes[self.tour_in[nodes] == self.tour_out[nodes]]
+        return [int(t) for t in self.taxid[nodes]]
+
+    def name_translator(self, names):
+        """Dictionary of name -> list of taxids, like NCBITaxa.get_name_translator"""
+        name2taxids = {}
+        for name in names:
+            key = name.lower()
+            lo = bisect.bisect_left(self._lookup, key)
+            hi = bisect.bisect_right(self._lookup, key, lo)
+            if hi == lo:
+                continue
+            synonym = self._lookup_synonym[lo:hi]
+            nodes = self._lookup_node[lo:hi]
+            # synonyms are only used when no scientific name matches
+            if (synonym == 0).any():
+                nodes = nodes[synonym == 0]
+            name2taxids[name] = [int(self.taxid[n]) for n in nodes]
+        return name2taxids
+
+_opened = {}
+
+def open_taxtable(path):
+    """
+    TaxTable of path, opened once per process and reopened when the table is
+    rebuilt; the children of a stage_worker.py server share the one it opened
+    """
+    key = (os.path.realpath(path), os.path.getmtime(os.path.join(path, "taxid.npy")))
+    if key not in _opened:
+        _opened[key] = TaxTable(path)
+    return _opened[key]
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--taxdb", type=str, required=True,
+                        help="Ete3 sqlite database file.")
+    parser.add_argument("--out", type=str, required=True,
+                        help="Output directory of the compiled taxonomy table.")
+    args = parser.parse_args()
+    build_taxtable(args.taxdb, args.out)
+
+if __name__ == '__main__':
+    main()